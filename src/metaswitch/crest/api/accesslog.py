@@ -0,0 +1,103 @@
+# @file accesslog.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import logging
+from twisted.internet import task, threads
+
+_log = logging.getLogger("crest.api.access")
+
+
+class AccessLog(object):
+    """
+    Log of the requests that have been handled.
+
+    Handling a request just stores its details (unformatted) in a ring buffer
+    of fixed size.  Every flush_interval seconds, the buffer is drained and the
+    requests are formatted and logged on a background thread, so logging costs
+    very little per request.  If the buffer fills up between flushes, the
+    oldest requests are overwritten (and counted).
+
+    To reduce logging further, only one in every sample_rate successful
+    requests is logged.  Failed requests, and requests that took longer than
+    slow_latency seconds, are always logged - as is every request while the
+    access log is enabled for debug logging.
+    """
+
+    def __init__(self, size, flush_interval, sample_rate=1, slow_latency=None):
+        self.size = size
+        self.flush_interval = flush_interval
+        self.sample_rate = max(int(sample_rate), 1)
+        self.slow_latency = slow_latency
+
+        self.entries = [None] * size
+        self.next = 0
+        self.count = 0
+        self.seen = 0
+        self.sampled_out = 0
+        self.overwritten = 0
+        self.flusher = None
+
+    def record(self, remote_ip, method, protocol, host, uri, status, latency):
+        """Records a request that has been handled (latency in seconds)"""
+        self.seen += 1
+        if (status < 400 and
+            (self.slow_latency is None or latency < self.slow_latency) and
+            self.seen % self.sample_rate != 0 and
+            not _log.isEnabledFor(logging.DEBUG)):
+            self.sampled_out += 1
+            return
+
+        if self.count == self.size:
+            self.overwritten += 1
+        else:
+            self.count += 1
+        self.entries[self.next] = (remote_ip, method, protocol, host, uri, status, latency)
+        self.next = (self.next + 1) % self.size
+
+    def drain(self):
+        """Empties the buffer, returning the requests in it (oldest first)
+        and the numbers of requests that were sampled out and overwritten"""
+        start = (self.next - self.count) % self.size
+        if start + self.count <= self.size:
+            entries = self.entries[start:start + self.count]
+        else:
+            entries = self.entries[start:] + self.entries[:self.next]
+
+        result = (entries, self.sampled_out, self.overwritten)
+        self.count = 0
+        self.sampled_out = 0
+        self.overwritten = 0
+        return result
+
+    @staticmethod
+    def write(entries, sampled_out, overwritten):
+        for (remote_ip, method, protocol, host, uri, status, latency) in entries:
+            _log.info("Sent %d response to %s for %s %s://%s%s in %dus",
+                      status, remote_ip, method, protocol, host, uri, latency * 1000000)
+
+        if sampled_out or overwritten:
+            _log.info("Not logged: %d sampled out, %d overwritten before they were logged",
+                      sampled_out, overwritten)
+
+    def flush(self):
+        """Logs the requests recorded since the last flush on a background
+        thread"""
+        if self.count or self.sampled_out or self.overwritten:
+            return threads.deferToThread(self.write, *self.drain())
+
+    def start(self):
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.start(self.flush_interval, now=False)
+
+    def stop(self):
+        # Log anything outstanding now, as the thread pool is being shut down.
+        if self.flusher is not None:
+            self.flusher.stop()
+            self.flusher = None
+        self.write(*self.drain())
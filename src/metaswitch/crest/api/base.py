@@ -12,20 +12,27 @@ import logging
 import json
 import traceback
 import httplib
+from collections import deque
 
 import msgpack
 import cyclone.web
 from cyclone.web import HTTPError
+from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
 
 from telephus.cassandra.ttypes import TimedOutException as CassandraTimeout
 from metaswitch.common import utils
 from metaswitch.crest import settings
-from metaswitch.crest.api.statistics import Accumulator, Counter
+from metaswitch.crest.api import statistics
+from metaswitch.crest.api.statistics import Accumulator, Counter, LabelledCollector, PercentileAccumulator
 from monotonic import monotonic
 from metaswitch.crest.api.DeferTimeout import TimeoutError
 from metaswitch.crest.api.exceptions import HSSOverloaded, HSSConnectionLost, HSSStillConnecting, UserNotIdentifiable, UserNotAuthorized
 from metaswitch.crest.api.lastvaluecache import LastValueCache
+from metaswitch.crest.api.accesslog import AccessLog
+from metaswitch.crest.api import tracing
+from metaswitch.crest.api.rowcache import RowMemo
+from metaswitch.crest.api.histogram import LatencyHistogram
 from metaswitch.crest import pdlogs
 
 _log = logging.getLogger("crest.api")
@@ -58,6 +65,21 @@ class PenaltyCounter:
         return self.hss_penalty_count
 
 
+# Request priorities.  When the system is overloaded, low priority requests
+# are rejected first, and high priority requests last.
+PRIORITY_LOW = "low"
+PRIORITY_NORMAL = "normal"
+PRIORITY_HIGH = "high"
+PRIORITIES = (PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH)
+
+# Clients can set the priority of a request with this header (for example, so
+# that the later steps of a multi-step operation aren't rejected).
+PRIORITY_HEADER = "X-Request-Priority"
+
+# Sprout times out requests that have taken over 500ms
+MAX_REQUEST_TIME = 0.5
+
+
 class LeakyBucket:
     def __init__(self, max_size, rate):
         self.max_size = max_size
@@ -65,14 +87,22 @@ class LeakyBucket:
         self.rate = rate
         self.replenish_time = monotonic()
 
-    def get_token(self):
+    def get_token(self, reserve=0):
+        """Takes a token from the bucket, as long as that leaves at least
+        `reserve` tokens in it.  Returns whether a token was taken."""
         self.replenish_bucket()
-        if self.tokens >= 1:
+        if self.tokens >= 1 + reserve:
             self.tokens -= 1
             return True
         else:
             return False
 
+    def time_until_token(self, reserve=0):
+        """Returns how long (in seconds) until get_token(reserve) will be able
+        to take a token"""
+        self.replenish_bucket()
+        return max(1 + reserve - self.tokens, 0) / float(self.rate)
+
     def update_rate(self, new_rate):
         self.rate = new_rate
 
@@ -101,12 +131,27 @@ class LoadMonitor:
     # How many deviations above the average latency is the max latency
     NUM_DEV = 4
 
-    def __init__(self, target_latency, max_bucket_size, init_token_rate, min_token_rate):
+    # How long (in seconds) the load reported by another process is taken
+    # into account for
+    PEER_LOAD_TIMEOUT = 10
+
+    def __init__(self, target_latency, max_bucket_size, init_token_rate, min_token_rate, target_percentile=None, headroom=None, name=None):
+        self.name = name
         self.accepted = 0
         self.rejected = 0
+
+        # The number of requests accepted and rejected since the load monitor
+        # was created (rather than since the last adjustment).
+        self.total_accepted = 0
+        self.total_rejected = 0
         self.pending_count = 0
         self.max_pending_count = 0
         self.target_latency = target_latency
+        self.target_percentile = target_percentile
+
+        # Maps each request priority to the proportion of the bucket that
+        # must be left for requests of higher priority.
+        self.headroom = headroom or {}
         self.smoothed_latency = 0
         self.smoothed_variability = target_latency
         self.max_latency = self.smoothed_latency + (self.NUM_DEV * self.smoothed_variability)
@@ -116,47 +161,197 @@ class LoadMonitor:
         self.overloaded = False
         self.last_adjustment_time = monotonic()
 
-    def admit_request(self):
-        if self.bucket.get_token():
-            # Got a token from the bucket, so admit the request
-            if self.overloaded:
-                pdlogs.API_NOTOVERLOADED.log()
-                self.overloaded = False
-            self.accepted += 1
-            self.pending_count += 1
-            queue_size_accumulator.accumulate(self.pending_count)
-            if self.pending_count > self.max_pending_count:
-                self.max_pending_count = self.pending_count
+        # Latencies (in microseconds) since the last adjustment.
+        self.latency_histogram = LatencyHistogram()
+
+        # The load most recently reported by the load monitors of the same
+        # name in other processes.  Maps process ID to the time of the report,
+        # the latency and the number of requests accepted.  We also count the
+        # HSS overloads they've seen since our last adjustment.
+        self.peer_load = {}
+        self.peer_hss_overloads = 0
+
+        # Requests waiting for a token, in a queue for each priority, in the
+        # order they arrived.  Each is a tuple of the request's deadline and a
+        # Deferred to fire once it's admitted or rejected.  Higher priority
+        # requests are admitted first, so a low priority request waiting for
+        # its headroom doesn't hold up the requests behind it.
+        self.queues = {priority: deque() for priority in PRIORITIES}
+        self.queue_timer = None
+
+    def queue_size(self):
+        return sum(len(queue) for queue in self.queues.itervalues())
+
+    def _queue_ahead(self, priority):
+        """Returns whether any requests of at least this priority are
+        queued"""
+        return any(self.queues[queued_priority]
+                   for queued_priority in PRIORITIES[PRIORITIES.index(priority):])
+
+    def admit_request(self, priority=PRIORITY_NORMAL):
+        # Requests that are already queued get the next tokens, unless they
+        # are of lower priority.
+        if not self._queue_ahead(priority) and self._get_token(priority):
+            self._accept()
             return True
         else:
-            if not self.overloaded:
-                pdlogs.API_OVERLOADED.log()
-                self.overloaded = True
-            self.rejected += 1
+            self._reject()
             return False
 
+    def request_admission(self, priority, deadline, max_queue_size):
+        """
+        Admits a request if there is a token for it.  Otherwise, the request
+        waits for a token in a queue of at most max_queue_size requests -
+        unless it's unlikely to be handled by the deadline (as returned by
+        monotonic()), in which case it's rejected.  Returns a Deferred that
+        fires with whether the request was admitted.
+        """
+        if not self._queue_ahead(priority) and self._get_token(priority):
+            self._accept()
+            return defer.succeed(True)
+
+        if self.queue_size() >= max_queue_size or not self._can_meet(deadline):
+            self._reject()
+            return defer.succeed(False)
+
+        d = defer.Deferred()
+        self.queues[priority].append((deadline, d))
+        self._schedule_queue()
+        return d
+
+    def _reserve(self, priority):
+        return self.bucket.max_size * self.headroom.get(priority, 0)
+
+    def _get_token(self, priority):
+        return self.bucket.get_token(self._reserve(priority))
+
+    def _can_meet(self, deadline):
+        # Assume that the request will take as long to handle as requests
+        # have recently.
+        return monotonic() + self.smoothed_latency < deadline
+
+    def _accept(self):
+        if self.overloaded:
+            pdlogs.API_NOTOVERLOADED.log()
+            self.overloaded = False
+        self.accepted += 1
+        self.total_accepted += 1
+        self.pending_count += 1
+        queue_size_accumulator.accumulate(self.pending_count)
+        if self.pending_count > self.max_pending_count:
+            self.max_pending_count = self.pending_count
+
+    def _reject(self):
+        if not self.overloaded:
+            pdlogs.API_OVERLOADED.log()
+            self.overloaded = True
+        self.rejected += 1
+        self.total_rejected += 1
+
+    def _schedule_queue(self):
+        """Arranges for the queues to be serviced when the request at the head
+        of any of them can get a token, or must be rejected, whichever is
+        soonest"""
+        if self.queue_timer is not None and self.queue_timer.active():
+            self.queue_timer.cancel()
+
+        now = monotonic()
+        wait = None
+        for priority, queue in self.queues.iteritems():
+            if queue:
+                (deadline, _) = queue[0]
+                head_wait = min(self.bucket.time_until_token(self._reserve(priority)),
+                                deadline - self.smoothed_latency - now)
+                wait = head_wait if wait is None else min(wait, head_wait)
+
+        self.queue_timer = None
+        if wait is not None:
+            self.queue_timer = reactor.callLater(max(wait, 0), self._service_queue)
+
+    def _service_queue(self):
+        self.queue_timer = None
+        results = []
+
+        # Admit requests from the highest priority queue first.  Once a
+        # request can't get a token, requests of lower priority (which need
+        # more headroom) can't either, but they are still rejected if they
+        # can no longer meet their deadlines.
+        blocked = False
+        for priority in reversed(PRIORITIES):
+            queue = self.queues[priority]
+            while queue:
+                (deadline, d) = queue[0]
+                if not self._can_meet(deadline):
+                    # Too late to handle this request now.
+                    queue.popleft()
+                    self._reject()
+                    results.append((d, False))
+                elif not blocked and self._get_token(priority):
+                    queue.popleft()
+                    self._accept()
+                    results.append((d, True))
+                else:
+                    blocked = True
+                    break
+
+        self._schedule_queue()
+
+        # Only carry on with the requests once the queue is consistent, as
+        # they may be handled straight away.
+        for d, admitted in results:
+            d.callback(admitted)
+
     def request_complete(self):
         self.pending_count -= 1
 
+    def background_pause(self, max_pause):
+        """
+        Returns how long (in seconds) background work, such as listing every
+        subscriber, should pause between steps so as not to slow down other
+        requests.  This is zero while latency is at or below the target, and
+        rises to max_pause as latency reaches twice the target (or if we're
+        rejecting requests).
+        """
+        if self.overloaded:
+            return max_pause
+
+        err = (self.smoothed_latency - self.target_latency) / self.target_latency
+        return max_pause * min(max(err, 0.0), 1.0)
+
     def update_latency(self, latency):
         self.smoothed_latency = (7 * self.smoothed_latency + latency) / 8
         self.smoothed_variability = (7 * self.smoothed_variability + abs(latency - self.smoothed_latency)) / 8
         self.max_latency = self.smoothed_latency + (self.NUM_DEV * self.smoothed_variability)
+        self.latency_histogram.record(latency * 1000000)
         self.adjust_count -= 1
         seconds_since_last_update = monotonic() - self.last_adjustment_time
 
         if (self.adjust_count <= 0) and (seconds_since_last_update >= self.SECONDS_BEFORE_ADJUSTMENT):
             # This algorithm is based on the Welsh and Culler "Adaptive Overload
-            # Control for Busy Internet Servers" paper, although based on a smoothed
-            # mean latency, rather than the 90th percentile as per the paper.
-            # Also, the additive increase is scaled as a proportion of the maximum
-            # bucket size, rather than an absolute number as per the paper.
+            # Control for Busy Internet Servers" paper.  By default it is based on
+            # a smoothed mean latency, rather than the 90th percentile as per the
+            # paper, but it can be based on any percentile of the latency since
+            # the last adjustment.  Also, the additive increase is scaled as a
+            # proportion of the maximum bucket size, rather than an absolute
+            # number as per the paper.
             accepted_percent = 100
             if (self.accepted + self.rejected) != 0:
                 accepted_percent = 100 * (float(self.accepted) / float(self.accepted + self.rejected))
 
-            err = (self.smoothed_latency - self.target_latency) / self.target_latency
+            if self.target_percentile is not None:
+                latency = self.latency_histogram.percentile(self.target_percentile) / 1000000.0
+            else:
+                latency = self.smoothed_latency
+
+            # Share our load with the other processes, and adjust based on the
+            # load on all of them - otherwise each process would probe the
+            # capacity of the node independently, and together they would
+            # overshoot.
             hss_overloads = penaltycounter.get_hss_penalty_count()
+            zmq.report_load_state(self.name, latency, self.accepted, hss_overloads)
+            (latency, hss_overloads, share) = self.node_load(latency, hss_overloads)
+
+            err = (latency - self.target_latency) / self.target_latency
             if ((err > self.DECREASE_THRESHOLD) or (hss_overloads > 0)):
                 # latency is above where we want it to be, or we are getting overload responses from the HSS,
                 # so adjust the rate downwards by a multiplicative factor
@@ -178,7 +373,10 @@ class LoadMonitor:
                 minimum_threshold = max_permitted_requests * 0.5
 
                 if (self.accepted > minimum_threshold):
-                    new_rate = self.bucket.rate + (-err) * self.bucket.max_size * self.INCREASE_FACTOR
+                    # Only increase the rate by our share of the node's
+                    # requests, so that the node as a whole increases its rate
+                    # as a single process would.
+                    new_rate = self.bucket.rate + (-err) * self.bucket.max_size * self.INCREASE_FACTOR * share
                     _log.info("Accepted %.2f%% of requests, latency error = %f, increase rate %f to %f"
                               " based on %d accepted requests in last %.2f seconds" %
                               (accepted_percent, err, self.bucket.rate, new_rate,
@@ -196,31 +394,151 @@ class LoadMonitor:
             self.rejected = 0
             self.adjust_count = self.REQUESTS_BEFORE_ADJUSTMENT
             self.last_adjustment_time = monotonic()
+            self.latency_histogram.reset()
 
         penaltycounter.reset_hss_penalty_count()
 
-# Create load monitor with target latency of 100ms, maximum bucket size of
-# 1000 request tokens, initial token rate of 100/s, and a minimum rate of 10/s
-loadmonitor = LoadMonitor(0.1, 1000, 100, 10)
+    def record_peer_load(self, peer_id, latency, requests, hss_overloads):
+        """Records the load reported by the load monitor of the same name in
+        another process"""
+        self.peer_load[peer_id] = (monotonic(), latency, requests)
+        self.peer_hss_overloads += hss_overloads
+
+    def node_load(self, latency, hss_overloads):
+        """
+        Combines our latency and HSS overloads since the last adjustment with
+        those recently reported by other processes.  Returns the latency
+        (averaged over all the processes' requests), the total HSS overloads,
+        and our share of the requests.
+        """
+        now = monotonic()
+        total_latency = latency * self.accepted
+        total_requests = self.accepted
+
+        for peer_id, (time, peer_latency, peer_requests) in self.peer_load.items():
+            if now - time > self.PEER_LOAD_TIMEOUT:
+                del self.peer_load[peer_id]
+            else:
+                total_latency += peer_latency * peer_requests
+                total_requests += peer_requests
+
+        share = 1.0
+        if total_requests > 0:
+            latency = total_latency / total_requests
+            share = float(self.accepted) / total_requests
+
+        hss_overloads += self.peer_hss_overloads
+        self.peer_hss_overloads = 0
+
+        return (latency, hss_overloads, share)
+
+# Create load monitor with the configured target latency (100ms by default),
+# maximum bucket size of 1000 request tokens, initial token rate of 100/s, and
+# a minimum rate of 10/s
+loadmonitor = LoadMonitor(settings.LOAD_MONITOR_TARGET_LATENCY,
+                          1000,
+                          100,
+                          10,
+                          settings.LOAD_MONITOR_TARGET_PERCENTILE,
+                          settings.ADMISSION_HEADROOM)
 penaltycounter = PenaltyCounter()
 
+# Load monitors for each admission class in settings.ADMISSION_CLASSES, created
+# when first used.  Requests in any other admission class use loadmonitor.
+_load_monitors = {}
+
+def get_load_monitor(admission_class):
+    """Returns the LoadMonitor that admits requests of the given admission
+    class"""
+    if admission_class not in settings.ADMISSION_CLASSES:
+        return loadmonitor
+
+    if admission_class not in _load_monitors:
+        _log.info("Creating load monitor for %s requests" % admission_class)
+        _load_monitors[admission_class] = LoadMonitor(
+                                headroom=settings.ADMISSION_HEADROOM,
+                                name=admission_class,
+                                **settings.ADMISSION_CLASSES[admission_class])
+    return _load_monitors[admission_class]
+
+def all_load_monitors():
+    return [loadmonitor] + _load_monitors.values()
+
+def record_peer_load(peer_id, admission_class, latency, requests, hss_overloads):
+    """Records the load reported by another process for one of its load
+    monitors"""
+    get_load_monitor(admission_class).record_peer_load(peer_id,
+                                                       latency,
+                                                       requests,
+                                                       hss_overloads)
+
+class LoadMonitorCollector(statistics.Collector):
+    """
+    Publishes the state of each load monitor (labelled with the name of its
+    admission class, or "default").
+    """
+
+    FIELDS = ["rate", "tokens", "smoothed_latency", "accepted_total", "rejected_total", "queued"]
+    labelled = True
+
+    def add(self):
+        pass
+
+    def values(self, time_difference):
+        values = []
+        for monitor in all_load_monitors():
+            monitor.bucket.replenish_bucket()
+            values.extend([monitor.name or "default",
+                           monitor.bucket.rate,
+                           monitor.bucket.tokens,
+                           monitor.smoothed_latency,
+                           monitor.total_accepted,
+                           monitor.total_rejected,
+                           monitor.queue_size()])
+        return values
+
+    def reset(self):
+        self.start_time = monotonic()
+
 # Create the accumulators and counters
 zmq = LastValueCache(settings.PROCESS_NAME)
 latency_accumulator = Accumulator("P_latency_us")
+latency_percentiles = PercentileAccumulator("P_latency_percentiles_us",
+                                            sketch_name="P_latency_sketch_us")
 queue_size_accumulator = Accumulator("P_queue_size")
 incoming_requests = Counter("P_incoming_requests")
 overload_counter = Counter("P_rejected_overload")
+load_monitor_collector = LoadMonitorCollector("P_load_monitors")
+
+# The same stats for each endpoint (see BaseHandler.get_endpoint)
+endpoint_latency_accumulator = LabelledCollector("P_endpoint_latency_us",
+                                                 Accumulator,
+                                                 settings.ENDPOINT_STATS_MAX_LABELS)
+endpoint_overload_counter = LabelledCollector("P_endpoint_rejected_overload",
+                                              Counter,
+                                              settings.ENDPOINT_STATS_MAX_LABELS)
+
+access_log = AccessLog(settings.ACCESS_LOG_BUFFER_SIZE,
+                       settings.ACCESS_LOG_FLUSH_INTERVAL,
+                       settings.ACCESS_LOG_SAMPLE_RATE,
+                       settings.LOAD_MONITOR_TARGET_LATENCY)
 
 # Update the accumulators and counters when the process id is known,
 # and set up the zmq bindings
 def setupStats(p_id, worker_proc):
     zmq.bind(p_id, worker_proc)
-    latency_accumulator.set_process_id(p_id)
-    queue_size_accumulator.set_process_id(p_id)
-    incoming_requests.set_process_id(p_id)
-    overload_counter.set_process_id(p_id)
+
+    # Worker processes always have peers, even if they weren't told how many.
+    if p_id != 0 or worker_proc > 1:
+        zmq.listen_for_load_state(record_peer_load)
+    for collector in statistics.collectors:
+        collector.set_process_id(p_id)
+    statistics.start_publishing()
+    access_log.start()
 
 def shutdownStats():
+    access_log.stop()
+    statistics.stop_publishing()
     zmq.unbind()
 
 def _guess_mime_type(body):
@@ -242,50 +560,100 @@ class BaseHandler(cyclone.web.RequestHandler):
     authenticating requests and post-processing data.
     """
 
+    # The admission class of requests to this handler - requests in different
+    # classes are admitted by different load monitors (see
+    # settings.ADMISSION_CLASSES).
+    admission_class = None
+
+    # The priority of requests to this handler, unless the client sets it.
+    priority = PRIORITY_NORMAL
+
     def __init__(self, application, request, **kwargs):
         super(BaseHandler, self).__init__(application, request, **kwargs)
         self.__request_data = None
 
+        # Timings of the stages of handling this request, if it's traced.
+        self.trace = tracing.start_trace()
+
+        # Rows read from Cassandra while handling this request.  Only GETs
+        # can be answered from the (possibly stale) row cache.
+        self.row_memo = RowMemo(self.trace,
+                                use_row_cache=(request.method == "GET"))
+
     def should_count_requests_in_latency(self):
         return True
 
+    def get_admission_class(self):
+        return self.admission_class
+
+    def get_endpoint(self):
+        """The label for statistics about requests to this endpoint"""
+        return "%s %s" % (self.request.method, self.__class__.__name__)
+
+    def get_priority(self):
+        priority = self.request.headers.get(PRIORITY_HEADER)
+        if priority in PRIORITIES:
+            return priority
+        return self.priority
+
     def prepare(self):
         # Increment the request counter
         incoming_requests.increment()
 
         # timestamp the request
         self._start = monotonic()
-        _log.info("Received request from %s - %s %s://%s%s" %
-                   (self.request.remote_ip, self.request.method, self.request.protocol, self.request.host, self.request.uri))
-        if not loadmonitor.admit_request():
+        # Requests are logged once they've been handled (see on_finish).
+        _log.debug("Received request from %s - %s %s://%s%s",
+                   self.request.remote_ip, self.request.method, self.request.protocol, self.request.host, self.request.uri)
+        self._load_monitor = get_load_monitor(self.get_admission_class())
+        if settings.ADMISSION_QUEUE_SIZE > 0:
+            # Wait (briefly) for a token if there isn't one yet.
+            d = self._load_monitor.request_admission(self.get_priority(),
+                                                     self._start + MAX_REQUEST_TIME,
+                                                     settings.ADMISSION_QUEUE_SIZE)
+            return self.trace.time("admission", d).addCallback(self._check_admitted)
+        return self._check_admitted(self._load_monitor.admit_request(self.get_priority()))
+
+    def _check_admitted(self, admitted):
+        if not admitted:
             _log.warning("Rejecting request because of overload")
             overload_counter.increment()
+            endpoint_overload_counter.increment(self.get_endpoint())
             return Failure(HTTPError(httplib.SERVICE_UNAVAILABLE))
 
     def on_finish(self):
-        _log.info("Sending %s response to %s for %s %s://%s%s" %
-                   (self.get_status(),
-                    self.request.remote_ip,
-                    self.request.method,
-                    self.request.protocol,
-                    self.request.host,
-                    self.request.uri))
-
-        loadmonitor.request_complete()
+        self._load_monitor.request_complete()
         latency = monotonic() - self._start
+        access_log.record(self.request.remote_ip,
+                          self.request.method,
+                          self.request.protocol,
+                          self.request.host,
+                          self.request.uri,
+                          self.get_status(),
+                          latency)
+        self.trace.finish(self.request.method,
+                          self.request.uri,
+                          self.get_status(),
+                          latency)
         if self.should_count_requests_in_latency():
-            loadmonitor.update_latency(latency)
+            self._load_monitor.update_latency(latency)
 
         # Track the latency of the requests (in usec)
         latency_accumulator.accumulate(latency * 1000000)
+        latency_percentiles.accumulate(latency * 1000000)
+        endpoint_latency_accumulator.accumulate(self.get_endpoint(), latency * 1000000)
+
+    def accepts(self, content_type):
+        """Returns whether the client will accept a response of the given
+        content type"""
+        return content_type in self.request.headers.get("Accept", "")
 
     def write(self, chunk):
-        if (isinstance(chunk, dict) and
-             "application/x-msgpack" in self.request.headers.get("Accept", "")):
+        if (isinstance(chunk, dict) and self.accepts("application/x-msgpack")):
             _log.debug("Responding with msgpack")
             self.set_header("Content-Type", "application/x-msgpack")
             chunk = msgpack.dumps(chunk)
-        _log.debug("Writing response body: %s" % chunk)
+        _log.debug("Writing response body: %s", chunk)
         cyclone.web.RequestHandler.write(self, chunk)
 
     def _query_data(self, args):
@@ -434,9 +802,6 @@ class BaseHandler(cyclone.web.RequestHandler):
         """Decorator that sends a 503 error (and returns None) if the request
         is too old"""
 
-        # Sprout times out requests that have taken over 500ms
-        MAX_REQUEST_TIME = 0.5
-
         def wrapper(handler, *pos_args, **kwd_args):
             if monotonic() - handler._start > MAX_REQUEST_TIME:
                 handler.send_error(503, "Request too old")
@@ -455,6 +820,10 @@ class UnknownApiHandler(BaseHandler):
 class SlowRequestHandler(BaseHandler):
     """
     Handler that doesn't track the latency of its requests with the load monitor - used for slow requests that won't complete instantly.
+    These are low priority, unless the client says otherwise.
     """
+    admission_class = "slow"
+    priority = PRIORITY_LOW
+
     def should_count_requests_in_latency(self):
         return False
@@ -0,0 +1,440 @@
+# @file cassandrapool.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import socket
+import logging
+from random import shuffle
+from monotonic import monotonic
+from twisted.internet import defer, reactor, task
+from telephus.protocol import ManagedCassandraClientFactory
+from telephus.client import CassandraClient
+from telephus.cassandra.ttypes import ConsistencyLevel, TimedOutException, UnavailableException
+
+from metaswitch.crest import settings
+from metaswitch.crest.api import utils
+from metaswitch.crest.api.cassandraring import TokenRing
+from metaswitch.crest.api.histogram import LatencyHistogram
+from metaswitch.crest.api.quorumbreaker import get_breaker
+from metaswitch.crest.api.statistics import Accumulator, Counter, LabelledCollector
+
+_log = logging.getLogger("crest.api.cassandra")
+
+hedged_reads_counter = Counter("P_cassandra_hedged_reads")
+timed_out_counter = Counter("P_cassandra_timeouts")
+
+# The latency of each type of request to each keyspace, labelled with the
+# keyspace and the method, e.g. "homer get_slice".
+MAX_LATENCY_LABELS = 50
+request_latency_accumulator = LabelledCollector("P_cassandra_latency_us",
+                                                Accumulator,
+                                                MAX_LATENCY_LABELS)
+
+
+class PooledConnection(object):
+    """One of the connections in a CassandraPool"""
+
+    def __init__(self, address, factory, client, discovered=False):
+        self.address = address
+        self.factory = factory
+        self.client = client
+
+        # Whether this is a connection to a node that we discovered from the
+        # ring (rather than to one of the configured addresses).
+        self.discovered = discovered
+
+        # The number of requests made on this connection that haven't
+        # completed yet.
+        self.outstanding = 0
+
+
+class CassandraPool(object):
+    """
+    Pool of connections to a Cassandra keyspace, through which homer and
+    homestead-prov make all their requests to it.  The pool can be used in
+    place of a telephus CassandraClient, and also provides the ha_* methods,
+    which make requests with our usual consistency fallback, timeouts and
+    retries (see ha).
+
+    The pool starts with connections spread across all the addresses that the
+    Cassandra host resolves to, and then periodically reads the ring of the
+    keyspace to discover the other nodes in the local datacenter(s), and which
+    of them own each row.  Requests for a single row are sent to one of the
+    row's replicas, saving the hop from the coordinator node to a replica;
+    other requests can go to any node.  Of the candidate connections, each
+    request is made on the one with the fewest outstanding requests, so that a
+    connection that is slow (or waiting to reconnect) is avoided.
+
+    If hedged reads are enabled (CASS_HEDGE_PERCENTILE), a read that is slower
+    than that percentile of recent reads is sent again on another connection
+    (to another replica, if there is one), and whichever response comes first
+    is used.
+
+    LOCAL_QUORUM requests go through the keyspace's QuorumBreaker, so that
+    while LOCAL_QUORUM is unavailable they fail without being sent, and the
+    caller can go straight to retrying at ONE.
+    """
+
+    # The methods that read or write a single row, passed as the "key"
+    # argument (or the first positional one).
+    ROW_METHODS = ("get", "get_slice", "get_count", "insert", "remove", "batch_insert")
+
+    # The methods that read, and so can safely be hedged.
+    READ_METHODS = ("get", "get_slice", "get_count", "multiget", "multiget_slice")
+
+    # The latency of reads is measured over windows of HEDGE_WINDOW seconds.
+    # Reads are only hedged once there have been at least HEDGE_MIN_READS in a
+    # window, so that we know what a slow read is.
+    HEDGE_WINDOW = 10
+    HEDGE_MIN_READS = 100
+
+    def __init__(self, keyspace, size=None, client_class=CassandraClient):
+        self.keyspace = keyspace
+        self.breaker = get_breaker(keyspace)
+        self.size = size or settings.CASS_CONNECTIONS
+        self.client_class = client_class
+
+        host = settings.CASS_HOST.strip()
+
+        # Ensure that the host isn't blank
+        if host == '':
+            host = 'localhost'
+
+        self.seeds = self.resolve(host, settings.CASS_PORT)
+
+        self.connections = []
+        for index in range(self.size):
+            address = self.seeds[index % len(self.seeds)]
+            _log.debug("Cassandra is connecting to %s - for host %s",
+                       address, host)
+            self.connect(address)
+
+        # Where the next search for the least loaded connection starts.
+        self._next = 0
+
+        # Latencies (in microseconds) of reads in the current and previous
+        # windows.
+        self.read_latencies = LatencyHistogram()
+        self.previous_read_latencies = LatencyHistogram()
+        self.window_start = monotonic()
+
+        # The ring of the keyspace, once we've read it.
+        self.ring = None
+        self._refresher = task.LoopingCall(self.refresh_ring)
+        if settings.CASS_RING_REFRESH_INTERVAL:
+            reactor.callWhenRunning(self._refresher.start,
+                                    settings.CASS_RING_REFRESH_INTERVAL)
+
+    @staticmethod
+    def resolve(host, port):
+        """Returns the distinct addresses that the host resolves to, in a
+        random order.  We return the addresses (rather than the host), as
+        twisted doesn't resolve IPv6 addresses itself."""
+        # addresses is a list of 5 tuple:
+        # (family, socktype, proto, cannonname, sockaddr)
+        # where sockaddr starts with the address.
+        addresses = list(set(sockaddr[0] for (_, _, _, _, sockaddr)
+                             in socket.getaddrinfo(host, port)))
+        shuffle(addresses)
+        return addresses
+
+    def connect(self, address, discovered=False):
+        factory = ManagedCassandraClientFactory(self.keyspace)
+        reactor.connectTCP(address, settings.CASS_PORT, factory)
+        self.connections.append(PooledConnection(address,
+                                                 factory,
+                                                 self.client_class(factory),
+                                                 discovered))
+
+    @property
+    def factories(self):
+        return [connection.factory for connection in self.connections]
+
+    @defer.inlineCallbacks
+    def refresh_ring(self):
+        """Reads the ring of the keyspace, and connects to (or disconnects
+        from) the nodes that have joined (or left) it"""
+        try:
+            token_ranges = yield self.call("describe_ring", self.keyspace)
+            partitioner = yield self.call("describe_partitioner")
+        except Exception as e:
+            # Carry on with the ring we know about.
+            _log.warning("Failed to read the Cassandra ring for %s: %s",
+                         self.keyspace, e)
+            return
+
+        # Only use the nodes in the datacenters of the nodes we were
+        # configured with.  If we can't tell which they are (e.g. because we
+        # connect to localhost), then we only use the ring for routing
+        # requests amongst the connections we already have, unless there is
+        # just one datacenter.
+        datacenters = TokenRing.datacenters(token_ranges, self.seeds)
+        self.ring = TokenRing(token_ranges, partitioner, datacenters or None)
+        if not datacenters and len(TokenRing.datacenters(token_ranges, self.ring.nodes)) > 1:
+            return
+
+        nodes = self.ring.nodes
+        for connection in list(self.connections):
+            if connection.discovered and connection.address not in nodes:
+                _log.info("Cassandra node %s has left the ring", connection.address)
+                self.connections.remove(connection)
+                connection.factory.shutdown()
+
+        per_node = max(1, self.size // max(len(nodes), 1))
+        for node in nodes:
+            existing = len([connection for connection in self.connections
+                            if connection.address == node])
+            if existing == 0:
+                _log.info("Discovered Cassandra node %s", node)
+            for _ in range(per_node - existing):
+                self.connect(node, discovered=True)
+
+    def replicas_for(self, method, args, kwargs):
+        """Returns the nodes that own the row that a request is for, or None
+        if it isn't for a single row (or we don't know who owns it)"""
+        if self.ring is None:
+            return None
+
+        if method in self.ROW_METHODS:
+            key = kwargs.get("key", args[0] if args else None)
+        elif method == "batch_mutate":
+            mutationmap = kwargs.get("mutationmap", args[0] if args else None)
+            if not mutationmap or len(mutationmap) != 1:
+                return None
+            key = mutationmap.keys()[0]
+        else:
+            return None
+
+        return self.ring.replicas_for(key) if key is not None else None
+
+    def least_loaded(self, addresses=None, exclude=None):
+        """Returns the connection with the fewest outstanding requests (out of
+        those to the given addresses, if there are any), or None if there are
+        none other than the excluded one.  Ties are broken in turn, so that
+        requests are spread evenly over idle connections."""
+        connections = [connection for connection in self.connections
+                       if connection is not exclude]
+        candidates = connections
+        if addresses:
+            candidates = ([connection for connection in connections
+                           if connection.address in addresses] or
+                          connections)
+
+        if not candidates:
+            return None
+
+        num_candidates = len(candidates)
+        start = self._next % num_candidates
+        self._next = (self._next + 1) % len(self.connections)
+        return min((candidates[(start + offset) % num_candidates]
+                    for offset in range(num_candidates)),
+                   key=lambda connection: connection.outstanding)
+
+    def rotate_windows(self):
+        """Starts a new window of read latencies, if the current one is over.
+        If there were no reads in the last window, the history is forgotten."""
+        now = monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= self.HEDGE_WINDOW:
+            if elapsed < 2 * self.HEDGE_WINDOW:
+                self.previous_read_latencies = self.read_latencies
+            else:
+                self.previous_read_latencies = LatencyHistogram()
+            self.read_latencies = LatencyHistogram()
+            self.window_start = now
+
+    def record_read_latency(self, latency):
+        self.rotate_windows()
+        self.read_latencies.record(latency * 1000000)
+
+    def hedge_delay(self):
+        """Returns how long to wait for a read before hedging it, or None if
+        reads shouldn't be hedged"""
+        if not settings.CASS_HEDGE_PERCENTILE or len(self.connections) < 2:
+            return None
+
+        self.rotate_windows()
+        for latencies in (self.previous_read_latencies, self.read_latencies):
+            if latencies.count >= self.HEDGE_MIN_READS:
+                return latencies.percentile(settings.CASS_HEDGE_PERCENTILE) / 1000000.0
+        return None
+
+    def send(self, connection, method, args, kwargs):
+        """Makes a request on a connection"""
+        connection.outstanding += 1
+        start = monotonic()
+
+        def complete(result):
+            connection.outstanding -= 1
+            if method in self.READ_METHODS:
+                self.record_read_latency(monotonic() - start)
+            return result
+
+        d = defer.maybeDeferred(getattr(connection.client, method), *args, **kwargs)
+        d.addBoth(complete)
+        return d
+
+    def hedged_send(self, connection, replicas, delay, method, args, kwargs):
+        """Makes a read on a connection, and sends it again on another one if
+        it hasn't completed after the delay.  Returns a Deferred that fires
+        with the first response, whether that is a result or an error (such
+        as NotFoundException)."""
+        result = defer.Deferred()
+
+        def on_response(response):
+            if timer.active():
+                timer.cancel()
+            if not result.called:
+                result.callback(response)
+
+        def hedge():
+            hedge_connection = self.least_loaded(replicas, exclude=connection)
+            _log.debug("Hedging %s after %.3fs on %s",
+                       method, delay, hedge_connection.address)
+            hedged_reads_counter.increment()
+            self.send(hedge_connection, method, args, kwargs).addBoth(on_response)
+
+        timer = reactor.callLater(delay, hedge)
+        self.send(connection, method, args, kwargs).addBoth(on_response)
+        return result
+
+    def call(self, method, *args, **kwargs):
+        """Calls a CassandraClient method on the least loaded connection (to
+        one of the replicas of the row, if it is for a single row)"""
+        quorum = kwargs.get("consistency") == ConsistencyLevel.LOCAL_QUORUM
+        if quorum and not self.breaker.allow_quorum():
+            return defer.fail(UnavailableException())
+
+        start = monotonic()
+
+        def record_latency(result):
+            request_latency_accumulator.accumulate("%s %s" % (self.keyspace, method),
+                                                   (monotonic() - start) * 1000000)
+            return result
+
+        replicas = self.replicas_for(method, args, kwargs)
+        connection = self.least_loaded(replicas)
+
+        delay = self.hedge_delay() if method in self.READ_METHODS else None
+        if delay is not None:
+            d = self.hedged_send(connection, replicas, delay, method, args, kwargs)
+        else:
+            d = self.send(connection, method, args, kwargs)
+
+        if quorum:
+            d.addBoth(self.breaker.record_result)
+        d.addBoth(record_latency)
+        return d
+
+    def with_timeout(self, d, timeout):
+        """Returns a Deferred that fires with the result of `d`, or fails with
+        TimedOutException (as if Cassandra had timed the request out, so that
+        handlers treat it the same way) if `d` hasn't fired after `timeout`
+        seconds.  The request isn't cancelled, so it still counts towards its
+        connection's outstanding requests until it completes."""
+        result = defer.Deferred()
+
+        def on_timeout():
+            timed_out_counter.increment()
+            _log.debug("No response from Cassandra after %ss", timeout)
+            result.errback(TimedOutException())
+
+        def on_response(response):
+            # Drop responses that arrive after the timeout.
+            if timer.active():
+                timer.cancel()
+                result.callback(response)
+
+        timer = reactor.callLater(timeout, on_timeout)
+        d.addBoth(on_response)
+        return result
+
+    @defer.inlineCallbacks
+    def attempt(self, method, args, kwargs):
+        """Makes a request, timing it out after CASS_REQUEST_TIMEOUT seconds
+        (if set).  Reads that time out (here or in Cassandra) are retried (on
+        the least loaded connection, which won't be the one the read is stuck
+        on) up to CASS_READ_RETRIES times."""
+        retries = settings.CASS_READ_RETRIES if method in self.READ_METHODS else 0
+        while True:
+            d = self.call(method, *args, **kwargs)
+            if settings.CASS_REQUEST_TIMEOUT:
+                d = self.with_timeout(d, settings.CASS_REQUEST_TIMEOUT)
+
+            try:
+                result = yield d
+                defer.returnValue(result)
+            except TimedOutException:
+                if retries == 0:
+                    raise
+                retries -= 1
+                _log.warning("Cassandra %s request to %s timed out, retrying", method, self.keyspace)
+
+    @defer.inlineCallbacks
+    def ha(self, method, *args, **kwargs):
+        """Makes a request at consistency LOCAL_QUORUM, and retries it at ONE
+        if LOCAL_QUORUM is unavailable.
+
+        After growing a cluster, Cassandra does not pro-actively populate the
+        new nodes with their data (the nodes are expected to use `nodetool
+        repair` if they need to get their data), so we read at LOCAL_QUORUM
+        where we can."""
+        try:
+            kwargs['consistency'] = ConsistencyLevel.LOCAL_QUORUM
+            result = yield self.attempt(method, args, kwargs)
+        except UnavailableException:
+            kwargs['consistency'] = ConsistencyLevel.ONE
+            result = yield self.attempt(method, args, kwargs)
+        defer.returnValue(result)
+
+    def ha_get(self, *args, **kwargs):
+        return self.ha("get", *args, **kwargs)
+
+    def ha_get_slice(self, *args, **kwargs):
+        return self.ha("get_slice", *args, **kwargs)
+
+    @defer.inlineCallbacks
+    def ha_multiget_slice(self, keys, *args, **kwargs):
+        """Reads a set of rows using multiget_slice, in parallel batches of at
+        most settings.MULTIGET_BATCH_SIZE rows (with at most
+        settings.MAX_CONCURRENT_READS batches outstanding at once).  Returns
+        the combined results."""
+        def get_batch(batch_keys):
+            return self.ha("multiget_slice", batch_keys, *args, **kwargs)
+
+        keys = list(keys)
+        batches = [keys[i:i + settings.MULTIGET_BATCH_SIZE]
+                   for i in range(0, len(keys), settings.MULTIGET_BATCH_SIZE)]
+        results = yield utils.map_concurrently(get_batch,
+                                               batches,
+                                               settings.MAX_CONCURRENT_READS)
+        rows = {}
+        for result in results:
+            rows.update(result)
+        defer.returnValue(rows)
+
+    def ha_get_range_slices(self, *args, **kwargs):
+        return self.ha("get_range_slices", *args, **kwargs)
+
+    def ha_insert(self, *args, **kwargs):
+        return self.ha("insert", *args, **kwargs)
+
+    def ha_batch_insert(self, *args, **kwargs):
+        return self.ha("batch_insert", *args, **kwargs)
+
+    def ha_batch_mutate(self, *args, **kwargs):
+        return self.ha("batch_mutate", *args, **kwargs)
+
+    def ha_remove(self, *args, **kwargs):
+        return self.ha("remove", *args, **kwargs)
+
+    def __getattr__(self, name):
+        # Any other (public) attribute is a CassandraClient method.
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
@@ -0,0 +1,102 @@
+# @file cassandraring.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import hashlib
+from bisect import bisect_left
+
+from metaswitch.crest.api import murmur3
+
+
+def random_token(key):
+    """Returns the token of a row key under the RandomPartitioner: the
+    absolute value of the MD5 of the key, as a signed 128-bit integer"""
+    token = int(hashlib.md5(key).hexdigest(), 16)
+    if token >= 1 << 127:
+        token -= 1 << 128
+    return abs(token)
+
+
+# The token functions of the partitioners that we can route requests for.
+PARTITIONERS = {"org.apache.cassandra.dht.Murmur3Partitioner": murmur3.token,
+                "org.apache.cassandra.dht.RandomPartitioner": random_token}
+
+
+def _endpoint_details(token_range):
+    # Older versions of Cassandra don't report endpoint details (or rpc
+    # endpoints).
+    return getattr(token_range, "endpoint_details", None) or []
+
+
+def _rpc_addresses(token_range):
+    # Nodes whose rpc_address is the wildcard address report that, so fall
+    # back to their listen addresses.
+    rpc_endpoints = getattr(token_range, "rpc_endpoints", None) or []
+    if not rpc_endpoints or any(address in ("0.0.0.0", "::") for address in rpc_endpoints):
+        return list(token_range.endpoints)
+    return list(rpc_endpoints)
+
+
+class TokenRing(object):
+    """
+    The token ranges of a keyspace (as returned by describe_ring), and the
+    replicas that own each of them.
+    """
+
+    def __init__(self, token_ranges, partitioner, datacenters=None):
+        """Builds the ring from a list of TokenRanges.  If datacenters is
+        given, only the replicas in those datacenters are used."""
+        self.token_function = PARTITIONERS.get(partitioner)
+
+        ranges = []
+        for token_range in token_ranges:
+            replicas = _rpc_addresses(token_range)
+            if datacenters is not None and _endpoint_details(token_range):
+                local = set(details.host for details in _endpoint_details(token_range)
+                            if details.datacenter in datacenters)
+                replicas = [rpc_address
+                            for (endpoint, rpc_address) in zip(token_range.endpoints, replicas)
+                            if endpoint in local]
+            ranges.append((int(token_range.end_token), replicas))
+        ranges.sort()
+
+        self.end_tokens = [end_token for (end_token, _) in ranges]
+        self.replicas = [owners for (_, owners) in ranges]
+
+    @staticmethod
+    def datacenters(token_ranges, addresses):
+        """Returns the datacenters of the nodes with the given addresses"""
+        datacenters = set()
+        for token_range in token_ranges:
+            hosts = dict(zip(token_range.endpoints, _rpc_addresses(token_range)))
+            for details in _endpoint_details(token_range):
+                if details.host in addresses or hosts.get(details.host) in addresses:
+                    datacenters.add(details.datacenter)
+        return datacenters
+
+    @property
+    def nodes(self):
+        """All the (rpc addresses of the) nodes that own part of the ring"""
+        return set(address for replicas in self.replicas for address in replicas)
+
+    def replicas_for(self, key):
+        """Returns the nodes that own the row key, or None if we don't know"""
+        if self.token_function is None or not self.end_tokens:
+            return None
+
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        token = self.token_function(str(key))
+
+        # Each range runs from (but not including) the end token of the
+        # previous range, up to and including its own end token.  The first
+        # range also wraps round to cover the tokens after the last range.
+        index = bisect_left(self.end_tokens, token)
+        if index == len(self.end_tokens):
+            index = 0
+        return self.replicas[index]
@@ -0,0 +1,101 @@
+# @file histogram.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# The percentiles that are published for a histogram.
+PERCENTILES = [50, 90, 99]
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies (in microseconds), used to work out percentiles.
+
+    The buckets are log-linear: each power of two is split into SUB_BUCKETS
+    equal buckets, so the error in a percentile is at most 1/SUB_BUCKETS of
+    its value.  Latencies of 2^MAX_EXPONENT us (about a minute) or more all
+    go in the last bucket.
+    """
+    SUB_BUCKETS = 16
+    SUB_BUCKET_BITS = 4
+    MAX_EXPONENT = 26
+
+    NUM_BUCKETS = SUB_BUCKETS * (MAX_EXPONENT - SUB_BUCKET_BITS + 1)
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+
+    @classmethod
+    def bucket_index(cls, value):
+        value = max(int(value), 0)
+        if value < cls.SUB_BUCKETS:
+            return value
+
+        exponent = value.bit_length() - 1
+        shift = exponent - cls.SUB_BUCKET_BITS
+        index = (cls.SUB_BUCKETS * (shift + 1) +
+                 (value >> shift) - cls.SUB_BUCKETS)
+        return min(index, cls.NUM_BUCKETS - 1)
+
+    @classmethod
+    def bucket_limit(cls, index):
+        """Returns the upper limit of the values in a bucket"""
+        if index < cls.SUB_BUCKETS:
+            return index + 1
+
+        shift = (index // cls.SUB_BUCKETS) - 1
+        sub_bucket = index % cls.SUB_BUCKETS
+        return (cls.SUB_BUCKETS + sub_bucket + 1) << shift
+
+    def record(self, value):
+        self.buckets[self.bucket_index(value)] += 1
+        self.count += 1
+
+    def sparse(self):
+        """Returns the (index, count) of each bucket with values in it - a
+        compact form of the histogram to send to other processes"""
+        return [(index, count)
+                for index, count in enumerate(self.buckets)
+                if count > 0]
+
+    @classmethod
+    def from_sparse(cls, buckets):
+        """Creates a histogram from the result of sparse().  Raises
+        ValueError if any of the buckets is invalid (as it may have been
+        received from another process)."""
+        histogram = cls()
+        for index, count in buckets:
+            if not (0 <= index < cls.NUM_BUCKETS) or count < 0:
+                raise ValueError("Invalid bucket: %s, %s" % (index, count))
+            histogram.buckets[index] += count
+            histogram.count += count
+        return histogram
+
+    def merge(self, other):
+        """Adds the values recorded in another histogram to this one"""
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.count += other.count
+
+    def percentile(self, percent):
+        """Returns (the upper limit of) the given percentile of the values
+        recorded, or 0 if there aren't any"""
+        if self.count == 0:
+            return 0
+
+        # The rank of the value we want, counting from 1.
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return self.bucket_limit(index)
+
+    def reset(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
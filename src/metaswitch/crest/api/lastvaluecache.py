@@ -9,24 +9,116 @@
 
 import logging
 import zmq
-from twisted.internet import defer, threads
+from monotonic import monotonic
+from zope.interface import implementer
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReadDescriptor
+
+from metaswitch.crest.api.histogram import LatencyHistogram, PERCENTILES
 
 _log = logging.getLogger("crest.api")
 VALID_STATS = [
     "P_latency_us",
+    "P_latency_percentiles_us",
     "P_queue_size",
     "P_incoming_requests",
     "P_rejected_overload",
+    "P_row_cache_hits",
+    "P_row_cache_misses",
+    "P_row_cache_evictions",
+    "P_endpoint_latency_us",
+    "P_endpoint_rejected_overload",
+    "P_load_monitors",
+    "P_cassandra_hedged_reads",
+    "P_cassandra_quorum_breakers",
+    "P_cassandra_timeouts",
+    "P_cassandra_latency_us",
 ]
 
+# Each process reports the load on each of its load monitors under this topic
+# (followed by its service's process name and its process ID).  The parent
+# process forwards the reports for its own service to all the processes on
+# its load state address, rather than publishing them with the stats.  The
+# stats socket is shared by all the services on the node, so both the topic
+# and the address are per service, so that services don't share their load.
+LOAD_STATE_TOPIC = "crest_load_state"
+
+# Each process publishes the histograms behind some of its stats under these
+# names (followed by its process ID).  The parent process merges the most
+# recent histogram from each process (as long as it's no more than
+# SKETCH_TIMEOUT seconds old), and publishes the count and percentiles for the
+# whole node under the corresponding name.
+MERGED_STATS = {
+    "P_latency_sketch_us": "P_node_latency_percentiles_us",
+}
+SKETCH_TIMEOUT = 10
+
+
+@implementer(IReadDescriptor)
+class SocketReader(object):
+    """
+    Reads messages from a ZMQ socket as they arrive, from the reactor thread,
+    and passes them to callback.
+
+    The reactor watches the socket's file descriptor (zmq.FD).  This only
+    signals that the socket's events (zmq.EVENTS) may have changed, and only
+    when they do change - so every message waiting must be read, and the
+    socket must be checked again (with check) after sending on it.
+    """
+
+    def __init__(self, socket, callback):
+        self.socket = socket
+        self.callback = callback
+
+    def start(self):
+        reactor.addReader(self)
+
+        # Messages may have arrived before we started watching.
+        self.check()
+
+    def stop(self):
+        reactor.removeReader(self)
+        self.socket = None
+
+    def check(self):
+        """Checks for messages after the socket's events may have changed
+        without being signalled"""
+        reactor.callLater(0, self.doRead)
+
+    def fileno(self):
+        return self.socket.getsockopt(zmq.FD)
+
+    def doRead(self):
+        while (self.socket is not None and
+               self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN):
+            try:
+                msg = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.callback(msg)
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return "zmq"
+
 
 class LastValueCache:
     def __init__(self, process_name):
         # Set up the cache.
         self.cache = {}
+        self.readers = []
+
+        # Maps the name of each merged stat to the time and histogram of the
+        # last report from each process.
+        self.sketches = {}
         self.zmq_address = "ipc:///var/run/clearwater/stats/" + process_name
+        self.load_state_address = "ipc:///tmp/crest_load_" + process_name
+        self.load_state_topic = LOAD_STATE_TOPIC + "_" + process_name + "_"
 
     def bind(self, p_id, worker_proc):
+        self.p_id = p_id
         self.context = zmq.Context()
 
         # Connect to the ipc file where all stats are published.
@@ -38,9 +130,14 @@ class LastValueCache:
             self.subscriber = self.context.socket(zmq.SUB)
             self.subscriber.bind("ipc:///tmp/stats0")
             for process_id in range (0, worker_proc):
-                for stat in VALID_STATS:
+                for stat in VALID_STATS + MERGED_STATS.keys():
                     self.subscriber.setsockopt(zmq.SUBSCRIBE,
                                                stat + "_" + str(process_id))
+            self.subscriber.setsockopt(zmq.SUBSCRIBE, self.load_state_topic)
+
+            # Set up a socket to forward load reports to all the processes.
+            self.load_broadcaster = self.context.socket(zmq.PUB)
+            self.load_broadcaster.bind(self.load_state_address)
 
             # Set up a tcp connection to publish all stats, including
             # repeat subscriptions. If the bind fails, log this and carry on.
@@ -51,63 +148,142 @@ class LastValueCache:
             except zmq.error.ZMQError as e:
                 _log.debug("The broadcaster bind failed; no statistics will be published: " + str(e))
 
-            # Set up a poller to listen for new stats published to the
-            # ipc file and for new external subscriptions
-            self.poller = zmq.Poller()
-            self.poller.register(self.subscriber, zmq.POLLIN)
-            self.poller.register(self.broadcaster, zmq.POLLIN)
-
             self.forward()
 
     def unbind(self):
+        for reader in self.readers:
+            reader.stop()
+        self.readers = []
+
         self.context.destroy()
         self.context = None
         self.publisher = None
         self.subscriber = None
         self.broadcaster = None
-        self.poller = None
+        self.load_broadcaster = None
+        self.load_subscriber = None
 
-    @defer.inlineCallbacks
-    def last_cache(self):
-        # Poll
-        d = threads.deferToThread(self.poller.poll)
-        answer = yield d
-        defer.returnValue(answer)
+    def read(self, socket, callback):
+        """Calls callback with each message received on the socket, and
+        returns the SocketReader that reads them"""
+        reader = SocketReader(socket, callback)
+        self.readers.append(reader)
+        reader.start()
+        return reader
 
-    @defer.inlineCallbacks
     def forward(self):
-        # Continually poll for updates
-        while True:
-            # Poll returns a dictionary of sockets
-            answer = yield self.last_cache()
-
-            if self.subscriber in dict(answer):
-                # A stat has been updated in the ipc file. Update
-                # the cache, and publish the new stat. The stat will
-                # be of the form [stat_name, "OK", values...]
-                msg = yield self.subscriber.recv_multipart()
-                self.cache[msg[0]] = msg
-                self.broadcaster.send_multipart(msg)
-            if self.broadcaster in dict(answer):
-                # A new subscription for a stat has occurred. Immediately
-                # send the value stored in the cache (if it exists)
-                event = yield self.broadcaster.recv()
-
-                # The first element is whether this is a subscripion (1)
-                # or to unsubscriber (0)
-                if event[0] == b'\x01':
-                    topic = event[1:]
-                    if topic in self.cache:
-                        self.broadcaster.send_multipart(self.cache[topic])
-                    else:
-                        # No cached value - return empty statistic.
-                        self.broadcaster.send_multipart([topic, "OK"])
+        # Listen for new stats published to the ipc file and for new external
+        # subscriptions.  These are read by the reactor as they arrive, rather
+        # than by polling.
+        self.read(self.subscriber, self.on_stat)
+        self.broadcaster_reader = self.read(self.broadcaster, self.on_subscription)
+
+    def on_stat(self, msg):
+        # A stat has been updated in the ipc file. Update the cache, and
+        # publish the new stat. The stat will be of the form
+        # [stat_name, "OK", values...]
+        if msg[0].startswith(LOAD_STATE_TOPIC):
+            # Only forward our own service's reports.
+            if msg[0].startswith(self.load_state_topic):
+                self.load_broadcaster.send_multipart(msg)
+        elif msg[0].rsplit("_", 1)[0] in MERGED_STATS:
+            self.merge_sketch(msg)
+        else:
+            self.cache[msg[0]] = msg
+            self.send(msg)
+
+    def merge_sketch(self, msg):
+        # The histogram is of the form
+        # [stat_name_<process ID>, "OK", index, count, index, count...]
+        try:
+            name, p_id = msg[0].rsplit("_", 1)
+            values = [int(value) for value in msg[2:]]
+            if len(values) % 2 != 0:
+                raise ValueError("Odd number of values")
+            histogram = LatencyHistogram.from_sparse(zip(values[::2], values[1::2]))
+        except (ValueError, IndexError):
+            _log.warning("Ignoring invalid histogram: %s", msg)
+            return
+
+        now = monotonic()
+        sketches = self.sketches.setdefault(name, {})
+        sketches[p_id] = (now, histogram)
+
+        merged = LatencyHistogram()
+        for p_id, (time, histogram) in sketches.items():
+            if now - time > SKETCH_TIMEOUT:
+                del sketches[p_id]
+            else:
+                merged.merge(histogram)
+
+        self.on_stat([MERGED_STATS[name], "OK", str(merged.count)] +
+                     [str(merged.percentile(p)) for p in PERCENTILES])
+
+    def on_subscription(self, msg):
+        # A new subscription for a stat has occurred. Immediately send the
+        # value stored in the cache (if it exists)
+        event = msg[0]
+
+        # The first element is whether this is a subscripion (1)
+        # or to unsubscriber (0)
+        if event[0] == b'\x01':
+            topic = event[1:]
+            if topic in self.cache:
+                self.send(self.cache[topic])
+            else:
+                # No cached value - return empty statistic.
+                self.send([topic, "OK"])
+
+    def send(self, msg):
+        self.broadcaster.send_multipart(msg)
+
+        # Sending can change the broadcaster's events, in which case
+        # subscriptions that have arrived won't be signalled.
+        self.broadcaster_reader.check()
 
     def report(self, new_value, stat_name):
         # Publish the updated stat to the ipc file
         self.publisher.send(stat_name, zmq.SNDMORE)
+
+        # A stat may have no values (e.g. a table with no rows).
+        if not new_value:
+            self.publisher.send("OK")
+            return
         self.publisher.send("OK", zmq.SNDMORE)
 
         for index in range(len(new_value) - 1):
             self.publisher.send(str(new_value[index]), zmq.SNDMORE)
         self.publisher.send(str(new_value[-1]))
+
+    def report_load_state(self, name, latency, requests, hss_overloads):
+        """Reports the load on one of this process's load monitors to the
+        other processes"""
+        self.report([name or "", latency, requests, hss_overloads],
+                    self.load_state_topic + str(self.p_id))
+
+    def listen_for_load_state(self, callback):
+        """Listens for the load reported by the other processes, calling
+        callback(process ID, load monitor name, latency, requests accepted,
+        HSS overloads) for each report"""
+        self.load_subscriber = self.context.socket(zmq.SUB)
+        self.load_subscriber.connect(self.load_state_address)
+        self.load_subscriber.setsockopt(zmq.SUBSCRIBE, self.load_state_topic)
+
+        def on_load_state(msg):
+            # The message is of the form
+            # [topic_<process name>_<process ID>, "OK", name, latency,
+            #  requests, HSS overloads]
+            if not msg[0].startswith(self.load_state_topic):
+                return
+            try:
+                p_id = int(msg[0][len(self.load_state_topic):])
+                if p_id != self.p_id:
+                    callback(p_id,
+                             msg[2] or None,
+                             float(msg[3]),
+                             int(msg[4]),
+                             int(msg[5]))
+            except (ValueError, IndexError):
+                _log.warning("Ignoring invalid load report: %s", msg)
+
+        self.read(self.load_subscriber, on_load_state)
@@ -0,0 +1,105 @@
+# @file metrics.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import re
+import cyclone.web
+
+from metaswitch.crest import settings
+from metaswitch.crest.api import base, statistics
+from metaswitch.crest.api.lastvaluecache import MERGED_STATS
+from metaswitch.crest.api.tracing import TracesHandler
+
+
+def metric_name(stat_name, field):
+    """Returns the Prometheus metric name for one of the values of a stat,
+    e.g. homestead_prov_latency_us_mean"""
+    if stat_name.startswith("P_"):
+        stat_name = stat_name[2:]
+    name = "%s_%s_%s" % (settings.PROCESS_NAME, stat_name, field)
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, value.replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in sorted(labels.items()))
+
+
+def _parse(stat_name, fields, labelled, labels, values):
+    """Returns (metric name, labels, value) for each of the published values
+    of a stat"""
+    samples = []
+    width = len(fields) + 1 if labelled else len(fields)
+    for row_start in range(0, len(values) - width + 1, width):
+        row = values[row_start:row_start + width]
+        row_labels = dict(labels)
+        if labelled:
+            row_labels["label"] = row.pop(0)
+
+        for field, value in zip(fields, row):
+            try:
+                samples.append((metric_name(stat_name, field), row_labels, float(value)))
+            except ValueError:
+                pass
+    return samples
+
+
+def render_metrics(cache, collectors):
+    """
+    Renders the stats in the cache of the parent process's LastValueCache in
+    the Prometheus text format.  Each registered collector's stat is rendered
+    for every process that has published it (with a "process" label), and
+    stats that the parent merges for the whole node are rendered without one.
+    """
+    samples = []
+    for collector in collectors:
+        prefix = collector.base_name + "_"
+        for topic, msg in sorted(cache.items()):
+            process = topic[len(prefix):]
+            if topic.startswith(prefix) and process.isdigit():
+                samples.extend(_parse(collector.base_name,
+                                      collector.FIELDS,
+                                      collector.labelled,
+                                      {"process": process},
+                                      msg[2:]))
+
+    for stat_name in sorted(MERGED_STATS.values()):
+        if stat_name in cache:
+            samples.extend(_parse(stat_name,
+                                  statistics.PercentileAccumulator.FIELDS,
+                                  False,
+                                  {},
+                                  cache[stat_name][2:]))
+
+    lines = []
+    last_name = None
+    for (name, labels, value) in sorted(samples, key=lambda sample: sample[0]):
+        if name != last_name:
+            metric_type = "counter" if name.endswith("_total") else "gauge"
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            last_name = name
+        lines.append("%s%s %r" % (name, _format_labels(labels), value))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(cyclone.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(render_metrics(base.zmq.cache, statistics.collectors))
+
+
+def create_application():
+    """Returns the application that the parent process serves on
+    METRICS_INTERFACE (localhost by default).  As well as the metrics, this
+    serves the recent request traces, which include subscribers' identities
+    so mustn't be served on the main API."""
+    return cyclone.web.Application([(r"/metrics", MetricsHandler),
+                                    (r"/debug/traces/?", TracesHandler)])
@@ -0,0 +1,106 @@
+# @file murmur3.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""
+Cassandra's Murmur3Partitioner, so that we can work out the token of a row
+key ourselves.
+"""
+
+import struct
+
+MIN_TOKEN = -2**63
+MAX_TOKEN = 2**63 - 1
+
+_MASK = 2**64 - 1
+_C1 = 0x87c37b91114253d5
+_C2 = 0x4cf5ad432745937f
+
+
+def _rotl(x, r):
+    return ((x << r) | (x >> (64 - r))) & _MASK
+
+
+def _fmix(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & _MASK
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & _MASK
+    k ^= k >> 33
+    return k
+
+
+def _signed_byte(b):
+    # Cassandra's implementation sign-extends the bytes in the tail of the
+    # key, so we must too.
+    b = ord(b)
+    return (b - 256 if b > 127 else b) & _MASK
+
+
+def token(key):
+    """Returns the token (a signed 64-bit integer) of a row key (a string)"""
+    length = len(key)
+    nblocks = length // 16
+
+    h1 = h2 = 0
+
+    for i in range(nblocks):
+        (k1, k2) = struct.unpack_from("<QQ", key, i * 16)
+
+        k1 = (k1 * _C1) & _MASK
+        k1 = _rotl(k1, 31)
+        k1 = (k1 * _C2) & _MASK
+        h1 ^= k1
+
+        h1 = _rotl(h1, 27)
+        h1 = (h1 + h2) & _MASK
+        h1 = (h1 * 5 + 0x52dce729) & _MASK
+
+        k2 = (k2 * _C2) & _MASK
+        k2 = _rotl(k2, 33)
+        k2 = (k2 * _C1) & _MASK
+        h2 ^= k2
+
+        h2 = _rotl(h2, 31)
+        h2 = (h2 + h1) & _MASK
+        h2 = (h2 * 5 + 0x38495ab5) & _MASK
+
+    tail = key[nblocks * 16:]
+    k1 = k2 = 0
+
+    for i in range(len(tail) - 1, 7, -1):
+        k2 ^= (_signed_byte(tail[i]) << ((i - 8) * 8)) & _MASK
+    if len(tail) > 8:
+        k2 = (k2 * _C2) & _MASK
+        k2 = _rotl(k2, 33)
+        k2 = (k2 * _C1) & _MASK
+        h2 ^= k2
+
+    for i in range(min(len(tail), 8) - 1, -1, -1):
+        k1 ^= (_signed_byte(tail[i]) << (i * 8)) & _MASK
+    if len(tail) > 0:
+        k1 = (k1 * _C1) & _MASK
+        k1 = _rotl(k1, 31)
+        k1 = (k1 * _C2) & _MASK
+        h1 ^= k1
+
+    h1 ^= length
+    h2 ^= length
+
+    h1 = (h1 + h2) & _MASK
+    h2 = (h2 + h1) & _MASK
+
+    h1 = _fmix(h1)
+    h2 = _fmix(h2)
+
+    h1 = (h1 + h2) & _MASK
+
+    # Convert to a signed value.  The partitioner never uses the minimum
+    # token for a key.
+    result = h1 - 2**64 if h1 > MAX_TOKEN else h1
+    return MAX_TOKEN if result == MIN_TOKEN else result
@@ -12,8 +12,7 @@ import logging
 import httplib
 
 from cyclone.web import HTTPError
-from telephus.client import CassandraClient
-from telephus.cassandra.ttypes import NotFoundException, UnavailableException, ConsistencyLevel
+from telephus.cassandra.ttypes import NotFoundException
 from twisted.internet import defer
 
 from metaswitch.crest.api.base import BaseHandler
@@ -31,11 +30,12 @@ class PassthroughHandler(BaseHandler):
     database
     """
 
-    cass_factories = {}
+    cass_clients = {}
 
     @classmethod
-    def add_cass_factory(cls, factory_name, factory):
-        cls.cass_factories[factory_name] = factory
+    def add_cass_client(cls, factory_name, client):
+        """Adds the CassandraPool to use for the named keyspace"""
+        cls.cass_clients[factory_name] = client
 
     def initialize(self, factory_name, table, column):
         """
@@ -46,7 +46,7 @@ class PassthroughHandler(BaseHandler):
         """
         self.table = table
         self.column = column
-        self.cass = CassandraClient(self.cass_factories[factory_name])
+        self.cass = self.cass_clients[factory_name]
 
     @defer.inlineCallbacks
     def get(self, row):
@@ -71,34 +71,8 @@ class PassthroughHandler(BaseHandler):
         self.set_status(httplib.NO_CONTENT)
         self.finish()
 
-    # After growing a cluster, Cassandra does not pro-actively populate the
-    # new nodes with their data (the nodes are expected to use `nodetool
-    # repair` if they need to get their data).
-    #
-    @defer.inlineCallbacks
     def ha_get(self, *args, **kwargs):
-        kwargs['consistency'] = ConsistencyLevel.LOCAL_QUORUM
-        try:
-            result = yield self.cass.get(*args, **kwargs)
-            defer.returnValue(result)
-        except UnavailableException as e:
-            try:
-                kwargs['consistency'] = ConsistencyLevel.ONE
-                result = yield self.cass.get(*args, **kwargs)
-                defer.returnValue(result)
-            except (NotFoundException, UnavailableException) as e:
-                raise e
+        return self.cass.ha_get(*args, **kwargs)
 
-    @defer.inlineCallbacks
     def ha_get_slice(self, *args, **kwargs):
-        kwargs['consistency'] = ConsistencyLevel.LOCAL_QUORUM
-        try:
-            result = yield self.cass.get_slice(*args, **kwargs)
-            defer.returnValue(result)
-        except UnavailableException as e:
-            try:
-                kwargs['consistency'] = ConsistencyLevel.ONE
-                result = yield self.cass.get_slice(*args, **kwargs)
-                defer.returnValue(result)
-            except (NotFoundException, UnavailableException) as e:
-                raise e
+        return self.cass.ha_get_slice(*args, **kwargs)
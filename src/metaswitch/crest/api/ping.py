@@ -9,7 +9,6 @@
 
 import logging
 from cyclone.web import RequestHandler
-from telephus.client import CassandraClient
 from twisted.internet import defer
 
 _log = logging.getLogger("crest.ping")
@@ -17,11 +16,12 @@ _log = logging.getLogger("crest.ping")
 # This class responds to pings - we use it to confirm that Homer/Homestead-prov
 # are still responsive and functional
 class PingHandler(RequestHandler):
-    cass_factories = []
+    cass_clients = []
 
     @classmethod
-    def register_cass_factory(cls, factory):
-        cls.cass_factories.append(factory)
+    def register_cass_client(cls, client):
+        """Registers a client (such as a CassandraPool) to ping through"""
+        cls.cass_clients.append(client)
 
     @defer.inlineCallbacks
     def get(self):
@@ -29,7 +29,6 @@ class PingHandler(RequestHandler):
         # We need this check as we've seen cases where telephus fails to
         # connect to Cassandra, and requests sit on the queue forever without
         # being processed.
-        clients = (CassandraClient(factory) for factory in self.cass_factories)
 
         # If Cassandra is up, it will throw an exception (because we're asking
         # for a nonexistent key). That's fine - it proves Cassandra is up and
@@ -46,7 +45,7 @@ class PingHandler(RequestHandler):
         try:
             _log.debug("Handling ping request")
             gets = (client.get(key='ping', column_family='ping').addErrback(ping_error)
-                    for client in clients)
+                    for client in self.cass_clients)
             yield defer.DeferredList(gets)
         except Exception:
             # We don't care about the result, just whether it returns
@@ -0,0 +1,123 @@
+# @file quorumbreaker.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import logging
+from monotonic import monotonic
+from twisted.python.failure import Failure
+from telephus.cassandra.ttypes import NotFoundException, UnavailableException
+
+from metaswitch.crest import settings
+from metaswitch.crest.api.statistics import Collector
+
+_log = logging.getLogger("crest.api.cassandra")
+
+
+class QuorumBreaker(object):
+    """
+    Circuit breaker for LOCAL_QUORUM requests to a keyspace.
+
+    We make requests at LOCAL_QUORUM, and retry them at ONE if Cassandra says
+    that LOCAL_QUORUM is unavailable.  Once FAILURE_THRESHOLD requests in a row
+    have been unavailable, the breaker opens, and LOCAL_QUORUM requests fail
+    straight away (so are retried at ONE without a wasted round trip) for
+    CASS_QUORUM_COOLDOWN seconds.  After that, one request is let through at
+    LOCAL_QUORUM as a probe: if it succeeds the breaker closes, and otherwise
+    it stays open for another cooldown.
+    """
+
+    FAILURE_THRESHOLD = 3
+
+    def __init__(self, keyspace):
+        self.keyspace = keyspace
+
+        # The number of LOCAL_QUORUM requests in a row that were unavailable.
+        self.failures = 0
+
+        # When the breaker is open, the time that the next probe can be made;
+        # None when it is closed.
+        self.open_until = None
+
+        # The number of LOCAL_QUORUM requests failed without being sent.
+        self.total_skipped = 0
+
+    @property
+    def degraded(self):
+        return self.open_until is not None
+
+    def allow_quorum(self):
+        """Returns whether a LOCAL_QUORUM request should be sent"""
+        if self.open_until is None:
+            return True
+
+        now = monotonic()
+        if now >= self.open_until:
+            # Send this request as a probe.  No other is sent until the
+            # cooldown after this, in case it never completes.
+            self.open_until = now + settings.CASS_QUORUM_COOLDOWN
+            return True
+
+        self.total_skipped += 1
+        return False
+
+    def record_available(self):
+        if self.degraded:
+            _log.info("LOCAL_QUORUM is available again for keyspace %s", self.keyspace)
+        self.failures = 0
+        self.open_until = None
+
+    def record_unavailable(self):
+        self.failures += 1
+        if not self.degraded and self.failures >= self.FAILURE_THRESHOLD:
+            _log.warning("LOCAL_QUORUM is unavailable for keyspace %s, using ONE for %ss",
+                         self.keyspace, settings.CASS_QUORUM_COOLDOWN)
+            self.open_until = monotonic() + settings.CASS_QUORUM_COOLDOWN
+
+    def record_result(self, result):
+        """Callback for the result of a LOCAL_QUORUM request.  Other errors
+        (such as timeouts) don't tell us whether LOCAL_QUORUM is available."""
+        if not isinstance(result, Failure) or result.check(NotFoundException):
+            self.record_available()
+        elif result.check(UnavailableException):
+            self.record_unavailable()
+        return result
+
+
+# The breaker for each keyspace.
+_breakers = {}
+
+def get_breaker(keyspace):
+    if keyspace not in _breakers:
+        _breakers[keyspace] = QuorumBreaker(keyspace)
+    return _breakers[keyspace]
+
+
+class QuorumBreakerCollector(Collector):
+    """
+    Publishes the state of the breaker for each keyspace: whether LOCAL_QUORUM
+    requests are being skipped, and how many have been.
+    """
+
+    FIELDS = ["degraded", "skipped_total"]
+    labelled = True
+
+    def add(self):
+        pass
+
+    def values(self, time_difference):
+        values = []
+        for keyspace, breaker in sorted(_breakers.items()):
+            values.extend([keyspace,
+                           1 if breaker.degraded else 0,
+                           breaker.total_skipped])
+        return values
+
+    def reset(self):
+        self.start_time = monotonic()
+
+quorum_breaker_collector = QuorumBreakerCollector("P_cassandra_quorum_breakers")
@@ -0,0 +1,172 @@
+# @file rowcache.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import logging
+from collections import OrderedDict
+
+from monotonic import monotonic
+from twisted.internet import defer
+
+from metaswitch.crest.api.statistics import Counter
+from metaswitch.crest.api.tracing import NO_TRACE
+
+_log = logging.getLogger("crest.api")
+
+# Statistics for all row caches in this process.
+hits_counter = Counter("P_row_cache_hits")
+misses_counter = Counter("P_row_cache_misses")
+evictions_counter = Counter("P_row_cache_evictions")
+
+
+class RowCache(object):
+    """
+    Least-recently-used, read-through cache of Cassandra rows, local to a
+    single process.
+
+    Entries are keyed by keyspace, table and row key, as well as by the
+    columns that were asked for (as the same row can be read with different
+    predicates).  At most `max_entries` entries are kept, and each expires
+    `ttl` seconds after it is read from Cassandra.  Writes made by this
+    process must call invalidate for the rows they touch; the TTL bounds how
+    long a write made by another process can go unnoticed.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # Maps (keyspace, table, key, predicate) to (expiry time, result),
+        # least recently used first.
+        self._entries = OrderedDict()
+
+        # Maps (keyspace, table, key) to the predicates cached for that row.
+        self._row_predicates = {}
+
+        # Incremented on every invalidation.  A read that was in flight while
+        # a row was invalidated may have returned stale data, so its result
+        # isn't cached.
+        self._epoch = 0
+
+    def read_through(self, keyspace, table, key, predicate, fetch):
+        """
+        Returns a Deferred that fires with the cached result of reading the
+        given row with the given predicate (which must be hashable).  On a
+        miss, `fetch` is called to read the row from Cassandra (it must return
+        a Deferred) and the result is cached.
+        """
+        entry_key = (keyspace, table, key, predicate)
+        entry = self._entries.pop(entry_key, None)
+
+        if entry is not None:
+            (expiry, result) = entry
+            if expiry > monotonic():
+                # Put the entry back as the most recently used.
+                self._entries[entry_key] = entry
+                hits_counter.increment()
+                return defer.succeed(result)
+
+            self._forget_predicate(entry_key)
+
+        misses_counter.increment()
+        d = fetch()
+        d.addCallback(self._store, entry_key, self._epoch)
+        return d
+
+    def invalidate(self, keyspace, table, key):
+        """Removes all entries for a row from the cache"""
+        self._epoch += 1
+        for predicate in self._row_predicates.pop((keyspace, table, key), ()):
+            self._entries.pop((keyspace, table, key, predicate), None)
+
+    def clear(self):
+        self._epoch += 1
+        self._entries.clear()
+        self._row_predicates.clear()
+
+    def _store(self, result, entry_key, epoch):
+        if epoch == self._epoch:
+            self._entries[entry_key] = (monotonic() + self.ttl, result)
+            self._row_predicates.setdefault(entry_key[:3], set()).add(entry_key[3])
+
+            while len(self._entries) > self.max_entries:
+                (evicted_key, _) = self._entries.popitem(last=False)
+                self._forget_predicate(evicted_key)
+                evictions_counter.increment()
+
+        return result
+
+    def _forget_predicate(self, entry_key):
+        row = entry_key[:3]
+        predicates = self._row_predicates.get(row)
+        if predicates is not None:
+            predicates.discard(entry_key[3])
+            if not predicates:
+                del self._row_predicates[row]
+
+
+class RowMemo(object):
+    """
+    Memo of the Cassandra rows read while handling a single request, so that
+    each row is read at most once per request (unless the request itself
+    writes to it).  Unlike RowCache, entries never expire, as the memo only
+    lives as long as the request.
+
+    Reads that miss the memo only go through the process's row cache if
+    `use_row_cache` is set.  Rows in the row cache can be out of date, so
+    this should only be set for requests that just read rows and return them
+    (GETs), not for requests that write what they read, or validate against
+    it.
+    """
+
+    # A read of a whole row returns at most this many columns (the default
+    # count of a get_slice), so a whole row read that returns this many
+    # columns may have been truncated.
+    MAX_ROW_COLUMNS = 100
+
+    def __init__(self, trace=NO_TRACE, use_row_cache=False):
+        # The trace of the request, so that the models reading rows for it
+        # can time what they do.
+        self.trace = trace
+        self.use_row_cache = use_row_cache
+
+        # Maps (keyspace, table, key, predicate) to the result of the read.
+        self._entries = {}
+        self._epoch = 0
+
+    def read_through(self, keyspace, table, key, predicate, fetch):
+        """
+        As for RowCache.read_through.  A read of named columns (a predicate
+        that is a tuple of column names) can also be answered from an earlier
+        read of the whole row (a predicate of None).
+        """
+        entry_key = (keyspace, table, key, predicate)
+        if entry_key in self._entries:
+            return defer.succeed(self._entries[entry_key])
+
+        whole_row = self._entries.get((keyspace, table, key, None))
+        if ((predicate is not None) and
+            (whole_row is not None) and
+            (len(whole_row) < self.MAX_ROW_COLUMNS)):
+            result = [col for col in whole_row if col.column.name in predicate]
+            return defer.succeed(result)
+
+        d = fetch()
+        d.addCallback(self._store, entry_key, self._epoch)
+        return d
+
+    def invalidate(self, keyspace, table, key):
+        self._epoch += 1
+        for entry_key in self._entries.keys():
+            if entry_key[:3] == (keyspace, table, key):
+                del self._entries[entry_key]
+
+    def _store(self, result, entry_key, epoch):
+        if epoch == self._epoch:
+            self._entries[entry_key] = result
+        return result
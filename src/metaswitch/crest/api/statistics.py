@@ -11,11 +11,17 @@ import logging
 import abc
 import base
 from monotonic import monotonic
+from twisted.internet import task
+from metaswitch.crest.api.histogram import LatencyHistogram, PERCENTILES
 
-# Collect stats every 5 seconds
+# Publish stats every 5 seconds
 STATS_PERIOD = 5
 _log = logging.getLogger("crest.api")
 
+# All the collectors that have been created in this process, so that they can
+# be set up together once the process ID is known, and published together.
+collectors = []
+
 class Collector(object):
     """
     Abstract base class for all statistics collectors that can be
@@ -24,18 +30,44 @@ class Collector(object):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, stat_name):
+    # The names of the values of the stat, as published.  The values of a
+    # labelled stat are a table: for each label in turn, the label followed
+    # by these values.
+    FIELDS = []
+    labelled = False
+
+    def __init__(self, stat_name, register=True):
+        # Collectors that are part of another (see LabelledCollector) aren't
+        # registered, as they aren't published by themselves.
+        self.base_name = stat_name
         self.stat_name = stat_name
         self.start_time = monotonic()
+        if register:
+            collectors.append(self)
 
     @abc.abstractmethod
-    def refresh(self):
+    def add(self, *args):
         """
-        Publish the stat to the ipc files, if enough time has passed
-        since the stat was last published.
+        Record an event, without publishing the stat.
         """
         pass
 
+    @abc.abstractmethod
+    def values(self, time_difference):
+        """
+        The values of the stat, as published, for the events recorded over
+        the last time_difference seconds.
+        """
+        pass
+
+    def publish(self):
+        """
+        Publish the stat to the ipc files, and start collecting it afresh.
+        """
+        time_difference = monotonic() - self.start_time
+        base.zmq.report(self.values(time_difference), self.stat_name)
+        self.reset()
+
     @abc.abstractmethod
     def reset(self):
         """
@@ -51,20 +83,20 @@ class Counter(Collector):
     Counters track how many times a particular event happens over a period
     """
 
-    def __init__(self, stat_name):
-        super(Counter, self).__init__(stat_name)
+    FIELDS = ["count"]
+
+    def __init__(self, stat_name, register=True):
+        super(Counter, self).__init__(stat_name, register)
         self.current = 0
 
     def increment(self):
-        self.current += 1
-        self.refresh()
+        self.add()
 
-    def refresh(self):
-        time_difference = monotonic() - self.start_time
+    def add(self):
+        self.current += 1
 
-        if time_difference > STATS_PERIOD:
-            base.zmq.report([self.current], self.stat_name)
-            self.reset()
+    def values(self, time_difference):
+        return [self.current]
 
     def reset(self):
         self.current = 0
@@ -74,20 +106,33 @@ class Accumulator(Collector):
     """
     Accumulators track how many times a particular event happens over a period,
     as well as the mean, variance, hwm and lwm values for the stat.
+
+    The mean and variance are kept up to date as each value is added
+    (using Welford's method), rather than by summing the values and their
+    squares, which loses precision for large values such as latencies in
+    microseconds.
     """
 
-    def __init__(self, stat_name):
-        super(Accumulator, self).__init__(stat_name)
+    FIELDS = ["count", "mean", "variance", "lwm", "hwm"]
+
+    def __init__(self, stat_name, register=True):
+        super(Accumulator, self).__init__(stat_name, register)
         self.current = 0
-        self.sigma = 0
-        self.sigma_squared = 0
+        self.mean = 0.0
+        self.m2 = 0.0
         self.lwm = 0
         self.hwm = 0
 
     def accumulate(self, latency):
+        self.add(latency)
+
+    def add(self, latency):
         self.current += 1
-        self.sigma += latency
-        self.sigma_squared += (latency * latency)
+
+        # m2 is the sum of the squares of the differences from the mean.
+        delta = latency - self.mean
+        self.mean += delta / self.current
+        self.m2 += delta * (latency - self.mean)
 
         if (self.lwm > latency or self.lwm == 0):
             self.lwm = latency
@@ -95,27 +140,140 @@ class Accumulator(Collector):
         if (self.hwm < latency):
             self.hwm = latency
 
-        self.refresh()
-
-    def refresh(self):
-        time_difference = monotonic() - self.start_time
-        mean = 0
+    def values(self, time_difference):
         variance = 0
+        n = self.current * STATS_PERIOD / time_difference
 
-        if time_difference > STATS_PERIOD:
-            n = self.current * STATS_PERIOD / time_difference
-
-            if self.current > 0:
-                mean = self.sigma / self.current
-                variance = (self.sigma_squared / self.current) - (mean * mean)
+        if self.current > 0:
+            variance = self.m2 / self.current
 
-            base.zmq.report([n, mean, variance, self.lwm, self.hwm], self.stat_name)
-            self.reset()
+        return [n, self.mean, variance, self.lwm, self.hwm]
 
     def reset(self):
         self.current = 0
-        self.sigma = 0
-        self.sigma_squared = 0
+        self.mean = 0.0
+        self.m2 = 0.0
         self.lwm = 0
         self.hwm = 0
         self.start_time = monotonic()
+
+class PercentileAccumulator(Collector):
+    """
+    PercentileAccumulators track how many times a particular event happens
+    over a period, as well as the 50th, 90th and 99th percentile values for
+    the stat (such as a latency in microseconds).  The percentiles are
+    accurate to within 1/16th of their value.
+
+    If sketch_name is set, the histogram itself is also published under that
+    name, so that the parent process can merge the histograms of all the
+    processes to give percentiles for the whole node (see LastValueCache).
+    """
+
+    PERCENTILES = PERCENTILES
+    FIELDS = ["count"] + ["p%d" % p for p in PERCENTILES]
+
+    def __init__(self, stat_name, register=True, sketch_name=None):
+        super(PercentileAccumulator, self).__init__(stat_name, register)
+        self.histogram = LatencyHistogram()
+        self.sketch_name = sketch_name
+
+    def set_process_id(self, process_id):
+        super(PercentileAccumulator, self).set_process_id(process_id)
+        if self.sketch_name is not None:
+            self.sketch_name += "_" + str(process_id)
+
+    def publish(self):
+        if self.sketch_name is not None:
+            # Published as the index and count of each bucket in turn.
+            base.zmq.report([value
+                             for bucket in self.histogram.sparse()
+                             for value in bucket],
+                            self.sketch_name)
+        super(PercentileAccumulator, self).publish()
+
+    def accumulate(self, value):
+        self.add(value)
+
+    def add(self, value):
+        self.histogram.record(value)
+
+    def values(self, time_difference):
+        n = self.histogram.count * STATS_PERIOD / time_difference
+        return [n] + [self.histogram.percentile(p) for p in self.PERCENTILES]
+
+    def reset(self):
+        self.histogram.reset()
+        self.start_time = monotonic()
+
+class LabelledCollector(Collector):
+    """
+    LabelledCollectors track a stat (using another type of collector, such as
+    an Accumulator) separately for each of a number of labels, such as the
+    endpoint that requests are made to.  The stat is published as a table: for
+    each label in turn, the label followed by the values for that label.
+
+    At most max_labels labels are tracked in each period.  Events for any
+    other labels are tracked together under OTHER_LABEL, so that the number
+    of labels (and so the memory used and the size of the stat) is bounded
+    however many different labels there are.
+    """
+
+    OTHER_LABEL = "other"
+    labelled = True
+
+    def __init__(self, stat_name, collector_class, max_labels):
+        super(LabelledCollector, self).__init__(stat_name)
+        self.FIELDS = collector_class.FIELDS
+        self.collector_class = collector_class
+        self.max_labels = max_labels
+        self.labels = {}
+
+    def increment(self, label):
+        self.add(label)
+
+    def accumulate(self, label, value):
+        self.add(label, value)
+
+    def add(self, label, *args):
+        collector = self.labels.get(label)
+        if collector is None:
+            if len(self.labels) >= self.max_labels:
+                label = self.OTHER_LABEL
+                collector = self.labels.get(label)
+
+            if collector is None:
+                collector = self.collector_class(self.stat_name, register=False)
+                self.labels[label] = collector
+
+        collector.add(*args)
+
+    def values(self, time_difference):
+        values = []
+        for label in sorted(self.labels):
+            values.append(label)
+            values.extend(self.labels[label].values(time_difference))
+        return values
+
+    def reset(self):
+        self.labels = {}
+        self.start_time = monotonic()
+
+
+def publish_all():
+    for collector in collectors:
+        try:
+            collector.publish()
+        except Exception:
+            _log.exception("Failed to publish %s", collector.stat_name)
+
+# Stats are published every STATS_PERIOD seconds, whether or not there have
+# been any events, so that they are always up to date.  Recording an event
+# doesn't check whether it's time to publish.
+_publisher = task.LoopingCall(publish_all)
+
+def start_publishing():
+    _publisher.start(STATS_PERIOD, now=False)
+
+def stop_publishing():
+    if _publisher.running:
+        _publisher.stop()
@@ -0,0 +1,146 @@
+# @file tracing.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import json
+import logging
+import random
+from collections import deque
+from monotonic import monotonic
+from cyclone.web import RequestHandler
+
+from metaswitch.crest import settings
+
+_log = logging.getLogger("crest.api.trace")
+
+# The most recent traces, as returned by /debug/traces.
+recent_traces = deque(maxlen=settings.TRACE_HISTORY)
+
+
+class _Span(object):
+    """Context manager that times a stage of a request"""
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = monotonic()
+
+    def __exit__(self, *exc_info):
+        self.trace.add_span(self.name, self.start, monotonic())
+
+
+class RequestTrace(object):
+    """
+    Timings (spans) of the stages of handling a request, such as reads from
+    Cassandra or building XML.  Stages can overlap (for example, if several
+    rows are read at once), so their durations needn't add up to the latency
+    of the request.
+
+    Time a stage with
+
+        with trace.span("name"):
+            ...
+
+    (which also works around a yield in an inlineCallbacks function), or time
+    a Deferred with trace.time("name", d).
+    """
+
+    def __init__(self):
+        self.start = monotonic()
+        self.spans = []
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def time(self, name, d):
+        start = monotonic()
+
+        def record(result):
+            self.add_span(name, start, monotonic())
+            return result
+
+        d.addBoth(record)
+        return d
+
+    def add_span(self, name, start, end):
+        self.spans.append((name, start - self.start, end - start))
+
+    def stages(self):
+        """Returns a dictionary mapping the name of each stage to the number
+        of spans of it and their total duration"""
+        stages = {}
+        for (name, _, duration) in self.spans:
+            count, total = stages.get(name, (0, 0))
+            stages[name] = (count + 1, total + duration)
+        return stages
+
+    def finish(self, method, uri, status, latency):
+        """Logs the trace once the request has been handled, and keeps it for
+        /debug/traces"""
+        stages = self.stages()
+        _log.info("%s %s (%d) took %dus: %s",
+                  method, uri, status, latency * 1000000,
+                  ", ".join("%s %dus (%d)" % (name, total * 1000000, count)
+                            for name, (count, total) in sorted(stages.items())) or "no stages")
+
+        recent_traces.append(
+            {"method": method,
+             "uri": uri,
+             "status": status,
+             "latency_us": int(latency * 1000000),
+             "spans": [{"name": name,
+                        "start_us": int(start * 1000000),
+                        "duration_us": int(duration * 1000000)}
+                       for (name, start, duration) in self.spans],
+             "stages": {name: {"count": count, "total_us": int(total * 1000000)}
+                        for name, (count, total) in stages.iteritems()}})
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _NoTrace(object):
+    """Trace of a request that isn't being traced, which does nothing"""
+    _no_span = _NoSpan()
+
+    def span(self, name):
+        return self._no_span
+
+    def time(self, name, d):
+        return d
+
+    def add_span(self, name, start, end):
+        pass
+
+    def finish(self, method, uri, status, latency):
+        pass
+
+NO_TRACE = _NoTrace()
+
+
+def start_trace():
+    """Returns the trace for a new request - which is NO_TRACE unless the
+    request has been sampled for tracing (see settings.TRACE_SAMPLE_RATE)"""
+    if settings.TRACE_SAMPLE_RATE > 0 and random.random() < settings.TRACE_SAMPLE_RATE:
+        return RequestTrace()
+    return NO_TRACE
+
+
+class TracesHandler(RequestHandler):
+    """Returns the most recent traces, newest first"""
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"traces": list(reversed(recent_traces))}))
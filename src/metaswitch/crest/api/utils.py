@@ -9,8 +9,32 @@
 
 import itertools
 
+from twisted.internet import defer
+
 
 def flatten(list_of_lists):
     """Flatten a list of lists into a single list, e.g:
     flatten([[A, B], [C, D]]) -> [A, B, C, D] """
     return list(itertools.chain.from_iterable(list_of_lists))
+
+
+def gather_results(deferreds):
+    """Returns a Deferred that fires with a list of the results of the given
+    Deferreds once they have all fired.
+
+    Unlike defer.gatherResults, if any of the Deferreds fail the returned
+    Deferred fails with the first underlying failure (rather than wrapping it
+    in a FirstError), so callers can catch exceptions such as
+    NotFoundException as if they had made the requests one after another."""
+    d = defer.gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(lambda f: f.value.subFailure if f.check(defer.FirstError) else f)
+    return d
+
+
+def map_concurrently(func, items, limit):
+    """Calls `func` (which must return a Deferred) on each of `items`, with at
+    most `limit` calls outstanding at once.  Returns a Deferred that fires
+    with the list of results, in the same order as `items`, or fails as for
+    gather_results."""
+    semaphore = defer.DeferredSemaphore(limit)
+    return gather_results([semaphore.run(func, item) for item in items])
@@ -25,6 +25,7 @@ import twisted.internet.address
 from twisted.internet import reactor
 
 from metaswitch.crest import api
+from metaswitch.crest.api import metrics
 from metaswitch.crest import settings
 from metaswitch.common import utils, logging_config
 from metaswitch.crest import pdlogs
@@ -150,6 +151,13 @@ def standalone():
         bind_safely(reactor, args.process_id, application)
         pdlogs.CREST_UP.log()
 
+        if settings.METRICS_PORT:
+            # Serve the stats collected from all the processes, for scraping.
+            _log.info("Going to serve metrics on TCP port %s", settings.METRICS_PORT)
+            reactor.listenTCP(settings.METRICS_PORT,
+                              metrics.create_application(),
+                              interface=settings.METRICS_INTERFACE)
+
         if args.signaling_namespace and settings.PROCESS_NAME == "homer":
             # Running in signaling namespace as Homer, create TCP socket for XDMS requests
             # from signaling interface
@@ -160,14 +168,16 @@ def standalone():
             for process_id in range(1, args.worker_processes):
                 reactor.spawnProcess(None, executable, [executable, __file__,
                                      "--shared-http-tcp-fd", str(http_tcp_port.fileno()),
-                                     "--process-id", str(process_id)],
+                                     "--process-id", str(process_id),
+                                     "--worker-processes", str(args.worker_processes)],
                                      childFDs={0: 0, 1: 1, 2: 2, http_tcp_port.fileno(): http_tcp_port.fileno()},
                                      env = os.environ)
         else:
             # Spin up worker sub-processes
             for process_id in range(1, args.worker_processes):
                 reactor.spawnProcess(None, executable, [executable, __file__,
-                                     "--process-id", str(process_id)],
+                                     "--process-id", str(process_id),
+                                     "--worker-processes", str(args.worker_processes)],
                                      childFDs={0: 0, 1: 1, 2: 2},
                                      env = os.environ)
     else:
@@ -60,6 +60,146 @@ SIP_DIGEST_REALM = 'example.com'
 CASS_HOST = "localhost"
 CASS_PORT = 9160
 
+# Each process opens CASS_CONNECTIONS connections to each Cassandra keyspace,
+# spread across all the addresses that CASS_HOST resolves to.  Each request is
+# sent on the connection with the fewest requests outstanding.
+CASS_CONNECTIONS = 4
+
+# Every CASS_RING_REFRESH_INTERVAL seconds, crest reads the ring of each
+# keyspace to find the Cassandra nodes in the local datacenter and which of them
+# own each row, so that it can send single-row requests straight to a replica.
+# Set to 0 to disable this.
+CASS_RING_REFRESH_INTERVAL = 60
+
+# Hedged reads.  If CASS_HEDGE_PERCENTILE is set (e.g. to 95), a read from
+# Cassandra that hasn't completed within that percentile of the latency of
+# recent reads is sent again on another connection (to another replica, if
+# possible), and the first response is used.  This cuts the tail latency caused
+# by a slow node, at the cost of roughly (100 - CASS_HEDGE_PERCENTILE)% more
+# reads.
+CASS_HEDGE_PERCENTILE = None
+
+# Once several requests in a row to a keyspace find that LOCAL_QUORUM is
+# unavailable, requests use consistency ONE straight away for
+# CASS_QUORUM_COOLDOWN seconds, before trying LOCAL_QUORUM again.
+CASS_QUORUM_COOLDOWN = 10
+
+# If CASS_REQUEST_TIMEOUT is set, requests to Cassandra fail (as if Cassandra
+# had timed them out) if they haven't completed after that many seconds.
+# Reads that time out are retried (on another connection) up to
+# CASS_READ_RETRIES times.
+CASS_REQUEST_TIMEOUT = None
+CASS_READ_RETRIES = 1
+
+# Reads of many Cassandra rows at once are split into multiget requests of at
+# most MULTIGET_BATCH_SIZE rows, with at most MAX_CONCURRENT_READS of them in
+# flight at once for a single request.
+MULTIGET_BATCH_SIZE = 100
+MAX_CONCURRENT_READS = 10
+
+# Overload control aims to keep the latency of requests below
+# LOAD_MONITOR_TARGET_LATENCY seconds.  By default, it is the smoothed mean
+# latency that is controlled.  Set LOAD_MONITOR_TARGET_PERCENTILE (e.g. to 90
+# or 99) to control that percentile of latency instead - in which case the
+# target latency will probably need to be raised.
+LOAD_MONITOR_TARGET_LATENCY = 0.1
+LOAD_MONITOR_TARGET_PERCENTILE = None
+
+# To make sure that higher priority requests can be admitted when the system
+# is overloaded, lower priority requests are only admitted if they leave this
+# proportion of each load monitor's bucket of tokens unused.  Slow bulk
+# requests (such as listing every public ID) are low priority.  Normal
+# priority requests have no headroom by default - give them some if clients
+# send high priority requests that must get through.
+ADMISSION_HEADROOM = {"low": 0.5,
+                      "normal": 0}
+
+# When there is no token for a request, it can wait in a queue of at most
+# ADMISSION_QUEUE_SIZE requests (per load monitor) until there is one, rather
+# than being rejected straight away.  Requests are admitted from the queue
+# highest priority first (and in the order they arrived within each
+# priority), and rejected once they can no longer be handled within the 500ms
+# that Sprout waits for a response.  0 disables the queue.
+ADMISSION_QUEUE_SIZE = 0
+
+# Each request is logged by a background flusher every
+# ACCESS_LOG_FLUSH_INTERVAL seconds.  At most ACCESS_LOG_BUFFER_SIZE requests
+# are held between flushes (older ones are dropped).  To log less at high
+# request rates, set ACCESS_LOG_SAMPLE_RATE to N to log only one in every N
+# successful requests - failed requests, requests slower than the target
+# latency, and all requests while debug logging is on, are always logged.
+ACCESS_LOG_BUFFER_SIZE = 10000
+ACCESS_LOG_FLUSH_INTERVAL = 1
+ACCESS_LOG_SAMPLE_RATE = 1
+
+# A fraction TRACE_SAMPLE_RATE (between 0 and 1) of requests are traced: the
+# time spent in each stage of handling them (such as Cassandra reads) is
+# logged, and the last TRACE_HISTORY traces of requests handled by the parent
+# process are returned by /debug/traces, which is served with the metrics
+# (see METRICS_PORT).
+TRACE_SAMPLE_RATE = 0
+TRACE_HISTORY = 100
+
+# Latency, throughput and overload statistics are also published for each
+# endpoint (request method and handler), for up to ENDPOINT_STATS_MAX_LABELS
+# endpoints in each period - any others are counted together as "other".
+ENDPOINT_STATS_MAX_LABELS = 50
+
+# If METRICS_PORT is set, the parent process also serves the latest stats from
+# every process (including the state of each load monitor) for Prometheus to
+# scrape, at http://METRICS_INTERFACE:METRICS_PORT/metrics.
+METRICS_PORT = None
+METRICS_INTERFACE = "127.0.0.1"
+
+# Some requests are admitted by their own load monitor, so that a burst of
+# expensive requests doesn't cause cheap ones to be rejected.  This maps each
+# of these admission classes to the parameters of its load monitor: target
+# latency (in seconds), maximum bucket size, initial and minimum token rates
+# (per second) and optionally a target percentile, as above.  Requests that
+# aren't in any of these classes share the load monitor configured above.
+ADMISSION_CLASSES = {
+    # Provisioning requests that change subscribers (and so rebuild their
+    # cache entries).
+    "provisioning": {"target_latency": 0.5,
+                     "max_bucket_size": 100,
+                     "init_token_rate": 20,
+                     "min_token_rate": 2},
+
+    # Slow requests, such as listing all subscribers.  These don't count
+    # towards latency, so are only limited by the initial token rate.
+    "slow": {"target_latency": 1,
+             "max_bucket_size": 10,
+             "init_token_rate": 5,
+             "min_token_rate": 5},
+}
+
+# Homestead-prov can cache provisioning rows in each worker process, to avoid
+# reading the same rows from Cassandra again and again.  The cache holds at
+# most PROVISIONING_ROW_CACHE_SIZE entries (0 disables it), each for at most
+# PROVISIONING_ROW_CACHE_TTL seconds - so changes made by other processes can
+# take this long to be seen by GET requests.  Requests that change
+# provisioning always read the rows they need from Cassandra.
+PROVISIONING_ROW_CACHE_SIZE = 0
+PROVISIONING_ROW_CACHE_TTL = 2
+
+# Listing all public IDs queries up to PUBLIC_ID_LISTING_CONCURRENCY chunks of
+# the token ring at once (a request can ask for fewer, or for up to
+# PUBLIC_ID_LISTING_MAX_CONCURRENCY).  Between chunks the listing pauses for
+# up to PUBLIC_ID_LISTING_MAX_PAUSE seconds, but only while request latency
+# is above its target, so it backs off when the system is busy.
+PUBLIC_ID_LISTING_CONCURRENCY = 4
+PUBLIC_ID_LISTING_MAX_CONCURRENCY = 16
+PUBLIC_ID_LISTING_MAX_PAUSE = 1
+
+# Each chunk is read from Cassandra in pages of PUBLIC_ID_LISTING_PAGE_SIZE
+# rows, so the memory used by a listing is bounded however many subscribers
+# there are.
+PUBLIC_ID_LISTING_PAGE_SIZE = 1000
+
+# When listing public IDs with their SP and IRS UUIDs, remember the IRS of up
+# to PUBLIC_ID_LISTING_SP_MEMO_SIZE service profiles.
+PUBLIC_ID_LISTING_SP_MEMO_SIZE = 10000
+
 # Debian install will pick this up from /etc/clearwater/config
 LOCAL_IP = "127.0.0.1"
 SPROUT_HOSTNAME = "sprout.%s" % SIP_DIGEST_REALM
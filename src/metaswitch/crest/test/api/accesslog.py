@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+# @file accesslog.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from mock import patch, MagicMock
+from twisted.internet import task
+from twisted.internet.task import Clock
+
+from metaswitch.crest.api.accesslog import AccessLog
+
+
+def record(access_log, uri, status=200, latency=0.01):
+    access_log.record("1.2.3.4", "GET", "http", "example.com", uri, status, latency)
+
+
+class TestAccessLog(unittest.TestCase):
+
+    def uris(self, entries):
+        return [entry[4] for entry in entries]
+
+    def test_ring_buffer(self):
+        """Test that requests are drained oldest first, and that the oldest
+        are overwritten when the buffer is full"""
+        access_log = AccessLog(3, 1)
+
+        for uri in ["/a", "/b"]:
+            record(access_log, uri)
+        self.assertEquals(access_log.drain(), ([("1.2.3.4", "GET", "http", "example.com", "/a", 200, 0.01),
+                                                ("1.2.3.4", "GET", "http", "example.com", "/b", 200, 0.01)], 0, 0))
+
+        for uri in ["/c", "/d", "/e", "/f", "/g"]:
+            record(access_log, uri)
+        (entries, sampled_out, overwritten) = access_log.drain()
+        self.assertEquals(self.uris(entries), ["/e", "/f", "/g"])
+        self.assertEquals(overwritten, 2)
+
+        self.assertEquals(access_log.drain(), ([], 0, 0))
+
+    def test_sampling(self):
+        """Test that only some successful requests are logged, but that
+        failed and slow requests always are"""
+        access_log = AccessLog(10, 1, sample_rate=3, slow_latency=0.1)
+
+        for uri in ["/1", "/2", "/3", "/4"]:
+            record(access_log, uri)
+        record(access_log, "/error", status=500)
+        record(access_log, "/slow", latency=0.2)
+
+        (entries, sampled_out, overwritten) = access_log.drain()
+        self.assertEquals(self.uris(entries), ["/3", "/error", "/slow"])
+        self.assertEquals(sampled_out, 3)
+
+    def test_debug(self):
+        """Test that every request is logged while debug logging is on"""
+        access_log = AccessLog(10, 1, sample_rate=100)
+
+        with patch("metaswitch.crest.api.accesslog._log.isEnabledFor", return_value=True):
+            for uri in ["/1", "/2"]:
+                record(access_log, uri)
+
+        (entries, sampled_out, overwritten) = access_log.drain()
+        self.assertEquals(self.uris(entries), ["/1", "/2"])
+
+    def test_write(self):
+        """Test that requests are formatted when they're written"""
+        with patch("metaswitch.crest.api.accesslog._log") as log:
+            AccessLog.write([("1.2.3.4", "GET", "http", "example.com", "/a", 200, 0.01)], 1, 0)
+
+        self.assertEquals(log.info.call_count, 2)
+        args = log.info.call_args_list[0][0]
+        self.assertEquals(args[0] % args[1:], "Sent 200 response to 1.2.3.4 for GET http://example.com/a in 10000us")
+
+    def test_flush(self):
+        """Test that the buffer is written on a background thread every flush
+        interval, and that whatever is left is written when it stops"""
+        clock = Clock()
+
+        def looping_call(f):
+            call = task.LoopingCall(f)
+            call.clock = clock
+            return call
+
+        written = []
+        access_log = AccessLog(10, 1)
+        access_log.write = lambda *args: written.append(args)
+
+        with patch("metaswitch.crest.api.accesslog.task", MagicMock(LoopingCall=looping_call)), \
+             patch("metaswitch.crest.api.accesslog.threads.deferToThread") as defer_to_thread:
+            access_log.start()
+            record(access_log, "/a")
+            record(access_log, "/b")
+            self.assertFalse(defer_to_thread.called)
+
+            clock.advance(1)
+            self.assertEquals(defer_to_thread.call_count, 1)
+            (write, entries, sampled_out, overwritten) = defer_to_thread.call_args[0]
+            self.assertEquals(write, access_log.write)
+            self.assertEquals(self.uris(entries), ["/a", "/b"])
+
+            # Nothing is handed off while there's nothing to log.
+            clock.advance(1)
+            self.assertEquals(defer_to_thread.call_count, 1)
+
+            record(access_log, "/c")
+            access_log.stop()
+            self.assertEquals(defer_to_thread.call_count, 1)
+
+        self.assertEquals(len(written), 1)
+        self.assertEquals(self.uris(written[0][0]), ["/c"])
+
+        # The flusher has stopped.
+        record(access_log, "/d")
+        clock.advance(1)
+        self.assertEquals(len(written), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,6 +14,7 @@ import sys
 import unittest
 import uuid
 from cyclone.web import HTTPError
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
 from metaswitch.crest.api import base
 from monotonic import monotonic
@@ -44,6 +45,43 @@ class TestBaseHandler(unittest.TestCase):
         self.request.headers = {}
         self.handler.prepare()
 
+    @patch("metaswitch.crest.settings.ADMISSION_CLASSES",
+           {"expensive": {"target_latency": 0.1,
+                          "max_bucket_size": 1,
+                          "init_token_rate": 1,
+                          "min_token_rate": 1}})
+    @patch("metaswitch.crest.api.base._load_monitors", {})
+    def test_admission_class(self):
+        """Test requests in an admission class are admitted separately from
+        other requests"""
+        expensive_handler = base.BaseHandler(self.app, self.request)
+        expensive_handler.admission_class = "expensive"
+
+        # The bucket for expensive requests only has one token.
+        self.assertEquals(expensive_handler.prepare(), None)
+        self.assertNotEquals(expensive_handler.prepare(), None)
+
+        # Other requests are still admitted.
+        self.assertEquals(self.handler.prepare(), None)
+        self.assertTrue(base.get_load_monitor("expensive") is not base.loadmonitor)
+        self.assertTrue(base.get_load_monitor(None) is base.loadmonitor)
+
+    def test_priority_header(self):
+        """Test clients can set the priority of their requests"""
+        self.assertEquals(self.handler.get_priority(), base.PRIORITY_NORMAL)
+        self.request.headers[base.PRIORITY_HEADER] = "high"
+        self.assertEquals(self.handler.get_priority(), base.PRIORITY_HIGH)
+        self.request.headers[base.PRIORITY_HEADER] = "urgent"
+        self.assertEquals(self.handler.get_priority(), base.PRIORITY_NORMAL)
+
+    def test_slow_priority(self):
+        """Test slow requests are low priority unless the client says
+        otherwise"""
+        slow_handler = base.SlowRequestHandler(self.app, self.request)
+        self.assertEquals(slow_handler.get_priority(), base.PRIORITY_LOW)
+        self.request.headers[base.PRIORITY_HEADER] = "normal"
+        self.assertEquals(slow_handler.get_priority(), base.PRIORITY_NORMAL)
+
     @patch('cyclone.web.RequestHandler')
     def test_write_msgpack(self, rh):
         self.handler.prepare()
@@ -378,5 +416,187 @@ class TestLoadMonitor(unittest.TestCase):
         print("Initial rate {}, final rate {}".format(initial_rate, final_rate))
         self.assertTrue(final_rate == initial_rate)
 
+    def test_rate_decrease_on_percentile(self):
+        """
+        Test that when the load monitor targets a percentile of latency, a
+        slow tail of requests causes the permitted request rate to decrease,
+        even though the mean latency is within target.
+        """
+        load_monitor = base.LoadMonitor(0.1, 100, 100, 10, 90)
+        load_monitor.last_adjustment_time = 0
+        initial_rate = load_monitor.bucket.rate
+
+        for i in range(base.LoadMonitor.REQUESTS_BEFORE_ADJUSTMENT):
+            load_monitor.admit_request()
+            load_monitor.request_complete()
+            load_monitor.update_latency(0.5 if i % 5 == 0 else 0.01)
+
+        self.assertTrue(load_monitor.smoothed_latency < 0.1)
+        self.assertTrue(load_monitor.bucket.rate < initial_rate)
+
+    def test_peer_load(self):
+        """
+        Test that the load monitor adjusts based on the load reported by other
+        processes, as well as its own.
+        """
+        load_monitor = base.LoadMonitor(0.1, 100, 100, 10)
+        load_monitor.last_adjustment_time = 0
+        initial_rate = load_monitor.bucket.rate
+
+        # Another process is handling lots of slow requests.
+        load_monitor.record_peer_load(1, 0.5, 100, 0)
+
+        for _ in range(base.LoadMonitor.REQUESTS_BEFORE_ADJUSTMENT):
+            load_monitor.admit_request()
+            load_monitor.request_complete()
+            load_monitor.update_latency(0.01)
+
+        # Although our own latency is well within target, the node's isn't.
+        self.assertTrue(load_monitor.bucket.rate < initial_rate)
+        base.zmq.report_load_state.assert_called_once_with(
+            None, load_monitor.smoothed_latency, base.LoadMonitor.REQUESTS_BEFORE_ADJUSTMENT, 0)
+
+    def test_priorities(self):
+        """
+        Test that lower priority requests are rejected first, leaving tokens
+        for higher priority requests.
+        """
+        load_monitor = base.LoadMonitor(0.1, 10, 0.001, 0.001, None,
+                                        {base.PRIORITY_LOW: 0.5,
+                                         base.PRIORITY_NORMAL: 0.2})
+
+        def admit_all(priority):
+            admitted = 0
+            while load_monitor.admit_request(priority):
+                admitted += 1
+            return admitted
+
+        self.assertEquals(admit_all(base.PRIORITY_LOW), 5)
+        self.assertEquals(admit_all(base.PRIORITY_NORMAL), 3)
+        self.assertEquals(admit_all(base.PRIORITY_HIGH), 2)
+
+    def test_admission_queue(self):
+        """
+        Test that requests wait in the queue for tokens and are admitted in
+        order, and are rejected once they can't meet their deadline.
+        """
+        clock = Clock()
+        with patch("metaswitch.crest.api.base.monotonic", clock.seconds), \
+             patch("metaswitch.crest.api.base.reactor", clock):
+            # One token, replenished every 0.125 seconds.
+            load_monitor = base.LoadMonitor(0.1, 1, 8, 8)
+            load_monitor.smoothed_latency = 0.0625
+            results = []
+
+            for deadline in [1, 1, 0.25, 1, 1]:
+                d = load_monitor.request_admission(base.PRIORITY_NORMAL, deadline, 3)
+                d.addCallback(lambda admitted, deadline=deadline: results.append((deadline, admitted)))
+
+            # The first request is admitted straight away, the next three are
+            # queued, and the last is rejected because the queue is full.
+            self.assertEquals(results, [(1, True), (1, False)])
+            self.assertEquals(load_monitor.queue_size(), 3)
+
+            clock.advance(0.125)
+            self.assertEquals(results[2:], [(1, True)])
+
+            # The request with the short deadline can't be handled in time
+            # once the next token is available, so is rejected.
+            clock.advance(0.0625)
+            self.assertEquals(results[3:], [(0.25, False)])
+
+            clock.advance(0.0625)
+            self.assertEquals(results[4:], [(1, True)])
+            self.assertEquals(load_monitor.queue_size(), 0)
+
+            # While requests are queued, new requests can't skip the queue.
+            load_monitor.request_admission(base.PRIORITY_NORMAL, 1, 3)
+            self.assertFalse(load_monitor.admit_request())
+
+    def test_admission_queue_priorities(self):
+        """
+        Test that queued requests are admitted in priority order, and that a
+        low priority request waiting for its headroom doesn't hold up higher
+        priority requests.
+        """
+        clock = Clock()
+        with patch("metaswitch.crest.api.base.monotonic", clock.seconds), \
+             patch("metaswitch.crest.api.base.reactor", clock):
+            # Low priority requests need half the bucket left over.  The
+            # bucket is empty, and a token is replenished every 0.125 seconds.
+            load_monitor = base.LoadMonitor(0.1, 4, 8, 8, None,
+                                            {base.PRIORITY_LOW: 0.5})
+            load_monitor.bucket.tokens = 0
+            results = []
+
+            for priority in [base.PRIORITY_LOW, base.PRIORITY_NORMAL,
+                             base.PRIORITY_HIGH, base.PRIORITY_NORMAL]:
+                d = load_monitor.request_admission(priority, 10, 10)
+                d.addCallback(lambda admitted, priority=priority: results.append((priority, admitted)))
+            self.assertEquals(load_monitor.queue_size(), 4)
+
+            # Each token goes to the highest priority request waiting, even
+            # though the low priority request arrived first.
+            clock.advance(0.125)
+            self.assertEquals(results, [(base.PRIORITY_HIGH, True)])
+            clock.advance(0.125)
+            clock.advance(0.125)
+            self.assertEquals(results[1:], [(base.PRIORITY_NORMAL, True),
+                                            (base.PRIORITY_NORMAL, True)])
+
+            # While only a low priority request is queued, a high priority
+            # request can take a token that the low priority one can't.
+            clock.advance(0.125)
+            self.assertTrue(load_monitor.admit_request(base.PRIORITY_HIGH))
+            self.assertFalse(load_monitor.admit_request(base.PRIORITY_NORMAL))
+
+            # The low priority request is admitted once the bucket is half
+            # full again.
+            clock.advance(0.125 * 3)
+            self.assertEquals(results[3:], [(base.PRIORITY_LOW, True)])
+            self.assertEquals(load_monitor.queue_size(), 0)
+
+    def test_background_pause(self):
+        """
+        Test that background work only pauses when latency is above target,
+        and pauses for longer the further above target it is.
+        """
+        load_monitor = base.LoadMonitor(0.1, 100, 100, 10)
+
+        load_monitor.smoothed_latency = 0.05
+        self.assertEquals(load_monitor.background_pause(1), 0)
+
+        load_monitor.smoothed_latency = 0.15
+        self.assertAlmostEqual(load_monitor.background_pause(1), 0.5)
+
+        load_monitor.smoothed_latency = 1
+        self.assertEquals(load_monitor.background_pause(1), 1)
+
+        # Always pause for the maximum time while overloaded.
+        load_monitor.smoothed_latency = 0.05
+        load_monitor.overloaded = True
+        self.assertEquals(load_monitor.background_pause(1), 1)
+
+
+class TestSetupStats(unittest.TestCase):
+
+    @patch.object(base, "zmq")
+    @patch.object(base, "access_log")
+    @patch.object(base.statistics, "start_publishing")
+    @patch.object(base.statistics, "collectors", [])
+    def test_listen_for_load_state(self, start_publishing, access_log, zmq):
+        """Test that every process shares its load with the others when there
+        are several, including workers that weren't told how many there are"""
+        for (p_id, worker_proc, listens) in [(0, 1, False),
+                                             (0, 4, True),
+                                             (2, 4, True),
+                                             (2, 1, True)]:
+            zmq.reset_mock()
+            base.setupStats(p_id, worker_proc)
+            zmq.bind.assert_called_once_with(p_id, worker_proc)
+            self.assertEquals(zmq.listen_for_load_state.called, listens)
+            if listens:
+                zmq.listen_for_load_state.assert_called_once_with(base.record_peer_load)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,350 @@
+#!/usr/bin/python
+
+# @file cassandrapool.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import socket
+import unittest
+
+from mock import patch, MagicMock
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from telephus.cassandra.ttypes import ConsistencyLevel, TimedOutException, UnavailableException
+
+from metaswitch.crest.api import cassandrapool, passthrough
+from metaswitch.crest.api.cassandrapool import CassandraPool
+from metaswitch.crest.test.api.cassandraring import token_range
+
+MURMUR3 = "org.apache.cassandra.dht.Murmur3Partitioner"
+
+
+class CassandraPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(cassandrapool, "reactor", MagicMock())
+        self.reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch.object(cassandrapool, "ManagedCassandraClientFactory",
+                               lambda keyspace: MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch("socket.getaddrinfo")
+        self.getaddrinfo = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.getaddrinfo.return_value = [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.1", 9160)),
+            (socket.AF_INET, socket.SOCK_DGRAM, 17, "", ("10.0.0.1", 9160)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.2", 9160))]
+
+        # Each connection gets its own mock client, whose requests don't
+        # complete until the test fires them.
+        self.clients = []
+        self.requests = []
+        def client_class(factory):
+            client = MagicMock()
+            client.get.side_effect = lambda *args, **kwargs: self.request()
+            self.clients.append(client)
+            return client
+        self.client_class = client_class
+
+    def request(self):
+        d = defer.Deferred()
+        self.requests.append(d)
+        return d
+
+
+class TestCassandraPool(CassandraPoolTestCase):
+
+    def test_spread_connections(self):
+        """Test that the connections are spread across all the addresses"""
+        pool = CassandraPool("homer", size=4, client_class=self.client_class)
+
+        self.assertEquals(len(pool.factories), 4)
+        addresses = [call[0][0] for call in self.reactor.connectTCP.call_args_list]
+        self.assertEquals(sorted(addresses),
+                          ["10.0.0.1", "10.0.0.1", "10.0.0.2", "10.0.0.2"])
+
+    def test_least_outstanding(self):
+        """Test that each request is sent on the connection with the fewest
+        outstanding requests"""
+        pool = CassandraPool("homer", size=3, client_class=self.client_class)
+
+        # The first requests are spread over all the connections.
+        pool.get(key="a")
+        pool.get(key="b")
+        pool.get(key="c")
+        self.assertEquals([client.get.call_count for client in self.clients], [1, 1, 1])
+
+        # Once the second connection's request completes, it is the least
+        # loaded, so gets the next request.
+        self.requests[1].callback("result")
+        pool.get(key="d")
+        self.assertEquals([client.get.call_count for client in self.clients], [1, 2, 1])
+
+    def test_completion(self):
+        """Test that the outstanding count falls when requests complete, whether
+        or not they succeed"""
+        pool = CassandraPool("homer", size=1, client_class=self.client_class)
+
+        d1 = pool.get(key="a")
+        d2 = pool.get(key="b")
+        self.assertEquals(pool.connections[0].outstanding, 2)
+
+        self.requests[0].callback("result")
+        self.requests[1].errback(Exception("error"))
+        d2.addErrback(lambda failure: None)
+        self.assertEquals(pool.connections[0].outstanding, 0)
+        self.assertEquals(d1.result, "result")
+
+    def ring(self, pool, token_ranges):
+        """Has the pool read a ring with the given token ranges"""
+        for client in self.clients:
+            client.describe_ring.return_value = token_ranges
+            client.describe_partitioner.return_value = MURMUR3
+        pool.refresh_ring()
+
+    def test_discover_nodes(self):
+        """Test that the pool connects to the nodes in the local datacenter,
+        and disconnects from them when they leave"""
+        self.getaddrinfo.return_value = [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("rpc-a", 9160))]
+        pool = CassandraPool("homer", size=4, client_class=self.client_class)
+        self.ring(pool, [token_range(0, 100, ["a", "x"], ["site1", "site2"]),
+                         token_range(100, 0, ["b", "y"], ["site1", "site2"])])
+
+        addresses = [connection.address for connection in pool.connections]
+        self.assertEquals(sorted(addresses), ["rpc-a"] * 4 + ["rpc-b"] * 2)
+
+        discovered = pool.connections[-1]
+        self.ring(pool, [token_range(0, 0, ["a", "x"], ["site1", "site2"])])
+        addresses = [connection.address for connection in pool.connections]
+        self.assertEquals(addresses, ["rpc-a"] * 4)
+        discovered.factory.shutdown.assert_called_once_with()
+
+    def test_route_to_replicas(self):
+        """Test that single row requests are sent to the row's replicas, and
+        other requests to any node"""
+        pool = CassandraPool("homer", size=2, client_class=self.client_class)
+        by_address = dict((connection.address, connection.client)
+                          for connection in pool.connections)
+        ranges = [token_range(0, 100, ["10.0.0.1"]), token_range(100, 0, ["10.0.0.2"])]
+        for tr in ranges:
+            tr.rpc_endpoints = tr.endpoints
+        self.ring(pool, ranges)
+        pool.ring.token_function = lambda key: int(key)
+
+        for _ in range(3):
+            pool.get(key="50")
+            pool.get("150", "column_family")
+            pool.batch_mutate({"60": {}})
+        self.assertEquals(by_address["10.0.0.1"].get.call_count, 3)
+        self.assertEquals(by_address["10.0.0.2"].get.call_count, 3)
+        self.assertEquals(by_address["10.0.0.1"].batch_mutate.call_count, 3)
+
+        # Requests for several rows go to any node.
+        for _ in range(4):
+            pool.multiget(keys=["50", "150"])
+        self.assertEquals(by_address["10.0.0.1"].multiget.call_count, 2)
+        self.assertEquals(by_address["10.0.0.2"].multiget.call_count, 2)
+
+    def test_ring_unavailable(self):
+        """Test that the pool carries on routing requests if it can't read
+        the ring"""
+        pool = CassandraPool("homer", size=2, client_class=self.client_class)
+        for client in self.clients:
+            client.describe_ring.side_effect = Exception("timed out")
+        pool.refresh_ring()
+        self.assertEquals(pool.ring, None)
+
+        pool.get(key="a")
+        self.assertEquals(sum(client.get.call_count for client in self.clients), 1)
+
+
+class TestHedgedReads(CassandraPoolTestCase):
+
+    def setUp(self):
+        CassandraPoolTestCase.setUp(self)
+        self.clock = Clock()
+        self.reactor.callLater.side_effect = self.clock.callLater
+
+        patcher = patch.object(cassandrapool, "monotonic", self.clock.seconds)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch("metaswitch.crest.settings.CASS_HEDGE_PERCENTILE", 90)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.pool = CassandraPool("homer", size=2, client_class=self.client_class)
+
+        # Build up a history of reads, 90% of which take 10ms.
+        for i in range(CassandraPool.HEDGE_MIN_READS):
+            self.pool.get(key="a")
+            self.clock.advance(0.01 if i % 10 else 0.1)
+            self.requests.pop().callback("result")
+        self.assertEquals(self.pool.hedge_delay(), 10240 / 1000000.0)
+
+    def test_hedge_slow_read(self):
+        """Test that a read that is slow is sent on the other connection, and
+        that the first response is used"""
+        counts = [client.get.call_count for client in self.clients]
+        result = []
+        self.pool.get(key="a").addBoth(result.append)
+
+        self.clock.advance(0.011)
+        self.assertEquals([client.get.call_count for client in self.clients],
+                          [count + 1 for count in counts])
+
+        self.requests[1].callback("hedged result")
+        self.requests[0].callback("slow result")
+        self.assertEquals(result, ["hedged result"])
+        self.assertEquals([connection.outstanding for connection in self.pool.connections], [0, 0])
+
+    def test_fast_read(self):
+        """Test that a read that completes in time isn't hedged, and that
+        errors are passed on"""
+        result = []
+        self.pool.get(key="a").addErrback(result.append)
+        self.requests[0].errback(Exception("not found"))
+        self.assertEquals(str(result[0].value), "not found")
+
+        self.clock.advance(1)
+        self.assertEquals(len(self.requests), 1)
+
+    def test_writes_not_hedged(self):
+        """Test that writes are never hedged"""
+        self.pool.insert(key="a", column_family="cf", value="v", column="c")
+        self.clock.advance(1)
+        self.assertEquals(sum(client.insert.call_count for client in self.clients), 1)
+
+    def test_no_history(self):
+        """Test that reads aren't hedged until there's a history of reads to
+        judge them against"""
+        self.clock.advance(CassandraPool.HEDGE_WINDOW * 2)
+        self.assertEquals(self.pool.hedge_delay(), None)
+
+        self.pool.get(key="a")
+        self.clock.advance(1)
+        self.assertEquals(len(self.requests), 1)
+
+
+class TestHARequests(CassandraPoolTestCase):
+
+    def setUp(self):
+        CassandraPoolTestCase.setUp(self)
+        self.clock = Clock()
+        self.reactor.callLater.side_effect = self.clock.callLater
+        patcher = patch.object(cassandrapool, "monotonic", self.clock.seconds)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.pool = CassandraPool("homer", size=2, client_class=self.client_class)
+
+    def test_fallback(self):
+        """Test that requests are retried at ONE if LOCAL_QUORUM is
+        unavailable"""
+        result = []
+        self.pool.ha_get(key="a", column_family="cf").addCallback(result.append)
+        self.requests[0].errback(UnavailableException())
+        self.requests[1].callback("result")
+
+        self.assertEquals(result, ["result"])
+        consistencies = [call[1]["consistency"]
+                         for client in self.clients
+                         for call in client.get.call_args_list]
+        self.assertEquals(sorted(consistencies),
+                          sorted([ConsistencyLevel.LOCAL_QUORUM, ConsistencyLevel.ONE]))
+
+    @patch("metaswitch.crest.settings.CASS_REQUEST_TIMEOUT", 1)
+    def test_timeout_retry(self):
+        """Test that a read that times out is retried on another connection,
+        and that the stuck connection is avoided until it responds"""
+        result = []
+        self.pool.ha_get(key="a", column_family="cf").addCallback(result.append)
+        self.clock.advance(1)
+
+        self.assertEquals([client.get.call_count for client in self.clients], [1, 1])
+        self.assertEquals([connection.outstanding for connection in self.pool.connections], [1, 1])
+        self.requests[1].callback("result")
+        self.assertEquals(result, ["result"])
+
+        # The late response to the first read is dropped.
+        self.requests[0].callback("late result")
+        self.assertEquals(result, ["result"])
+
+    @patch("metaswitch.crest.settings.CASS_REQUEST_TIMEOUT", 1)
+    def test_write_timeout(self):
+        """Test that writes that time out aren't retried"""
+        for client in self.clients:
+            client.remove.side_effect = lambda *args, **kwargs: self.request()
+        result = []
+        self.pool.ha_remove(key="a", column_family="cf").addErrback(result.append)
+        self.clock.advance(1)
+
+        self.assertTrue(result[0].check(TimedOutException))
+        self.assertEquals(sum(client.remove.call_count for client in self.clients), 1)
+
+    def test_cassandra_timeout_retry(self):
+        """Test that a read that Cassandra times out is retried"""
+        result = []
+        self.pool.ha_get(key="a", column_family="cf").addCallback(result.append)
+        self.requests[0].errback(TimedOutException())
+        self.requests[1].callback("result")
+        self.assertEquals(result, ["result"])
+
+    @patch("metaswitch.crest.settings.CASS_REQUEST_TIMEOUT", 1)
+    @patch("metaswitch.crest.settings.CASS_READ_RETRIES", 0)
+    @patch.object(passthrough.PassthroughHandler, "cass_clients", {})
+    def test_timeout_response(self):
+        """Test that a handler answers a request that times out with a 503,
+        rather than treating the timeout as an uncaught exception"""
+        passthrough.PassthroughHandler.add_cass_client("homer", self.pool)
+        handler = passthrough.PassthroughHandler(MagicMock(),
+                                                 MagicMock(),
+                                                 factory_name="homer",
+                                                 table="cf",
+                                                 column="col")
+        failures = []
+        handler.get("a").addErrback(failures.append)
+        self.clock.advance(1)
+
+        with patch.object(handler, "send_error") as send_error, \
+             patch("metaswitch.crest.api.base.utils.write_core_file") as write_core_file:
+            handler._handle_request_exception(failures[0])
+        send_error.assert_called_once_with(503)
+        self.assertFalse(write_core_file.called)
+
+    @patch("metaswitch.crest.settings.MULTIGET_BATCH_SIZE", 2)
+    def test_multiget_batches(self):
+        """Test that multiget_slice reads are split into batches, and the
+        results combined"""
+        for client in self.clients:
+            client.multiget_slice.side_effect = \
+                lambda keys, **kwargs: defer.succeed(dict((key, [key]) for key in keys))
+
+        result = []
+        self.pool.ha_multiget_slice(["a", "b", "c", "d", "e"], column_family="cf").addCallback(result.append)
+
+        keys = [call[0][0] for client in self.clients for call in client.multiget_slice.call_args_list]
+        self.assertEquals(sorted(keys), [["a", "b"], ["c", "d"], ["e"]])
+        self.assertEquals(result, [{"a": ["a"], "b": ["b"], "c": ["c"], "d": ["d"], "e": ["e"]}])
+
+    def test_latency_stats(self):
+        """Test that the latency of each type of request is recorded"""
+        with patch.object(cassandrapool, "request_latency_accumulator") as accumulator:
+            self.pool.get(key="a")
+            self.clock.advance(0.002)
+            self.requests[0].callback("result")
+            accumulator.accumulate.assert_called_once_with("homer get", 2000)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# @file cassandraring.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from mock import MagicMock
+
+from metaswitch.crest.api.cassandraring import random_token, TokenRing
+
+MURMUR3 = "org.apache.cassandra.dht.Murmur3Partitioner"
+
+
+def token_range(start, end, endpoints, datacenters=None):
+    """Returns a TokenRange as describe_ring does"""
+    rpc_endpoints = ["rpc-" + endpoint for endpoint in endpoints]
+    endpoint_details = None
+    if datacenters:
+        endpoint_details = [MagicMock(host=endpoint, datacenter=datacenter)
+                            for endpoint, datacenter in zip(endpoints, datacenters)]
+    return MagicMock(start_token=str(start),
+                     end_token=str(end),
+                     endpoints=endpoints,
+                     rpc_endpoints=rpc_endpoints,
+                     endpoint_details=endpoint_details)
+
+
+class TestTokens(unittest.TestCase):
+
+    def test_random(self):
+        """Test that RandomPartitioner tokens are the absolute MD5"""
+        token = random_token("sip:alice@example.com")
+        self.assertTrue(0 <= token < 2 ** 127)
+
+
+class TestTokenRing(unittest.TestCase):
+
+    def test_replicas(self):
+        """Test that each key is owned by the range that its token falls in,
+        and that the tokens after the last range wrap round"""
+        ring = TokenRing([token_range(0, 100, ["b"]),
+                          token_range(100, -100, ["a"]),
+                          token_range(-100, 0, ["c"])],
+                         MURMUR3)
+        ring.token_function = lambda key: int(key)
+
+        self.assertEquals(ring.replicas_for("-500"), ["rpc-a"])
+        self.assertEquals(ring.replicas_for("-100"), ["rpc-a"])
+        self.assertEquals(ring.replicas_for("-99"), ["rpc-c"])
+        self.assertEquals(ring.replicas_for("0"), ["rpc-c"])
+        self.assertEquals(ring.replicas_for("100"), ["rpc-b"])
+        self.assertEquals(ring.replicas_for("101"), ["rpc-a"])
+        self.assertEquals(ring.nodes, set(["rpc-a", "rpc-b", "rpc-c"]))
+
+    def test_unknown_partitioner(self):
+        """Test that we don't route keys if we don't know the partitioner"""
+        ring = TokenRing([token_range(0, 100, ["a"])],
+                         "org.apache.cassandra.dht.ByteOrderedPartitioner")
+        self.assertEquals(ring.replicas_for("key"), None)
+
+    def test_datacenters(self):
+        """Test that only replicas in the local datacenters are used"""
+        ranges = [token_range(0, 100, ["a", "x"], ["site1", "site2"]),
+                  token_range(100, 0, ["b", "y"], ["site1", "site2"])]
+        self.assertEquals(TokenRing.datacenters(ranges, ["rpc-b"]), set(["site1"]))
+        self.assertEquals(TokenRing.datacenters(ranges, ["127.0.0.1"]), set())
+
+        ring = TokenRing(ranges, MURMUR3, set(["site1"]))
+        self.assertEquals(ring.nodes, set(["rpc-a", "rpc-b"]))
+
+    def test_wildcard_rpc_address(self):
+        """Test that nodes listening for clients on all addresses are
+        identified by their listen addresses"""
+        wildcard = token_range(0, 100, ["a"])
+        wildcard.rpc_endpoints = ["0.0.0.0"]
+        ring = TokenRing([wildcard], MURMUR3)
+        self.assertEquals(ring.nodes, set(["a"]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+# @file histogram.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from metaswitch.crest.api.histogram import LatencyHistogram
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        """Test each value is in a bucket whose limits contain it, and that
+        the buckets are within 1/16th of the values in them"""
+        for value in range(0, 100000, 7) + [2**25, 2**26 - 1]:
+            index = LatencyHistogram.bucket_index(value)
+            self.assertTrue(value < LatencyHistogram.bucket_limit(index))
+            self.assertTrue(LatencyHistogram.bucket_limit(index) <= value + value / 16 + 1)
+            if index > 0:
+                self.assertTrue(value >= LatencyHistogram.bucket_limit(index - 1))
+
+    def test_large_values(self):
+        """Test very large values go in the last bucket"""
+        self.assertEquals(LatencyHistogram.bucket_index(10**12),
+                          LatencyHistogram.NUM_BUCKETS - 1)
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        self.assertEquals(histogram.percentile(90), 0)
+
+        for value in range(1, 1001):
+            histogram.record(value * 100)
+
+        self.assertTrue(50000 <= histogram.percentile(50) <= 50000 * 17 / 16)
+        self.assertTrue(90000 <= histogram.percentile(90) <= 90000 * 17 / 16)
+        self.assertTrue(99000 <= histogram.percentile(99) <= 99000 * 17 / 16)
+
+    def test_merge(self):
+        histogram1 = LatencyHistogram()
+        histogram2 = LatencyHistogram()
+        for value in range(1, 101):
+            histogram1.record(value)
+            histogram2.record(value + 100)
+
+        histogram1.merge(histogram2)
+        self.assertEquals(histogram1.count, 200)
+        self.assertTrue(100 <= histogram1.percentile(50) <= 100 * 17 / 16)
+
+    def test_sparse(self):
+        histogram = LatencyHistogram()
+        for value in [3, 3, 1000, 2**30]:
+            histogram.record(value)
+
+        sparse = histogram.sparse()
+        self.assertEquals(len(sparse), 3)
+        copy = LatencyHistogram.from_sparse(sparse)
+        self.assertEquals(copy.buckets, histogram.buckets)
+        self.assertEquals(copy.count, 4)
+
+    def test_invalid_sparse(self):
+        """Test that buckets that are out of range are rejected"""
+        for buckets in [[(-1, 1)],
+                        [(LatencyHistogram.NUM_BUCKETS, 1)],
+                        [(0, 1), (1, -1)]]:
+            self.assertRaises(ValueError, LatencyHistogram.from_sparse, buckets)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+# @file lastvaluecache.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+import zmq
+from mock import patch, MagicMock
+
+from metaswitch.crest.api import lastvaluecache
+from metaswitch.crest.api.lastvaluecache import LastValueCache, SocketReader
+
+
+class FakeSocket(object):
+    """ZMQ socket with messages waiting to be read"""
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.sent = []
+
+    def getsockopt(self, option):
+        if option == zmq.EVENTS:
+            return zmq.POLLIN if self.messages else 0
+        return 42
+
+    def recv_multipart(self, flags=0):
+        return self.messages.pop(0)
+
+    def send_multipart(self, msg):
+        self.sent.append(msg)
+
+
+class TestSocketReader(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(lastvaluecache, "reactor", MagicMock())
+        self.reactor = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_all(self):
+        """Test that every message waiting is read each time the socket's
+        file descriptor is readable"""
+        socket = FakeSocket([["a"], ["b"]])
+        received = []
+        reader = SocketReader(socket, received.append)
+
+        reader.start()
+        self.reactor.addReader.assert_called_once_with(reader)
+        self.assertEquals(reader.fileno(), 42)
+
+        reader.doRead()
+        self.assertEquals(received, [["a"], ["b"]])
+
+        socket.messages.append(["c"])
+        reader.doRead()
+        self.assertEquals(received, [["a"], ["b"], ["c"]])
+
+    def test_stop(self):
+        """Test that a stopped reader reads nothing more"""
+        socket = FakeSocket([["a"]])
+        received = []
+        reader = SocketReader(socket, received.append)
+
+        reader.start()
+        reader.stop()
+        self.reactor.removeReader.assert_called_once_with(reader)
+        reader.doRead()
+        self.assertEquals(received, [])
+
+    def test_forward(self):
+        """Test that stats are cached and forwarded to subscribers, and that
+        the broadcaster is checked for subscriptions after sending"""
+        cache = LastValueCache("test")
+        cache.broadcaster = FakeSocket([])
+        cache.broadcaster_reader = MagicMock()
+
+        cache.on_stat(["P_latency_us_1", "OK", "1"])
+        cache.on_subscription(["\x01P_latency_us_1"])
+        cache.on_subscription(["\x01P_queue_size_1"])
+        cache.on_subscription(["\x00P_latency_us_1"])
+
+        self.assertEquals(cache.broadcaster.sent,
+                          [["P_latency_us_1", "OK", "1"],
+                           ["P_latency_us_1", "OK", "1"],
+                           ["P_queue_size_1", "OK"]])
+        self.assertEquals(cache.broadcaster_reader.check.call_count, 3)
+
+    def test_merge_sketches(self):
+        """Test that the parent merges the histograms from each process into
+        percentiles for the whole node, ignoring old ones"""
+        cache = LastValueCache("test")
+        cache.broadcaster = FakeSocket([])
+        cache.broadcaster_reader = MagicMock()
+        time = [100]
+
+        with patch.object(lastvaluecache, "monotonic", lambda: time[0]):
+            # Process 1 has 10 requests of 3us, and process 2 has 90 of 5us.
+            cache.on_stat(["P_latency_sketch_us_1", "OK", "3", "10"])
+            time[0] += 1
+            cache.on_stat(["P_latency_sketch_us_2", "OK", "5", "90"])
+            time[0] += lastvaluecache.SKETCH_TIMEOUT
+            cache.on_stat(["P_latency_sketch_us_2", "OK", "5", "45"])
+
+        self.assertEquals(cache.broadcaster.sent,
+                          [["P_node_latency_percentiles_us", "OK", "10", "4", "4", "4"],
+                           ["P_node_latency_percentiles_us", "OK", "100", "6", "6", "6"],
+                           ["P_node_latency_percentiles_us", "OK", "45", "6", "6", "6"]])
+        self.assertEquals(cache.cache["P_node_latency_percentiles_us"],
+                          ["P_node_latency_percentiles_us", "OK", "45", "6", "6", "6"])
+
+    def test_invalid_sketch(self):
+        """Test that invalid histograms are ignored"""
+        cache = LastValueCache("test")
+        cache.broadcaster = FakeSocket([])
+        cache.on_stat(["P_latency_sketch_us_1", "OK", "3"])
+        cache.on_stat(["P_latency_sketch_us_1", "OK", "x", "1"])
+        cache.on_stat(["P_latency_sketch_us_1", "OK", "-1", "1"])
+        self.assertEquals(cache.broadcaster.sent, [])
+
+    @patch.object(lastvaluecache, "reactor", MagicMock())
+    @patch("zmq.Context")
+    def test_load_state_address(self, context):
+        """Test that each service forwards load reports on its own address,
+        so that services on the same node don't see each other's load"""
+        sockets = []
+        def socket(socket_type):
+            sockets.append(MagicMock())
+            return sockets[-1]
+        context.return_value.socket.side_effect = socket
+
+        addresses = []
+        for process_name in ["homer", "homestead-prov"]:
+            del sockets[:]
+            cache = LastValueCache(process_name)
+            cache.bind(0, 2)
+            cache.listen_for_load_state(MagicMock())
+            cache.load_broadcaster.bind.assert_called_once_with(cache.load_state_address)
+            cache.load_subscriber.connect.assert_called_once_with(cache.load_state_address)
+            addresses.append(cache.load_state_address)
+
+        self.assertNotEquals(addresses[0], addresses[1])
+
+    def test_forward_load_state(self):
+        """Test that the parent forwards its own service's load reports, but
+        not those of other services publishing on the same stats socket"""
+        cache = LastValueCache("homer")
+        cache.broadcaster = FakeSocket([])
+        cache.load_broadcaster = FakeSocket([])
+
+        own = ["crest_load_state_homer_1", "OK", "", "0.1", "5", "0"]
+        other = ["crest_load_state_homestead-prov_1", "OK", "", "9.9", "5", "0"]
+        cache.on_stat(own)
+        cache.on_stat(other)
+
+        self.assertEquals(cache.load_broadcaster.sent, [own])
+        self.assertEquals(cache.broadcaster.sent, [])
+
+    def test_listen_for_load_state(self):
+        """Test that each process is told the load of its peers in the same
+        service, but not its own load or that of other services"""
+        cache = LastValueCache("homer")
+        cache.p_id = 1
+        cache.context = MagicMock()
+        callback = MagicMock()
+        with patch.object(cache, "read") as read:
+            cache.listen_for_load_state(callback)
+        on_load_state = read.call_args[0][1]
+
+        on_load_state(["crest_load_state_homer_2", "OK", "hss", "0.1", "5", "1"])
+        on_load_state(["crest_load_state_homer_1", "OK", "", "0.2", "5", "0"])
+        on_load_state(["crest_load_state_homestead-prov_2", "OK", "", "9.9", "5", "0"])
+        on_load_state(["crest_load_state_homer_x", "OK", "", "0.1", "5", "0"])
+
+        callback.assert_called_once_with(2, "hss", 0.1, 5, 1)
+
+if __name__ == "__main__":
+    unittest.main()
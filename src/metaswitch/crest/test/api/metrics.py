@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+# @file metrics.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from mock import patch, MagicMock
+
+from metaswitch.crest.api import base, metrics
+from metaswitch.crest.api.statistics import Accumulator, Counter, LabelledCollector
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch("metaswitch.crest.settings.PROCESS_NAME", "homestead-prov")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_render(self):
+        """Test that the stats from every process are rendered"""
+        collectors = [Counter("P_incoming_requests", register=False),
+                      Accumulator("P_latency_us", register=False)]
+        cache = {"P_incoming_requests_0": ["P_incoming_requests_0", "OK", "5"],
+                 "P_incoming_requests_1": ["P_incoming_requests_1", "OK", "7"],
+                 "P_latency_us_1": ["P_latency_us_1", "OK", "7", "100.5", "4", "99", "102"],
+                 "P_latency_us_2": ["P_latency_us_2", "OK"],
+                 "P_node_latency_percentiles_us": ["P_node_latency_percentiles_us", "OK", "12", "96", "104", "104"]}
+
+        lines = metrics.render_metrics(cache, collectors).splitlines()
+        self.assertEquals(lines[:3],
+                          ['# TYPE homestead_prov_incoming_requests_count gauge',
+                           'homestead_prov_incoming_requests_count{process="0"} 5.0',
+                           'homestead_prov_incoming_requests_count{process="1"} 7.0'])
+        self.assertIn('homestead_prov_latency_us_mean{process="1"} 100.5', lines)
+        self.assertIn('homestead_prov_node_latency_percentiles_us_p99 104.0', lines)
+        self.assertEquals(len([line for line in lines if not line.startswith("#")]), 11)
+
+    def test_labelled(self):
+        """Test that labelled stats are rendered with their labels"""
+        collector = LabelledCollector("P_endpoint_rejected_overload", Counter, 10)
+        base.statistics.collectors.remove(collector)
+        cache = {"P_endpoint_rejected_overload_1":
+                 ["P_endpoint_rejected_overload_1", "OK", 'PUT "IRS"', "3", "other", "1"]}
+
+        lines = metrics.render_metrics(cache, [collector]).splitlines()
+        self.assertEquals(lines,
+                          ['# TYPE homestead_prov_endpoint_rejected_overload_count gauge',
+                           'homestead_prov_endpoint_rejected_overload_count{label="PUT \\"IRS\\"",process="1"} 3.0',
+                           'homestead_prov_endpoint_rejected_overload_count{label="other",process="1"} 1.0'])
+
+    def test_load_monitors(self):
+        """Test that the state of the load monitors is published and rendered
+        as counters and gauges"""
+        collector = base.LoadMonitorCollector("P_load_monitors", register=False)
+        with patch.object(base, "_load_monitors", {}):
+            values = collector.values(5)
+        self.assertEquals(values[0], "default")
+        self.assertEquals(len(values), len(collector.FIELDS) + 1)
+
+        cache = {"P_load_monitors_0": ["P_load_monitors_0", "OK"] + [str(value) for value in values]}
+        output = metrics.render_metrics(cache, [collector])
+        self.assertIn("# TYPE homestead_prov_load_monitors_accepted_total counter", output)
+        self.assertIn("# TYPE homestead_prov_load_monitors_rate gauge", output)
+
+
+class TestMetricsHandler(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch("metaswitch.crest.settings.PROCESS_NAME", "homer")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get(self):
+        """Test that the handler returns the cached stats of the registered
+        collectors in the Prometheus text format"""
+        collector = Counter("P_incoming_requests", register=False)
+        cache = {"P_incoming_requests_1": ["P_incoming_requests_1", "OK", "3"]}
+
+        handler = metrics.MetricsHandler(MagicMock(), MagicMock())
+        with patch.object(base.zmq, "cache", cache), \
+             patch.object(base.statistics, "collectors", [collector]), \
+             patch.object(handler, "finish") as finish:
+            handler.get()
+
+        self.assertEquals(handler._headers["Content-Type"], "text/plain; version=0.0.4")
+        self.assertEquals(finish.call_args[0][0],
+                          '# TYPE homer_incoming_requests_count gauge\n'
+                          'homer_incoming_requests_count{process="1"} 3.0\n')
+
+    def test_application(self):
+        """Test that the metrics are served at /metrics"""
+        application = metrics.create_application()
+        handlers = dict((spec.regex.pattern, spec.handler_class)
+                        for (_, specs) in application.handlers
+                        for spec in specs)
+        self.assertEquals(handlers["/metrics$"], metrics.MetricsHandler)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+#!/usr/bin/python
+
+# @file murmur3.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from metaswitch.crest.api import murmur3
+
+
+class TestMurmur3(unittest.TestCase):
+
+    def test_tokens(self):
+        """Test tokens match those Cassandra's Murmur3Partitioner gives"""
+        self.assertEquals(murmur3.token("123"), -7468325962851647638)
+        self.assertEquals(murmur3.token("\x00\xff\x10\xfa\x99" * 10), 5837342703291459765)
+        self.assertEquals(murmur3.token("\xfe" * 8), -8927430733708461935)
+        self.assertEquals(murmur3.token("\x10" * 8), 1446172840243228796)
+        self.assertEquals(murmur3.token("9223372036854775807"), 7162290910810015547)
+        self.assertEquals(murmur3.token("sip:alice@example.com"), -4152130126973449979)
+        self.assertEquals(murmur3.token("\xff" * 17), -4128212798341382003)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -26,9 +26,9 @@ class TestPassthroughHandler(unittest.TestCase):
         unittest.TestCase.setUp(self)
         self.app = mock.MagicMock()
         self.request = mock.MagicMock()
-        self.factory = mock.MagicMock()
+        self.cass_client = mock.MagicMock()
 
-        passthrough.PassthroughHandler.add_cass_factory("factory", self.factory)
+        passthrough.PassthroughHandler.add_cass_client("factory", self.cass_client)
         self.handler = passthrough.PassthroughHandler(self.app,
                                                       self.request,
                                                       factory_name="factory",
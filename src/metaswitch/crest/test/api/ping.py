@@ -12,7 +12,6 @@
 import unittest
 import mock
 from twisted.internet.defer import fail
-import telephus.protocol
 
 from metaswitch.crest.api import ping
 
@@ -30,27 +29,21 @@ class TestPingHandler(unittest.TestCase):
         self.request = mock.MagicMock()
         self.handler = ping.PingHandler(self.app, self.request)
 
-    @mock.patch('twisted.internet.defer.DeferredList',
-                autospec=True)
-    @mock.patch('metaswitch.crest.api.passthrough.PassthroughHandler',
-                autospec=True)
-    @mock.patch('telephus.protocol.ManagedCassandraClientFactory',
-                autospec=True)
-    def test_get_mainline(self,
-                          mock_client_factory,
-                          mock_passthrough_handler,
-                          mock_deferred_list):
+    @mock.patch.object(ping.PingHandler, 'cass_clients', [])
+    def test_get_mainline(self):
         """Test that the ping runs to completion in the mainline."""
 
         # Make sure there is at least one (fake) connection to Cassandra, to
-        # exercise the main logic, and check that only real methods are
-        # called.
-        ping.PingHandler.register_cass_factory(telephus.protocol.ManagedCassandraClientFactory())
-        mock_deferred_list.return_value = fail(Exception())
+        # exercise the main logic.  Cassandra rejects the request for the
+        # nonexistent key.
+        client = mock.MagicMock()
+        client.get.return_value = fail(Exception())
+        ping.PingHandler.register_cass_client(client)
 
         # Insert a mock so that we can extract the value that finish
         # was called with.
         with mock.patch.object(self.handler, 'finish') as mock_finish:
             self.handler.get()
 
+        client.get.assert_called_once_with(key='ping', column_family='ping')
         self.assertEquals(mock_finish.call_args[0][0], "OK")
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+# @file quorumbreaker.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from mock import patch, MagicMock
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from telephus.cassandra.ttypes import ConsistencyLevel, NotFoundException, UnavailableException
+
+from metaswitch.crest.api import cassandrapool, quorumbreaker
+from metaswitch.crest.api.quorumbreaker import QuorumBreaker
+
+
+class TestQuorumBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 100.0
+        patcher = patch.object(quorumbreaker, "monotonic", lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch("metaswitch.crest.settings.CASS_QUORUM_COOLDOWN", 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch.object(quorumbreaker, "_breakers", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.breaker = quorumbreaker.get_breaker("homer")
+
+    def unavailable(self, count):
+        for _ in range(count):
+            self.assertTrue(self.breaker.allow_quorum())
+            self.breaker.record_result(Failure(UnavailableException()))
+
+    def test_open(self):
+        """Test that LOCAL_QUORUM requests are skipped once several in a row
+        are unavailable"""
+        self.unavailable(QuorumBreaker.FAILURE_THRESHOLD - 1)
+        self.breaker.record_result("result")
+        self.unavailable(QuorumBreaker.FAILURE_THRESHOLD)
+
+        self.assertTrue(self.breaker.degraded)
+        self.assertFalse(self.breaker.allow_quorum())
+        self.assertFalse(self.breaker.allow_quorum())
+        self.assertEquals(self.breaker.total_skipped, 2)
+
+    def test_probe(self):
+        """Test that after the cooldown a single probe is let through, and that
+        the breaker closes if it succeeds"""
+        self.unavailable(QuorumBreaker.FAILURE_THRESHOLD)
+
+        self.time += 10
+        self.assertTrue(self.breaker.allow_quorum())
+        self.assertFalse(self.breaker.allow_quorum())
+        self.breaker.record_result(Failure(UnavailableException()))
+        self.assertTrue(self.breaker.degraded)
+
+        self.time += 10
+        self.assertTrue(self.breaker.allow_quorum())
+        self.breaker.record_result(Failure(NotFoundException()))
+        self.assertFalse(self.breaker.degraded)
+        self.assertTrue(self.breaker.allow_quorum())
+
+    def test_other_errors(self):
+        """Test that other errors don't affect the breaker"""
+        self.unavailable(QuorumBreaker.FAILURE_THRESHOLD - 1)
+        self.breaker.record_result(Failure(Exception("timed out")))
+        self.unavailable(1)
+        self.assertTrue(self.breaker.degraded)
+
+    def test_collector(self):
+        """Test that the state of each keyspace's breaker is published"""
+        quorumbreaker.get_breaker("homestead_cache")
+        self.unavailable(QuorumBreaker.FAILURE_THRESHOLD)
+        self.breaker.allow_quorum()
+
+        collector = quorumbreaker.QuorumBreakerCollector("P_test", register=False)
+        self.assertEquals(collector.values(5),
+                          ["homer", 1, 1, "homestead_cache", 0, 0])
+
+    @patch.object(cassandrapool, "reactor", MagicMock())
+    @patch.object(cassandrapool, "ManagedCassandraClientFactory", MagicMock())
+    def test_pool(self):
+        """Test that the pool fails LOCAL_QUORUM requests without sending them
+        while the breaker is open, but still sends requests at ONE"""
+        client = MagicMock()
+        client.get.side_effect = lambda *args, **kwargs: defer.fail(UnavailableException())
+        pool = cassandrapool.CassandraPool("homer", size=1, client_class=lambda factory: client)
+
+        for _ in range(QuorumBreaker.FAILURE_THRESHOLD + 1):
+            pool.get(key="a", consistency=ConsistencyLevel.LOCAL_QUORUM).addErrback(
+                lambda failure: failure.trap(UnavailableException))
+        self.assertEquals(client.get.call_count, QuorumBreaker.FAILURE_THRESHOLD)
+
+        client.get.side_effect = lambda *args, **kwargs: defer.succeed("result")
+        result = []
+        pool.get(key="a", consistency=ConsistencyLevel.ONE).addCallback(result.append)
+        self.assertEquals(result, ["result"])
+
+if __name__ == "__main__":
+    unittest.main()
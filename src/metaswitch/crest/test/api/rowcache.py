@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+# @file rowcache.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+from twisted.internet import defer
+from mock import patch, MagicMock
+
+from metaswitch.crest.api import base
+from metaswitch.crest.api.rowcache import RowCache, RowMemo
+
+
+class TestRowCache(unittest.TestCase):
+
+    def setUp(self):
+        # Mock out zmq so we don't fail if we try to report stats during the
+        # test.
+        self.real_zmq = base.zmq
+        base.zmq = MagicMock()
+
+        self.cache = RowCache(2, 10)
+        self.fetch = MagicMock(side_effect=lambda: defer.succeed(["column"]))
+
+    def tearDown(self):
+        base.zmq = self.real_zmq
+        del self.real_zmq
+
+    def read(self, key, predicate=None):
+        results = []
+        self.cache.read_through("ks", "table", key, predicate, self.fetch).addCallback(results.append)
+        return results[0]
+
+    def test_read_through(self):
+        """Test a row is only fetched once, and then served from the cache"""
+        self.assertEquals(self.read("row"), ["column"])
+        self.assertEquals(self.read("row"), ["column"])
+        self.assertEquals(self.fetch.call_count, 1)
+
+        # Reading the row with a different predicate is a different entry.
+        self.read("row", ("a", "b"))
+        self.assertEquals(self.fetch.call_count, 2)
+
+    def test_invalidate(self):
+        """Test all the entries for a row are removed when it is invalidated"""
+        self.read("row")
+        self.read("row", ("a",))
+        self.cache.invalidate("ks", "table", "row")
+        self.read("row")
+        self.read("row", ("a",))
+        self.assertEquals(self.fetch.call_count, 4)
+
+    def test_invalidate_during_read(self):
+        """Test a read that overlaps with an invalidation isn't cached"""
+        d = defer.Deferred()
+        self.cache.read_through("ks", "table", "row", None, lambda: d)
+        self.cache.invalidate("ks", "table", "row")
+        d.callback(["stale"])
+        self.assertEquals(self.read("row"), ["column"])
+
+    def test_expiry(self):
+        """Test entries are fetched again once their TTL has passed"""
+        with patch("metaswitch.crest.api.rowcache.monotonic", return_value=100):
+            self.read("row")
+            self.read("row")
+        with patch("metaswitch.crest.api.rowcache.monotonic", return_value=111):
+            self.read("row")
+        self.assertEquals(self.fetch.call_count, 2)
+
+    def test_eviction(self):
+        """Test the least recently used entry is evicted when the cache is
+        full"""
+        self.read("row1")
+        self.read("row2")
+        self.read("row1")
+        self.read("row3")
+
+        # row2 was least recently used, so has been evicted.
+        self.read("row1")
+        self.read("row3")
+        self.assertEquals(self.fetch.call_count, 3)
+        self.read("row2")
+        self.assertEquals(self.fetch.call_count, 4)
+
+
+class TestRowMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.memo = RowMemo()
+        self.row = [MagicMock(), MagicMock()]
+        self.row[0].column.name = "a"
+        self.row[1].column.name = "b"
+        self.fetch = MagicMock(side_effect=lambda: defer.succeed(self.row))
+
+    def read(self, key, predicate=None):
+        results = []
+        self.memo.read_through("ks", "table", key, predicate, self.fetch).addCallback(results.append)
+        return results[0]
+
+    def test_read_through(self):
+        """Test a row is only fetched once"""
+        self.assertEquals(self.read("row"), self.row)
+        self.assertEquals(self.read("row"), self.row)
+        self.read("row2")
+        self.assertEquals(self.fetch.call_count, 2)
+
+    def test_named_columns_from_whole_row(self):
+        """Test a read of named columns is served from a read of the whole
+        row"""
+        self.read("row")
+        self.assertEquals(self.read("row", ("b",)), [self.row[1]])
+        self.assertEquals(self.fetch.call_count, 1)
+
+    def test_invalidate(self):
+        """Test a row is fetched again once it has been invalidated"""
+        self.read("row")
+        self.read("row", ("a",))
+        self.memo.invalidate("ks", "table", "row")
+        self.read("row", ("a",))
+        self.assertEquals(self.fetch.call_count, 2)
+
+if __name__ == "__main__":
+    unittest.main()
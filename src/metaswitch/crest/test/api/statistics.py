@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+# @file statistics.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from mock import call, patch, MagicMock
+from twisted.internet.task import Clock
+
+from metaswitch.crest.api import base, statistics
+from metaswitch.crest.api.statistics import Accumulator, Counter, LabelledCollector, PercentileAccumulator
+
+
+class TestStatistics(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 100.0
+        patcher = patch("metaswitch.crest.api.statistics.monotonic", lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch.object(base, "zmq", MagicMock())
+        self.zmq = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_accumulator(self):
+        """Test that an Accumulator publishes its stats, normalised to the
+        period, and then starts again"""
+        accumulator = Accumulator("P_test", register=False)
+        accumulator.accumulate(10)
+        accumulator.accumulate(30)
+        self.assertFalse(self.zmq.report.called)
+
+        self.time += statistics.STATS_PERIOD * 2
+        accumulator.publish()
+        self.zmq.report.assert_called_once_with([1, 20, 100, 10, 30], "P_test")
+        self.assertEquals(accumulator.current, 0)
+
+    def test_accumulator_precision(self):
+        """Test that an Accumulator's variance is accurate for large values"""
+        accumulator = Accumulator("P_test", register=False)
+        for value in [10**9 + 1, 10**9 + 2, 10**9 + 3]:
+            accumulator.accumulate(value)
+
+        self.time += statistics.STATS_PERIOD
+        (n, mean, variance, lwm, hwm) = accumulator.values(statistics.STATS_PERIOD)
+        self.assertEquals(mean, 10**9 + 2)
+        self.assertAlmostEqual(variance, 2.0 / 3)
+
+    def test_sketch(self):
+        """Test that a PercentileAccumulator can also publish its histogram"""
+        accumulator = PercentileAccumulator("P_test", register=False, sketch_name="P_sketch")
+        accumulator.set_process_id(2)
+        for value in [3, 3, 5]:
+            accumulator.accumulate(value)
+
+        self.time += statistics.STATS_PERIOD
+        accumulator.publish()
+        self.assertEquals(self.zmq.report.call_args_list,
+                          [call([3, 2, 5, 1], "P_sketch_2"),
+                           call([3, 4, 6, 6], "P_test_2")])
+
+    def test_publish_every_period(self):
+        """Test that all the collectors are published every period, even if
+        there haven't been any events"""
+        clock = Clock()
+        counter = Counter("P_test")
+        self.addCleanup(statistics.collectors.remove, counter)
+
+        with patch.object(statistics._publisher, "clock", clock), \
+             patch.object(statistics, "collectors", [counter]):
+            statistics.start_publishing()
+            counter.increment()
+
+            self.time += statistics.STATS_PERIOD
+            clock.advance(statistics.STATS_PERIOD)
+            self.time += statistics.STATS_PERIOD
+            clock.advance(statistics.STATS_PERIOD)
+            statistics.stop_publishing()
+
+        self.assertEquals(self.zmq.report.call_args_list,
+                          [call([1], "P_test"), call([0], "P_test")])
+
+    def test_labelled_collector(self):
+        """Test that a LabelledCollector publishes a table of the stat for each
+        label"""
+        collector = LabelledCollector("P_test", Accumulator, 10)
+        self.assertIn(collector, statistics.collectors)
+        statistics.collectors.remove(collector)
+
+        collector.accumulate("PUT IRSHandler", 10)
+        collector.accumulate("GET IRSHandler", 20)
+        collector.accumulate("PUT IRSHandler", 30)
+
+        self.time += statistics.STATS_PERIOD * 2
+        collector.publish()
+        self.zmq.report.assert_called_once_with(
+            ["GET IRSHandler", 0.5, 20, 0, 20, 20,
+             "PUT IRSHandler", 1, 20, 100, 10, 30],
+            "P_test")
+        self.assertEquals(collector.labels, {})
+
+    def test_max_labels(self):
+        """Test that labels over the limit are counted together"""
+        collector = LabelledCollector("P_test", Counter, 2)
+        statistics.collectors.remove(collector)
+
+        for label in ["a", "b", "c", "a", "d"]:
+            collector.increment(label)
+
+        self.time += statistics.STATS_PERIOD * 2
+        collector.publish()
+        self.zmq.report.assert_called_once_with(["a", 2, "b", 1, "other", 2], "P_test")
+
+    def test_no_labels(self):
+        """Test that a LabelledCollector with no labels publishes an empty
+        table"""
+        collector = LabelledCollector("P_test", Counter, 2)
+        statistics.collectors.remove(collector)
+
+        self.time += statistics.STATS_PERIOD + 1
+        collector.publish()
+        self.zmq.report.assert_called_once_with([], "P_test")
+
+if __name__ == "__main__":
+    unittest.main()
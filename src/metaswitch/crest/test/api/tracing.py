@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+# @file tracing.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import json
+import unittest
+
+from mock import patch, MagicMock
+from twisted.internet import defer
+
+from metaswitch.crest import api
+from metaswitch.crest.api import metrics, tracing
+
+
+class TestRequestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 100
+        patcher = patch("metaswitch.crest.api.tracing.monotonic", lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tracing.recent_traces.clear()
+
+    def test_spans(self):
+        """Test that spans are recorded with their start (relative to the
+        request) and duration, and are totalled by stage"""
+        trace = tracing.RequestTrace()
+
+        self.time = 101
+        with trace.span("read"):
+            self.time = 103
+
+        d = defer.Deferred()
+        trace.time("read", d)
+        self.time = 104
+        d.callback(None)
+
+        self.assertEquals(trace.spans, [("read", 1, 2), ("read", 3, 1)])
+        self.assertEquals(trace.stages(), {"read": (2, 3)})
+
+    def test_span_exception(self):
+        """Test that a span is recorded even if the stage fails"""
+        trace = tracing.RequestTrace()
+        try:
+            with trace.span("write"):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEquals(trace.stages(), {"write": (1, 0)})
+
+    def test_finish(self):
+        """Test that finished traces are kept for /debug/traces"""
+        trace = tracing.RequestTrace()
+        with trace.span("read"):
+            self.time = 100.5
+
+        with patch("metaswitch.crest.api.tracing._log") as log:
+            trace.finish("GET", "/irs", 200, 0.5)
+
+        self.assertTrue(log.info.called)
+        self.assertEquals(list(tracing.recent_traces),
+                          [{"method": "GET",
+                            "uri": "/irs",
+                            "status": 200,
+                            "latency_us": 500000,
+                            "spans": [{"name": "read", "start_us": 0, "duration_us": 500000}],
+                            "stages": {"read": {"count": 1, "total_us": 500000}}}])
+
+    def test_sampling(self):
+        """Test that only the configured fraction of requests are traced"""
+        with patch("metaswitch.crest.settings.TRACE_SAMPLE_RATE", 0):
+            self.assertIs(tracing.start_trace(), tracing.NO_TRACE)
+
+        with patch("metaswitch.crest.settings.TRACE_SAMPLE_RATE", 1):
+            self.assertIsInstance(tracing.start_trace(), tracing.RequestTrace)
+
+    def test_no_trace(self):
+        """Test that requests that aren't traced aren't affected"""
+        d = defer.Deferred()
+        self.assertIs(tracing.NO_TRACE.time("read", d), d)
+        with tracing.NO_TRACE.span("read"):
+            pass
+        tracing.NO_TRACE.finish("GET", "/irs", 200, 0.5)
+        self.assertEquals(len(tracing.recent_traces), 0)
+
+
+class TestTracesHandler(unittest.TestCase):
+
+    def setUp(self):
+        tracing.recent_traces.clear()
+
+    def test_get(self):
+        """Test that the recent traces are returned newest first"""
+        tracing.recent_traces.append({"uri": "/old"})
+        tracing.recent_traces.append({"uri": "/new"})
+
+        handler = tracing.TracesHandler(MagicMock(), MagicMock())
+        with patch.object(handler, "finish") as finish:
+            handler.get()
+
+        self.assertEquals(handler._headers["Content-Type"], "application/json")
+        self.assertEquals(json.loads(finish.call_args[0][0]),
+                          {"traces": [{"uri": "/new"}, {"uri": "/old"}]})
+
+    def test_local_only(self):
+        """Test that traces are only served with the metrics, and not on the
+        main API"""
+        self.assertNotIn(tracing.TracesHandler,
+                         [handler for (_, handler) in api.ROUTES])
+
+        application = metrics.create_application()
+        handlers = [spec.handler_class
+                    for (_, specs) in application.handlers
+                    for spec in specs]
+        self.assertIn(tracing.TracesHandler, handlers)
+
+if __name__ == "__main__":
+    unittest.main()
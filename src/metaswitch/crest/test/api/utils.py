@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+# @file utils.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+
+import unittest
+
+from twisted.internet import defer
+from telephus.cassandra.ttypes import NotFoundException
+
+from metaswitch.crest.api import utils
+
+
+class TestMapConcurrently(unittest.TestCase):
+
+    def setUp(self):
+        # The Deferred of each call that hasn't completed yet, by item.
+        self.outstanding = {}
+        self.max_outstanding = 0
+
+    def call(self, item):
+        d = defer.Deferred()
+        self.outstanding[item] = d
+        self.max_outstanding = max(self.max_outstanding, len(self.outstanding))
+        return d
+
+    def complete(self, item, result):
+        self.outstanding.pop(item).callback(result)
+
+    def test_limit(self):
+        """Test that at most `limit` calls are outstanding at once, and that
+        the results are in the order of the items"""
+        results = []
+        utils.map_concurrently(self.call, range(5), 2).addCallback(results.append)
+        self.assertEquals(sorted(self.outstanding.keys()), [0, 1])
+
+        # Complete the calls out of order.
+        self.complete(1, "one")
+        self.assertEquals(sorted(self.outstanding.keys()), [0, 2])
+        for item in [2, 0, 4, 3]:
+            self.complete(item, str(item))
+
+        self.assertEquals(self.max_outstanding, 2)
+        self.assertEquals(results, [["0", "one", "2", "3", "4"]])
+
+    def test_failure(self):
+        """Test that a failed call fails the result with its own exception"""
+        failures = []
+        utils.map_concurrently(self.call, range(3), 2).addErrback(failures.append)
+        self.outstanding.pop(0).errback(NotFoundException())
+        self.complete(1, "one")
+        self.complete(2, "two")
+
+        self.assertEquals(len(failures), 1)
+        self.assertTrue(failures[0].check(NotFoundException))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,12 +8,9 @@
 # Metaswitch Networks in a separate written agreement.
 
 
-from twisted.internet import reactor
-from telephus.protocol import ManagedCassandraClientFactory
-
+from metaswitch.crest.api.cassandrapool import CassandraPool
 from metaswitch.crest.api.passthrough import PassthroughHandler
 from metaswitch.crest.api.ping import PingHandler
-from metaswitch.crest import settings
 from metaswitch.homer import routes
 
 # Routes for application
@@ -21,9 +18,6 @@ ROUTES = routes.get_routes()
 
 def initialize(application):
     """Module initialization"""
-    factory = ManagedCassandraClientFactory("homer")
-    reactor.connectTCP(settings.CASS_HOST,
-                       settings.CASS_PORT,
-                       factory)
-    PassthroughHandler.add_cass_factory("homer", factory)
-    PingHandler.register_cass_factory(factory)
+    pool = CassandraPool("homer")
+    PassthroughHandler.add_cass_client("homer", pool)
+    PingHandler.register_cass_client(pool)
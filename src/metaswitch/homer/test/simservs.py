@@ -170,11 +170,11 @@ class TestSimservsHandler(unittest.TestCase):
         unittest.TestCase.setUp(self)
         self.app = mock.MagicMock()
         self.request = mock.MagicMock()
-        self.factory = mock.MagicMock()
+        self.cass_client = mock.MagicMock()
 
         self.schema_path = os.path.join(SCHEMA_DIR, 'simservs/mmtel.xsd')
         self.handler_class = validator.create_handler(self.schema_path)
-        self.handler_class.add_cass_factory("homer", self.factory)
+        self.handler_class.add_cass_client("homer", self.cass_client)
 
         self.handler = self.handler_class(self.app,
                                           self.request,
@@ -16,6 +16,8 @@ from .provisioning.handlers.public import PublicIDServiceProfileHandler, PublicI
 from .cache.db import CacheModel
 from .provisioning.models import PrivateID, IRS, ServiceProfile, PublicID, ProvisioningModel
 from metaswitch.crest.api.ping import PingHandler
+from metaswitch.crest.api.rowcache import RowCache
+from metaswitch.crest import settings
 
 # Regex that matches any path element (covers anything that isn't a slash).
 ANY = '([^/]+)'
@@ -118,11 +120,16 @@ def initialize(application):
     application.cache = Cache()
     ProvisioningModel.register_cache(application.cache)
 
+    # Cache provisioning rows in this process if configured to.
+    if settings.PROVISIONING_ROW_CACHE_SIZE > 0:
+        ProvisioningModel.row_cache = RowCache(settings.PROVISIONING_ROW_CACHE_SIZE,
+                                               settings.PROVISIONING_ROW_CACHE_TTL)
+
     # Connect to the cache and provisioning databases. Register the cassandra
-    # factories with the PingHandler so that connectivity to cassandra is
+    # clients with the PingHandler so that connectivity to cassandra is
     # checked when crest is pinged.
     ProvisioningModel.start_connection()
-    PingHandler.register_cass_factory(ProvisioningModel.get_cass_factory())
+    PingHandler.register_cass_client(ProvisioningModel.client)
 
     CacheModel.start_connection()
-    PingHandler.register_cass_factory(CacheModel.get_cass_factory())
+    PingHandler.register_cass_client(CacheModel.client)
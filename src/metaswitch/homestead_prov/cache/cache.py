@@ -11,7 +11,8 @@ import logging
 import time
 
 from twisted.internet import defer
-from .db import IMPI, IMPU
+from .db import CacheModel, IMPI, IMPU
+from ..cassandra import merge_mutations
 from ..auth_vectors import DigestAuthVector
 from .. import authtypes
 _log = logging.getLogger("crest.api.homestead.cache")
@@ -88,6 +89,40 @@ class Cache(object):
                    (str(public_ids), xml))
         yield IMPU.put_multi_ims_subscription(public_ids, xml, ttl=ttl, timestamp=timestamp)
 
+    @defer.inlineCallbacks
+    def rebuild_entries(self, public_ids, xml, private_ids, timestamp, ttl=None):
+        """
+        Rewrite a set of related cache entries in a single batch.
+
+        Each public ID in `public_ids` is given the IMS subscription `xml` (no
+        public IDs are written if `xml` is None).  `private_ids` maps each
+        private ID to a tuple of its auth vector and the public IDs it can
+        authenticate, and replaces the private ID's existing entry.  All the
+        entries are written with the same timestamp, so the cache is kept
+        consistent with itself (see generate_timestamp).
+        """
+        _log.debug("Rebuild public IDs %s and private IDs %s in cache" %
+                   (str(public_ids), str(private_ids.keys())))
+
+        mutmaps = []
+        if xml is not None and public_ids:
+            mutmaps.append(IMPU.put_multi_ims_subscription_mutations(public_ids,
+                                                                     xml,
+                                                                     ttl=ttl,
+                                                                     timestamp=timestamp))
+
+        for private_id, (auth_vector, associated_public_ids) in private_ids.iteritems():
+            mutmaps.append(IMPI.rebuild_mutations(private_id,
+                                                  auth_vector.ha1,
+                                                  auth_vector.realm,
+                                                  auth_vector.qop,
+                                                  associated_public_ids,
+                                                  ttl=ttl,
+                                                  timestamp=timestamp))
+
+        if mutmaps:
+            yield CacheModel.ha_batch_mutate(merge_mutations(*mutmaps))
+
     @defer.inlineCallbacks
     def delete_private_id(self, private_id, timestamp):
         _log.debug("Delete private ID '%s' from cache" % private_id)
@@ -12,7 +12,7 @@ import logging
 
 from .. import config
 from metaswitch.crest import settings
-from ..cassandra import CassandraModel
+from ..cassandra import CassandraModel, merge_mutations
 from telephus.cassandra.ttypes import NotFoundException
 
 DIGEST_HA1 = "digest_ha1"
@@ -84,6 +84,23 @@ class IMPI(CacheModel):
     def delete_multi_private_ids(cls, private_ids, timestamp=None):
         yield cls.delete_rows(private_ids, timestamp=timestamp)
 
+    @classmethod
+    def rebuild_mutations(cls, private_id, ha1, realm, qop, public_ids, ttl=None, timestamp=None):
+        """Returns the mutations that replace the whole of a private ID's row
+        with the given digest and associated public IDs.  The existing row is
+        deleted 1ms before the timestamp of the new columns, so the new
+        columns survive the deletion."""
+        mapping = {DIGEST_HA1: ha1, DIGEST_REALM: realm, DIGEST_QOP: qop}
+        for public_id in public_ids:
+            mapping[PUBLIC_ID_PREFIX + public_id] = ""
+
+        return merge_mutations(
+            cls.delete_rows_mutations([private_id], timestamp=timestamp - 1000),
+            cls.modify_columns_multikeys_mutations([private_id],
+                                                   mapping,
+                                                   ttl=ttl,
+                                                   timestamp=timestamp))
+
 IMS_SUBSCRIPTION = "ims_subscription_xml"
 PRIMARY_CCF = "primary_ccf"
 
@@ -107,6 +124,14 @@ class IMPU(CacheModel):
                                   ttl=ttl,
                                   timestamp=timestamp)
 
+    @classmethod
+    def put_multi_ims_subscription_mutations(cls, public_ids, ims_subscription, ttl=None, timestamp=None):
+        return cls.modify_columns_multikeys_mutations(public_ids,
+                                                      {IMS_SUBSCRIPTION: ims_subscription,
+                                                       PRIMARY_CCF: settings.CCF},
+                                                      ttl=ttl,
+                                                      timestamp=timestamp)
+
     @classmethod
     @defer.inlineCallbacks
     def put_multi_ims_subscription(cls, public_ids, ims_subscription, ttl=None, timestamp=None):
@@ -7,49 +7,33 @@
 # Otherwise no rights are granted except for those provided to you by
 # Metaswitch Networks in a separate written agreement.
 
-import socket
 import logging
-from random import shuffle
-from twisted.internet import defer, reactor
-from metaswitch.crest.api import settings
-from telephus.protocol import ManagedCassandraClientFactory
-from telephus.client import CassandraClient, ConsistencyLevel
-from telephus.cassandra.ttypes import Column, Deletion, NotFoundException, UnavailableException
+from twisted.internet import defer
+from metaswitch.crest.api.cassandrapool import CassandraPool
+from metaswitch.crest.api.tracing import NO_TRACE
+from telephus.client import CassandraClient
+from telephus.cassandra.ttypes import Column, Deletion, NotFoundException
 
 _log = logging.getLogger("hsprov.cassandra")
 
 class CassandraConnection(object):
-    """Simple representation of a connection to a Cassandra keyspace"""
+    """Simple representation of a connection to a Cassandra keyspace (in fact,
+    a pool of connections)"""
     def __init__(self, keyspace):
         self._keyspace = keyspace
+        self.client = CassandraPool(keyspace, client_class=CassandraClient)
 
-        self.factory = ManagedCassandraClientFactory(keyspace)
-        host = settings.CASS_HOST.strip()
 
-        # Ensure that the host isn't blank
-        if host == '':
-            host = 'localhost'
-
-        addresses = socket.getaddrinfo(host, settings.CASS_PORT)
-
-        # If we are using IPv6, we need to provide an IPv6 address directly
-        # to twisted, as it doesn't support IPv6.
-
-        # addresses is a list of 5 tuple:
-        # (family, socktype, proto, cannonname, sockaddr)
-        shuffle(addresses)
-        if len(addresses) > 1 and addresses[0][0] == socket.AF_INET6:
-            # sockaddr is a 4 tuple:
-            # (address, port, flow, scope)
-            address = addresses[0][4][0]
-        else:
-            address = host
-
-        _log.debug("Cassandra is connecting to %s - for host %s",
-                   address, settings.CASS_HOST)
-
-        reactor.connectTCP(address, settings.CASS_PORT, self.factory)
-        self.client = CassandraClient(self.factory)
+def merge_mutations(*mutmaps):
+    """Combines several batch_mutate mutation maps into one, so that they can
+    be sent to Cassandra in a single request.  Mutations for the same row and
+    table are applied in the order the maps are passed in."""
+    merged = {}
+    for mutmap in mutmaps:
+        for key, cfmap in mutmap.iteritems():
+            for cf, mutations in cfmap.iteritems():
+                merged.setdefault(key, {}).setdefault(cf, []).extend(mutations)
+    return merged
 
 
 class CassandraModel(object):
@@ -61,6 +45,10 @@ class CassandraModel(object):
     # always present and we can query to tell if this is the case.
     EXISTS_COLUMN = "_exists"
 
+    # Read-through cache of rows in this model's tables (a RowCache), or None
+    # if rows should always be read from Cassandra.
+    row_cache = None
+
     @classmethod
     def start_connection(cls):
         """Connect to cassandra.
@@ -70,14 +58,20 @@ class CassandraModel(object):
         cls.cass_connection = CassandraConnection(cls.cass_keyspace)
         cls.client = cls.cass_connection.client
 
-    @classmethod
-    def get_cass_factory(cls):
-        return cls.cass_connection.factory
-
-    def __init__(self, row_key):
+    def __init__(self, row_key, memo=None):
         self.row_key = row_key
         self.row_key_str = str(row_key)
 
+        # The RowMemo of the request this model is being used for, if any.
+        # Any other models created by this one should share it.
+        self.memo = memo
+
+    @property
+    def trace(self):
+        """The trace of the request this model is being used for (from its
+        memo)"""
+        return self.memo.trace if self.memo is not None else NO_TRACE
+
     @defer.inlineCallbacks
     def get_columns(self, columns=None):
         """Gets the named columns from this row (or all columns if it is not
@@ -107,6 +101,34 @@ class CassandraModel(object):
 
         defer.returnValue(columns_as_dictionary)
 
+    @classmethod
+    @defer.inlineCallbacks
+    def get_columns_multikeys(cls, keys, columns=None):
+        """Gets the named columns (or all columns if it is not specified) from
+        a set of rows.  Returns a dictionary mapping the key of each row that
+        exists to its columns, formatted as for get_columns.
+
+        The rows are read using multiget_slice, in parallel batches (see
+        CassandraPool.ha_multiget_slice)."""
+        if columns:
+            columns = list(columns)
+            columns.append(cls.EXISTS_COLUMN)
+
+        result = yield cls.ha_multiget_slice(keys,
+                                             column_family=cls.cass_table,
+                                             names=columns)
+
+        rows = {}
+        for key, cass_columns in result.iteritems():
+            # Rows that don't exist come back with no columns.
+            if cass_columns:
+                row = {col.column.name: col.column.value
+                       for col in cass_columns}
+                row.pop(cls.EXISTS_COLUMN, None)
+                rows[key] = row
+
+        defer.returnValue(rows)
+
     @defer.inlineCallbacks
     def get_column_value(self, column):
         """Gets the value of a single named column"""
@@ -131,11 +153,16 @@ class CassandraModel(object):
         Returns the columns formatted as a dictionary,
         with the prefix stripped off the keys.
         Does not support super columns."""
-        mapping = yield self.get_columns_with_prefix(prefix)
-        new_mapping = {key[len(prefix):]: value
-                       for key, value in mapping.iteritems()
-                       if key.startswith(prefix)}
-        defer.returnValue(new_mapping)
+        columns = yield self.get_columns()
+        defer.returnValue(self.strip_column_prefix(columns, prefix))
+
+    @staticmethod
+    def strip_column_prefix(columns, prefix):
+        """Takes a dictionary of columns and returns those with the given
+        prefix, with the prefix stripped off the keys."""
+        return {key[len(prefix):]: value
+                for key, value in columns.iteritems()
+                if key.startswith(prefix)}
 
     @defer.inlineCallbacks
     def touch(self):
@@ -159,14 +186,22 @@ class CassandraModel(object):
                                    timestamp=timestamp)
 
 
+    @classmethod
+    def modify_columns_multikeys_mutations(cls, keys, mapping, ttl=None, timestamp=None):
+        """Returns the batch_mutate mutation map that updates a set of rows to
+        give the columns specified by the keys of `mapping` their respective
+        values.  This can be combined with other mutations using
+        merge_mutations."""
+        row = map(lambda x: Column(x, mapping[x], timestamp, ttl), mapping)
+        row.append(Column(cls.EXISTS_COLUMN, "", timestamp, ttl))
+        return {key: {cls.cass_table: row} for key in keys}
+
     @classmethod
     @defer.inlineCallbacks
     def modify_columns_multikeys(cls, keys, mapping, ttl=None, timestamp=None):
         """Updates a set of rows to give the columns specified by the keys of
         `mapping` their respective values."""
-        row = map(lambda x: Column(x, mapping[x], timestamp, ttl), mapping)
-        row.append(Column(cls.EXISTS_COLUMN, "", timestamp, ttl))
-        mutmap = {key: {cls.cass_table: row} for key in keys}
+        mutmap = cls.modify_columns_multikeys_mutations(keys, mapping, ttl, timestamp)
         yield cls.ha_batch_mutate(mutmap)
 
     @defer.inlineCallbacks
@@ -176,13 +211,17 @@ class CassandraModel(object):
                              column_family=self.cass_table,
                              timestamp=timestamp)
 
+    @classmethod
+    def delete_rows_mutations(cls, keys, timestamp=None):
+        """Returns the batch_mutate mutation map that deletes multiple rows"""
+        row = [Deletion(timestamp)]
+        return {key: {cls.cass_table: row} for key in keys}
+
     @classmethod
     @defer.inlineCallbacks
     def delete_rows(cls, keys, timestamp=None):
         """Delete multiple row"""
-        mutmap = {}
-        row = [Deletion(timestamp)]
-        mutmap = {key: {cls.cass_table: row} for key in keys}
+        mutmap = cls.delete_rows_mutations(keys, timestamp)
         yield cls.ha_batch_mutate(mutmap)
 
     @defer.inlineCallbacks
@@ -210,70 +249,115 @@ class CassandraModel(object):
 
         defer.returnValue(exists)
 
-    # After growing a cluster, Cassandra does not pro-actively populate the
-    # new nodes with their data (the nodes are expected to use `nodetool
-    # repair` if they need to get their data).
-    @defer.inlineCallbacks
     def ha_get(self, *args, **kwargs):
-        try:
-            kwargs['consistency'] = ConsistencyLevel.LOCAL_QUORUM
-            result = yield self.client.get(*args, **kwargs)
-            defer.returnValue(result)
-        except UnavailableException as e:
-            try:
-                kwargs['consistency'] = ConsistencyLevel.ONE
-                result = yield self.client.get(*args, **kwargs)
-                defer.returnValue(result)
-            except (NotFoundException, UnavailableException) as e:
-                raise e
+        return self.client.ha_get(*args, **kwargs)
 
-    @defer.inlineCallbacks
     def ha_get_slice(self, *args, **kwargs):
-        try:
-            kwargs['consistency'] = ConsistencyLevel.LOCAL_QUORUM
-            result = yield self.client.get_slice(*args, **kwargs)
-            defer.returnValue(result)
-        except UnavailableException as e:
-            try:
-                kwargs['consistency'] = ConsistencyLevel.ONE
-                result = yield self.client.get_slice(*args, **kwargs)
-                defer.returnValue(result)
-            except (NotFoundException, UnavailableException) as e:
-                raise e
+        # Only simple reads of a row (as made by get_columns) are memoized or
+        # cached.  Check the request's memo first, then the row cache (if the
+        # request can use it), before going to Cassandra.  Reads that aren't
+        # for a request never use the row cache.
+        if (args or
+            not set(kwargs.keys()) <= set(["key", "column_family", "names"])):
+            return self.trace.time("cassandra.get_slice",
+                                   self._ha_get_slice(*args, **kwargs))
+
+        keyspace, table, key = (self.cass_keyspace,
+                                kwargs["column_family"],
+                                kwargs["key"])
+        names = kwargs.get("names")
+        predicate = tuple(sorted(names)) if names else None
+
+        def read_from_cassandra():
+            return self.trace.time("cassandra.get_slice",
+                                   self._ha_get_slice(**kwargs))
+
+        def read_from_cache():
+            if ((self.row_cache is None) or
+                (self.memo is None) or
+                (not self.memo.use_row_cache)):
+                return read_from_cassandra()
+            return self.row_cache.read_through(keyspace, table, key, predicate,
+                                               read_from_cassandra)
+
+        if self.memo is None:
+            return read_from_cache()
+        return self.memo.read_through(keyspace, table, key, predicate,
+                                      read_from_cache)
+
+    def _ha_get_slice(self, *args, **kwargs):
+        return self.client.ha_get_slice(*args, **kwargs)
+
+    @classmethod
+    def ha_multiget_slice(cls, *args, **kwargs):
+        return cls.client.ha_multiget_slice(*args, **kwargs)
+
+    @classmethod
+    def invalidate_rows(cls, rows):
+        """Removes rows that are being written from the row cache (if there is
+        one).  `rows` is a list of (table, row key) tuples."""
+        if cls.row_cache is not None:
+            for (table, key) in rows:
+                cls.row_cache.invalidate(cls.cass_keyspace, table, key)
+
+    @classmethod
+    def _invalidate_rows_around(cls, rows, d):
+        """Invalidates the given rows before the write `d` (a Deferred) is
+        made and again once it has completed, so that reads that overlap with
+        the write aren't left in the cache."""
+        cls.invalidate_rows(rows)
+
+        def invalidate_again(result):
+            cls.invalidate_rows(rows)
+            return result
+
+        d.addBoth(invalidate_again)
+        return d
+
+    def _invalidate_row_around(self, kwargs, d):
+        """As _invalidate_rows_around, for a write `d` to the row and table
+        given in `kwargs`.  The row is also invalidated in this model's memo
+        (if it has one)."""
+        table, key = kwargs.get("column_family"), kwargs.get("key")
+
+        if self.memo is not None:
+            self.memo.invalidate(self.cass_keyspace, table, key)
+
+            def invalidate_memo_again(result):
+                self.memo.invalidate(self.cass_keyspace, table, key)
+                return result
+
+            d.addBoth(invalidate_memo_again)
+
+        return self._invalidate_rows_around([(table, key)], d)
 
-    @defer.inlineCallbacks
     def ha_batch_insert(self, *args, **kwargs):
-        try:
-            kwargs['consistency'] = ConsistencyLevel.LOCAL_QUORUM
-            yield self.client.batch_insert(*args, **kwargs)
-        except UnavailableException as e:
-            try:
-                kwargs['consistency'] = ConsistencyLevel.ONE
-                yield self.client.batch_insert(*args, **kwargs)
-            except (NotFoundException, UnavailableException) as e:
-                raise e
+        return self._invalidate_row_around(
+                          kwargs,
+                          self.trace.time("cassandra.batch_insert",
+                                          self._ha_batch_insert(*args, **kwargs)))
+
+    def _ha_batch_insert(self, *args, **kwargs):
+        return self.client.ha_batch_insert(*args, **kwargs)
 
     @classmethod
-    @defer.inlineCallbacks
-    def ha_batch_mutate(cls, *args, **kwargs):
-        try:
-            kwargs['consistency'] = ConsistencyLevel.LOCAL_QUORUM
-            yield cls.client.batch_mutate(*args, **kwargs)
-        except UnavailableException as e:
-            try:
-                kwargs['consistency'] = ConsistencyLevel.ONE
-                yield cls.client.batch_mutate(*args, **kwargs)
-            except (NotFoundException, UnavailableException) as e:
-                raise e
+    def ha_batch_mutate(cls, mutmap, *args, **kwargs):
+        rows = [(table, key)
+                for key, cfmap in mutmap.iteritems()
+                for table in cfmap]
+        return cls._invalidate_rows_around(
+                          rows,
+                          cls._ha_batch_mutate(mutmap, *args, **kwargs))
+
+    @classmethod
+    def _ha_batch_mutate(cls, *args, **kwargs):
+        return cls.client.ha_batch_mutate(*args, **kwargs)
 
-    @defer.inlineCallbacks
     def ha_remove(self, *args, **kwargs):
-        try:
-            kwargs['consistency'] = ConsistencyLevel.LOCAL_QUORUM
-            yield self.client.remove(*args, **kwargs)
-        except UnavailableException as e:
-            try:
-                kwargs['consistency'] = ConsistencyLevel.ONE
-                yield self.client.remove(*args, **kwargs)
-            except (NotFoundException, UnavailableException) as e:
-                raise e
+        return self._invalidate_row_around(
+                          kwargs,
+                          self.trace.time("cassandra.remove",
+                                          self._ha_remove(*args, **kwargs)))
+
+    def _ha_remove(self, *args, **kwargs):
+        return self.client.ha_remove(*args, **kwargs)
@@ -1,2 +1,22 @@
 # @file __init__.py
 #
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+from metaswitch.crest.api.base import BaseHandler
+
+
+class ProvisioningHandler(BaseHandler):
+    """
+    Base class for provisioning handlers.  Requests that change subscribers
+    can rebuild large parts of the cache, so they are admitted separately
+    from requests that only read.
+    """
+    def get_admission_class(self):
+        if self.request.method in ("PUT", "POST", "DELETE"):
+            return "provisioning"
+        return super(ProvisioningHandler, self).get_admission_class()
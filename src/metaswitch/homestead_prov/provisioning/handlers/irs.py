@@ -9,63 +9,64 @@
 
 from twisted.internet import defer
 from telephus.cassandra.ttypes import NotFoundException
-from metaswitch.crest.api.base import BaseHandler
 
+from metaswitch.crest.api.base import BaseHandler
+from . import ProvisioningHandler
 from ..models import PrivateID, IRS
 
 JSON_PUBLIC_IDS = "public_ids"
 JSON_PRIVATE_IDS = "private_ids"
 
 
-class AllIRSHandler(BaseHandler):
+class AllIRSHandler(ProvisioningHandler):
     @BaseHandler.requires_empty_body
     @defer.inlineCallbacks
     def post(self):
-        irs_uuid = yield IRS.create()
+        irs_uuid = yield IRS.create(self.row_memo)
         self.set_header("Location", "/irs/%s" % irs_uuid)
         self.set_status(201)
         self.finish()
 
 
-class IRSHandler(BaseHandler):
+class IRSHandler(ProvisioningHandler):
     @BaseHandler.requires_empty_body
     @defer.inlineCallbacks
     def delete(self, irs_uuid):
         try:
-            yield IRS(irs_uuid).delete()
+            yield IRS(irs_uuid, self.row_memo).delete()
             self.finish()
         except NotFoundException:
             self.send_error(204)
 
 
-class IRSAllPublicIDsHandler(BaseHandler):
+class IRSAllPublicIDsHandler(ProvisioningHandler):
     @defer.inlineCallbacks
     def get(self, irs_uuid):
         try:
-            ids = yield IRS(irs_uuid).get_associated_publics()
+            ids = yield IRS(irs_uuid, self.row_memo).get_associated_publics()
             self.send_json({JSON_PUBLIC_IDS: ids})
         except NotFoundException:
             self.send_error(404)
 
 
-class IRSAllPrivateIDsHandler(BaseHandler):
+class IRSAllPrivateIDsHandler(ProvisioningHandler):
     @defer.inlineCallbacks
     def get(self, irs_uuid):
         try:
-            ids = yield IRS(irs_uuid).get_associated_privates()
+            ids = yield IRS(irs_uuid, self.row_memo).get_associated_privates()
             self.send_json({JSON_PRIVATE_IDS: ids})
         except NotFoundException:
             self.send_error(404)
 
 
-class IRSPrivateIDHandler(BaseHandler):
+class IRSPrivateIDHandler(ProvisioningHandler):
     @BaseHandler.requires_empty_body
     @defer.inlineCallbacks
     def put(self, irs_uuid, private_id):
         try:
             # Associating the IRS with the private ID also does the reciprocal
             # association.
-            yield PrivateID(private_id).associate_irs(irs_uuid)
+            yield PrivateID(private_id, self.row_memo).associate_irs(irs_uuid)
             self.finish()
         except NotFoundException:
             self.send_error(404)
@@ -76,7 +77,7 @@ class IRSPrivateIDHandler(BaseHandler):
         try:
             # Dissociating the IRS with the private ID also does the reciprocal
             # association.
-            yield PrivateID(private_id).dissociate_irs(irs_uuid)
+            yield PrivateID(private_id, self.row_memo).dissociate_irs(irs_uuid)
             self.finish()
         except NotFoundException:
             self.send_error(404)
@@ -14,6 +14,7 @@ from twisted.internet import defer
 from telephus.cassandra.ttypes import NotFoundException
 from metaswitch.crest import settings
 from metaswitch.crest.api.base import BaseHandler
+from . import ProvisioningHandler
 from ..models import PrivateID
 from metaswitch.common import utils
 
@@ -26,11 +27,11 @@ JSON_ASSOC_IRS = "associated_implicit_registration_sets"
 JSON_ASSOC_PUBLIC_IDS = "associated_public_ids"
 
 
-class PrivateHandler(BaseHandler):
+class PrivateHandler(ProvisioningHandler):
     @defer.inlineCallbacks
     def get(self, private_id):
         try:
-            (digest_ha1, plaintext_password, realm) = yield PrivateID(private_id).get_digest()
+            (digest_ha1, plaintext_password, realm) = yield PrivateID(private_id, self.row_memo).get_digest()
             body = {JSON_DIGEST_HA1: digest_ha1, JSON_REALM: realm}
 
             if plaintext_password != "":
@@ -78,7 +79,8 @@ class PrivateHandler(BaseHandler):
                 # PUT that contains a digest.
                 plaintext_password = ""
 
-            yield PrivateID(private_id).put_digest(digest_ha1,
+            yield PrivateID(private_id, self.row_memo).put_digest(
+                                                   digest_ha1,
                                                    plaintext_password,
                                                    realm)
             self.finish()
@@ -89,29 +91,29 @@ class PrivateHandler(BaseHandler):
     @defer.inlineCallbacks
     def delete(self, private_id):
         try:
-            yield PrivateID(private_id).delete()
+            yield PrivateID(private_id, self.row_memo).delete()
             self.finish()
         except NotFoundException:
             self.send_error(204)
 
 
-class PrivateAllIrsHandler(BaseHandler):
+class PrivateAllIrsHandler(ProvisioningHandler):
     @defer.inlineCallbacks
     def get(self, private_id):
         try:
-            irses = yield PrivateID(private_id).get_irses()
+            irses = yield PrivateID(private_id, self.row_memo).get_irses()
             self.send_json({JSON_ASSOC_IRS: irses})
 
         except NotFoundException:
             self.send_error(404)
 
 
-class PrivateOneIrsHandler(BaseHandler):
+class PrivateOneIrsHandler(ProvisioningHandler):
     @BaseHandler.requires_empty_body
     @defer.inlineCallbacks
     def put(self, private_id, irs_uuid):
         try:
-            yield PrivateID(private_id).associate_irs(irs_uuid)
+            yield PrivateID(private_id, self.row_memo).associate_irs(irs_uuid)
             self.finish()
         except NotFoundException:
             self.send_error(404)
@@ -120,17 +122,17 @@ class PrivateOneIrsHandler(BaseHandler):
     @defer.inlineCallbacks
     def delete(self, private_id, irs_uuid):
         try:
-            yield PrivateID(private_id).dissociate_irs(irs_uuid)
+            yield PrivateID(private_id, self.row_memo).dissociate_irs(irs_uuid)
             self.finish()
         except NotFoundException:
             self.send_error(204)
 
 
-class PrivateAllPublicIdsHandler(BaseHandler):
+class PrivateAllPublicIdsHandler(ProvisioningHandler):
     @defer.inlineCallbacks
     def get(self, private_id):
         try:
-            public_ids = yield PrivateID(private_id).get_public_ids()
+            public_ids = yield PrivateID(private_id, self.row_memo).get_public_ids()
             self.send_json({JSON_ASSOC_PUBLIC_IDS: public_ids})
         except NotFoundException:
             self.send_error(404)
@@ -7,13 +7,18 @@
 # Otherwise no rights are granted except for those provided to you by
 # Metaswitch Networks in a separate written agreement.
 
+import base64
+from collections import deque
 from twisted.internet import defer, reactor
 from telephus.cassandra.ttypes import NotFoundException
-from metaswitch.crest.api.base import BaseHandler, SlowRequestHandler
+from metaswitch.crest import settings
+from metaswitch.crest.api.base import SlowRequestHandler, loadmonitor
 import json
 import logging
+import msgpack
 
-from ..models import PublicID
+from . import ProvisioningHandler
+from ..models import PublicID, uuid_to_str
 
 _log = logging.getLogger("crest.api.homestead.provisioning")
 
@@ -26,85 +31,294 @@ def sleep(seconds):
 
 JSON_PRIVATE_IDS = "private_ids"
 
+
+class _JSONListingWriter(object):
+    """Writes a listing of public IDs as a single JSON document"""
+    def __init__(self, handler):
+        self.handler = handler
+        self.first_entry = True
+
+    def start(self):
+        self.handler.write('{"public_ids": [')
+
+    def write_entries(self, entries):
+        if entries:
+            data = ",".join(json.dumps(entry) for entry in entries)
+            if not self.first_entry:
+                data = "," + data
+            self.first_entry = False
+            self.handler.write(data)
+
+    def keepalive(self):
+        # Whitespace is not significant in JSON.
+        self.handler.write(' ')
+
+    def end(self, continuation=None):
+        if continuation is not None:
+            self.handler.write('], "continuation": %s}' % json.dumps(continuation))
+        else:
+            self.handler.write(']}')
+
+
+class _NDJSONListingWriter(object):
+    """Writes a listing of public IDs as newline-delimited JSON - one JSON
+    object per line"""
+    CONTENT_TYPE = "application/x-ndjson"
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def start(self):
+        self.handler.set_header("Content-Type", self.CONTENT_TYPE)
+
+    def write_entries(self, entries):
+        if entries:
+            self.handler.write("".join(json.dumps(entry) + "\n"
+                                       for entry in entries))
+
+    def keepalive(self):
+        # Clients should skip blank lines.
+        self.handler.write("\n")
+
+    def end(self, continuation=None):
+        if continuation is not None:
+            self.handler.write(json.dumps({"continuation": continuation}) + "\n")
+
+
+class _MsgpackListingWriter(object):
+    """Writes a listing of public IDs as a stream of msgpack maps"""
+    CONTENT_TYPE = "application/x-msgpack"
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def start(self):
+        self.handler.set_header("Content-Type", self.CONTENT_TYPE)
+
+    def write_entries(self, entries):
+        # BaseHandler.write encodes dictionaries as msgpack.
+        for entry in entries:
+            self.handler.write(entry)
+
+    def keepalive(self):
+        # Clients should skip nil values.
+        self.handler.write(msgpack.packb(None))
+
+    def end(self, continuation=None):
+        if continuation is not None:
+            self.handler.write({"continuation": continuation})
+
 class AllPublicIDsHandler(SlowRequestHandler):
     @defer.inlineCallbacks
     def get(self):
-        num_chunks = int(self.get_argument("chunk-proportion", default=256))
-        chunk = self.get_argument("chunk", default="")
-        chunk = int(chunk) if chunk != "" else None
+        continuation = self.get_argument("continuation", default="")
+        if continuation != "":
+            # Resume an earlier listing.  The continuation token tells us the
+            # chunks that listing was for, and how far through it got.
+            try:
+                (num_chunks, chunk, position) = self.decode_continuation(continuation)
+            except ValueError:
+                self.send_error(400, "Invalid continuation token")
+                return
+        else:
+            num_chunks = int(self.get_argument("chunk-proportion", default=256))
+            chunk = self.get_argument("chunk", default="")
+            chunk = int(chunk) if chunk != "" else None
+            position = None
+
         fast = (self.get_argument("excludeuuids", default="false") == "true")
+        limit = int(self.get_argument("limit", default=0))
+        concurrency = int(self.get_argument("concurrency",
+                                    default=settings.PUBLIC_ID_LISTING_CONCURRENCY))
+        concurrency = max(1, min(concurrency,
+                                 settings.PUBLIC_ID_LISTING_MAX_CONCURRENCY))
+
+        if chunk != None:
+            _log.info("Retrieving public IDs (chunk {}/{})".format(chunk, num_chunks))
+        else:
+            _log.info("Retrieving all public IDs (broken into {} chunks)".format(num_chunks))
+
+        token_ranges = self.token_ranges(num_chunks, chunk)
+        if position is not None:
+            token_ranges = [(max(start, position), end)
+                            for (start, end) in token_ranges if end > position]
+
+        # Stream the results back in the format the client asked for.
+        if self.accepts(_NDJSONListingWriter.CONTENT_TYPE):
+            writer = _NDJSONListingWriter(self)
+        elif self.accepts(_MsgpackListingWriter.CONTENT_TYPE):
+            writer = _MsgpackListingWriter(self)
+        else:
+            writer = _JSONListingWriter(self)
 
-        # Break the Cassandra ring down into chunks
-        min_token = -2**63;
-        max_token = (2**63)-1;
+        # Query all subscribers, page-by-page, and stream it back to the
+        # client.  The first page of up to `concurrency` chunks is queried at
+        # once, but the results are written in ring order.  Each entry in
+        # in_flight is the end token of a chunk and the Deferred for its next
+        # page.
+        num_results = 0
+        in_flight = deque()
+        next_range = 0
+
+        # The IRS of each service profile read so far, as many public IDs
+        # share a service profile.
+        self.sp_irs_memo = {}
+
+        writer.start()
+        try:
+            while in_flight or next_range < len(token_ranges):
+                while (next_range < len(token_ranges) and
+                       len(in_flight) < concurrency):
+                    (start, end) = token_ranges[next_range]
+                    in_flight.append((end, self.get_page_entries(start, end, fast)))
+                    next_range += 1
+
+                (end, d) = in_flight.popleft()
+                (entries, next_start) = yield d
+                writer.write_entries(entries)
+                self.flush()
+                num_results += len(entries)
+
+                # Everything up to `position` in the ring has now been
+                # written.  If the chunk has more pages, query the next one.
+                if next_start is not None:
+                    position = next_start
+                    in_flight.appendleft(
+                            (end, self.get_page_entries(next_start, end, fast)))
+                else:
+                    position = end
+
+                if in_flight or next_range < len(token_ranges):
+                    if limit and num_results >= limit:
+                        # We've written as many results as the client asked
+                        # for.  Give them a token to continue from here.
+                        for (_, d) in in_flight:
+                            d.addErrback(lambda _: None)
+                        writer.end(self.encode_continuation(num_chunks,
+                                                            chunk,
+                                                            position))
+                        self.finish()
+                        return
+
+                    if not entries:
+                        # Write some data to prevent the request from being
+                        # timed out by nginx.
+                        writer.keepalive()
+
+                    # Back off if other requests are being slowed down,
+                    # rather than always sleeping between chunks (which made
+                    # listing the whole ring take minutes even when idle).
+                    pause = loadmonitor.background_pause(
+                                            settings.PUBLIC_ID_LISTING_MAX_PAUSE)
+                    if pause > 0:
+                        yield sleep(pause)
+        except:
+            # Don't leave errors from the other queries unhandled.
+            for (_, d) in in_flight:
+                d.addErrback(lambda _: None)
+            raise
+
+        writer.end()
+
+        self.finish()
+
+    @staticmethod
+    def encode_continuation(num_chunks, chunk, position):
+        """Encodes how far through a listing we've got as an opaque token"""
+        token = "{}:{}:{}".format(num_chunks,
+                                  "" if chunk is None else chunk,
+                                  position)
+        return base64.urlsafe_b64encode(token)
+
+    @staticmethod
+    def decode_continuation(continuation):
+        """Decodes a continuation token, returning the number of chunks and
+        the chunk (or None) of the listing, and the token in the ring it got
+        up to.  Raises ValueError if the token is invalid."""
+        try:
+            token = base64.urlsafe_b64decode(str(continuation))
+        except TypeError:
+            raise ValueError("Invalid continuation token")
+
+        (num_chunks, chunk, position) = token.split(":")
+        num_chunks = int(num_chunks)
+        chunk = int(chunk) if chunk != "" else None
+        position = int(position)
+
+        if num_chunks <= 0 or (chunk is not None and not 0 <= chunk < num_chunks):
+            raise ValueError("Invalid continuation token")
+
+        return (num_chunks, chunk, position)
+
+    @staticmethod
+    def token_ranges(num_chunks, chunk=None):
+        """Breaks the Cassandra ring down into num_chunks chunks, and returns
+        the (start, end) tokens of each chunk in ring order (or of just the
+        given chunk)."""
+        min_token = -2**63
+        max_token = (2**63)-1
 
         chunk_size = (max_token - min_token) / num_chunks
 
         if chunk != None:
-            _log.info("Retrieving public IDs (chunk {}/{})".format(chunk, num_chunks))
             start = min_token + chunk * chunk_size
             max_start = min([max_token, start + chunk_size])
         else:
-            _log.info("Retrieving all public IDs (broken into {} chunks)".format(num_chunks))
             start = min_token
             max_start = max_token
 
-        # Query all subscribers, chunk-by-chunk, and stream it back to the
-        # client
-        first_result = True
-        first_chunk = True
-
-        self.write('{"public_ids": [')
+        ranges = []
         while start < max_start:
-            if not first_chunk:
-                # Write some data to prevent the request from being timed out by
-                # nginx. Use a space as whitespace is not significant in JSON.
-                self.write(' ')
+            end = min([max_token, start + chunk_size])
+            ranges.append((start, end))
+            start = end
 
-                # Sleep to avoid using too much CPU. Don't sleep on the first
-                # iteration as this makes the request take at least 1 second
-                # (which is bad for tools which query small subsections of the
-                # token space).
-                yield sleep(1)
+        return ranges
 
-            end = min([max_token, start + chunk_size])
-            result = yield PublicID.get_chunk(start=str(start), finish=str(end))
-            for p in result:
-                sp = None
-                irs = None
+    @defer.inlineCallbacks
+    def get_page_entries(self, start, end, fast):
+        """Gets the entries to write for a page of the public IDs in a chunk
+        of the ring, and the token to start the next page from (or None)"""
+        (result, next_start) = yield PublicID.get_chunk_page(
+                                        start,
+                                        end,
+                                        settings.PUBLIC_ID_LISTING_PAGE_SIZE)
 
-                if first_result:
-                    first_result = False
-                else:
-                    self.write(',')
-
-                # Retrieving these UUIDs is time-consuming and may not be
-                # necessary - skip them if "excludeuuids=true" is given in the URL.
-                if not fast:
-                    sp = yield p.get_sp_str()
-                    irs = yield p.get_irs_str()
-                    self.write(json.dumps({"public_id": p.row_key_str,
-                                           "sp": sp,
-                                           "irs": irs
-                                          }))
-                else:
-                    self.write(json.dumps({"public_id": p.row_key_str}))
+        # Retrieving these UUIDs is time-consuming and may not be
+        # necessary - skip them if "excludeuuids=true" is given in the URL.
+        if fast:
+            defer.returnValue(([{"public_id": p.row_key_str} for p in result],
+                               next_start))
 
-            self.flush()
-            start = end
+        # Look up the SP and IRS of all the public IDs in the page together.
+        # Public IDs that have been deleted since the chunk was queried are
+        # skipped.
+        if len(self.sp_irs_memo) > settings.PUBLIC_ID_LISTING_SP_MEMO_SIZE:
+            self.sp_irs_memo.clear()
+        sps_and_irses = yield PublicID.get_sps_and_irses(
+                                            [p.row_key for p in result],
+                                            self.sp_irs_memo)
 
-            first_chunk = False
+        entries = []
+        for p in result:
+            if p.row_key not in sps_and_irses:
+                _log.debug("Public ID {} no longer exists".format(p.row_key_str))
+                continue
 
-        self.write(']}')
+            (sp_uuid, irs_uuid) = sps_and_irses[p.row_key]
+            entries.append({"public_id": p.row_key_str,
+                            "sp": uuid_to_str(sp_uuid),
+                            "irs": uuid_to_str(irs_uuid)
+                           })
 
-        self.finish()
+        defer.returnValue((entries, next_start))
 
 
-class PublicIDServiceProfileHandler(BaseHandler):
+class PublicIDServiceProfileHandler(ProvisioningHandler):
     @defer.inlineCallbacks
     def get(self, public_id):
         try:
-            pub = PublicID(public_id)
+            pub = PublicID(public_id, self.row_memo)
             sp_uuid = yield pub.get_sp()
             irs_uuid = yield pub.get_irs()
 
@@ -117,11 +331,11 @@ class PublicIDServiceProfileHandler(BaseHandler):
             self.send_error(404)
 
 
-class PublicIDIRSHandler(BaseHandler):
+class PublicIDIRSHandler(ProvisioningHandler):
     @defer.inlineCallbacks
     def get(self, public_id):
         try:
-            irs_uuid = yield PublicID(public_id).get_irs()
+            irs_uuid = yield PublicID(public_id, self.row_memo).get_irs()
             self.set_header("Location", "/irs/%s" % irs_uuid)
             self.set_status(303)
             self.finish()
@@ -130,11 +344,11 @@ class PublicIDIRSHandler(BaseHandler):
             self.send_error(404)
 
 
-class PublicIDPrivateIDHandler(BaseHandler):
+class PublicIDPrivateIDHandler(ProvisioningHandler):
     @defer.inlineCallbacks
     def get(self, public_id):
         try:
-            private_ids = yield PublicID(public_id).get_private_ids()
+            private_ids = yield PublicID(public_id, self.row_memo).get_private_ids()
             self.send_json({JSON_PRIVATE_IDS: private_ids})
 
         except NotFoundException:
@@ -9,9 +9,10 @@
 
 from twisted.internet import defer
 from telephus.cassandra.ttypes import NotFoundException
-from metaswitch.crest.api.base import BaseHandler
 import defusedxml.ElementTree as ET
 
+from metaswitch.crest.api.base import BaseHandler
+from . import ProvisioningHandler
 from ..models import PublicID, ServiceProfile
 
 JSON_PUBLIC_IDS = "public_ids"
@@ -58,7 +59,7 @@ def verify_relationships(start=None, finish=None):
 
                 # If we've got a service profile, check it's a child of the IRS.
                 if sp_uuid:
-                    parent_irs_uuid = yield ServiceProfile(sp_uuid).get_irs()
+                    parent_irs_uuid = yield ServiceProfile(sp_uuid, handler.row_memo).get_irs()
                     if irs_uuid != parent_irs_uuid:
                         handler.send_error(
                                 403, "Service Profile not a child of IRS")
@@ -67,7 +68,7 @@ def verify_relationships(start=None, finish=None):
                 # If we've got a public ID, check it's a child of the service
                 # profile.
                 if public_id:
-                    parent_sp_uuid = yield PublicID(public_id).get_sp()
+                    parent_sp_uuid = yield PublicID(public_id, handler.row_memo).get_sp()
                     if sp_uuid != parent_sp_uuid:
                         handler.send_error(
                                 403, "Public ID not a child of Service Profile")
@@ -86,39 +87,39 @@ def verify_relationships(start=None, finish=None):
     return decorator
 
 
-class AllServiceProfilesHandler(BaseHandler):
+class AllServiceProfilesHandler(ProvisioningHandler):
     @BaseHandler.requires_empty_body
     @verify_relationships()
     @defer.inlineCallbacks
     def post(self, irs_uuid):
-        sp_uuid = yield ServiceProfile.create(irs_uuid)
+        sp_uuid = yield ServiceProfile.create(irs_uuid, self.row_memo)
         self.set_header("Location", "/irs/%s/service_profiles/%s" %
                                                             (irs_uuid, sp_uuid))
         self.set_status(201)
         self.finish()
 
 
-class ServiceProfileHandler(BaseHandler):
+class ServiceProfileHandler(ProvisioningHandler):
     @BaseHandler.requires_empty_body
     @verify_relationships()
     @defer.inlineCallbacks
     def delete(self, irs_uuid, sp_uuid):
-        yield ServiceProfile(sp_uuid).delete()
+        yield ServiceProfile(sp_uuid, self.row_memo).delete()
         self.finish()
 
 
-class SPAllPublicIDsHandler(BaseHandler):
+class SPAllPublicIDsHandler(ProvisioningHandler):
     @verify_relationships()
     @defer.inlineCallbacks
     def get(self, irs_uuid, sp_uuid):
         try:
-            public_ids = yield ServiceProfile(sp_uuid).get_public_ids()
+            public_ids = yield ServiceProfile(sp_uuid, self.row_memo).get_public_ids()
             self.send_json({JSON_PUBLIC_IDS: public_ids})
         except NotFoundException:
             self.send_error(404)
 
 
-class SPPublicIDHandler(BaseHandler):
+class SPPublicIDHandler(ProvisioningHandler):
     @verify_relationships(finish=-1)  # The public ID need not exist already.
     @defer.inlineCallbacks
     def put(self, irs_uuid, sp_uuid, public_id):
@@ -130,8 +131,8 @@ class SPPublicIDHandler(BaseHandler):
             xml_public_id = xml_root.find("Identity").text
 
             if public_id == xml_public_id:
-                yield PublicID(public_id).put_publicidentity(xml, sp_uuid)
-                yield ServiceProfile(sp_uuid).associate_public_id(public_id)
+                yield PublicID(public_id, self.row_memo).put_publicidentity(xml, sp_uuid)
+                yield ServiceProfile(sp_uuid, self.row_memo).associate_public_id(public_id)
             else:
                 self.send_error(403, "Incorrect XML Identity")
         except ET.ParseError:
@@ -141,18 +142,18 @@ class SPPublicIDHandler(BaseHandler):
     @defer.inlineCallbacks
     def delete(self, irs_uuid, sp_uuid, public_id):
         try:
-            yield PublicID(public_id).delete()
+            yield PublicID(public_id, self.row_memo).delete()
             self.finish()
         except NotFoundException:
             self.send_error(204)
 
 
-class SPFilterCriteriaHandler(BaseHandler):
+class SPFilterCriteriaHandler(ProvisioningHandler):
     @verify_relationships()
     @defer.inlineCallbacks
     def get(self, irs_uuid, sp_uuid):
         try:
-            ifc = yield ServiceProfile(sp_uuid).get_ifc()
+            ifc = yield ServiceProfile(sp_uuid, self.row_memo).get_ifc()
             self.write(ifc)
             self.finish()
         except NotFoundException:
@@ -164,6 +165,6 @@ class SPFilterCriteriaHandler(BaseHandler):
         xml_body = self.request.body
 
         if self.request.body:
-            yield ServiceProfile(sp_uuid).update_ifc(xml_body)
+            yield ServiceProfile(sp_uuid, self.row_memo).update_ifc(xml_body)
         else:
             self.send_error(400, "Body is empty")
@@ -15,13 +15,11 @@ import uuid
 import logging
 
 from twisted.internet import defer
-from telephus.cassandra.ttypes import NotFoundException, UnavailableException
-from telephus.client import ConsistencyLevel
 from metaswitch.crest.api.exceptions import IRSNoSIPURI
 
 from .. import config
 from ..auth_vectors import DigestAuthVector
-from metaswitch.crest.api import utils
+from metaswitch.crest.api import murmur3, utils
 from ..cassandra import CassandraModel
 
 _log = logging.getLogger("crest.api.homestead.provisioning")
@@ -94,8 +92,8 @@ class IRS(ProvisioningModel):
 
     cass_table = config.IRS_TABLE
 
-    def __init__(self, row_key):
-        super(IRS, self).__init__(convert_uuid(row_key))
+    def __init__(self, row_key, memo=None):
+        super(IRS, self).__init__(convert_uuid(row_key), memo)
 
         # The row key is stored a byte array so need to explicitly store a human
         # readable version.
@@ -103,11 +101,11 @@ class IRS(ProvisioningModel):
 
     @classmethod
     @defer.inlineCallbacks
-    def create(cls):
+    def create(cls, memo=None):
         irs_uuid = uuid.uuid4()
         _log.debug("Create IRS %s" % irs_uuid)
 
-        yield IRS(irs_uuid).touch()
+        yield IRS(irs_uuid, memo).touch()
         defer.returnValue(irs_uuid)
 
     @defer.inlineCallbacks
@@ -125,7 +123,7 @@ class IRS(ProvisioningModel):
         sp_uuids = yield self.get_associated_service_profiles()
 
         public_ids = utils.flatten(
-                                [(yield ServiceProfile(uuid).get_public_ids())
+                                [(yield ServiceProfile(uuid, self.memo).get_public_ids())
                                  for uuid in sp_uuids])
         defer.returnValue(public_ids)
 
@@ -157,11 +155,11 @@ class IRS(ProvisioningModel):
 
         sp_uuids = yield self.get_associated_service_profiles()
         for sp_uuid in sp_uuids:
-            yield ServiceProfile(sp_uuid).delete()
+            yield ServiceProfile(sp_uuid, self.memo).delete()
 
         private_ids = yield self.get_associated_privates()
         for priv in private_ids:
-            yield PrivateID(priv).dissociate_irs(self.row_key)
+            yield PrivateID(priv, self.memo).dissociate_irs(self.row_key)
 
         self.delete_row()
 
@@ -179,37 +177,49 @@ class IRS(ProvisioningModel):
 
         found_sip_uri = False
 
-        sp_uuids = yield self.get_associated_service_profiles()
+        # Read the service profiles in this IRS, then the public identities
+        # in all of those profiles.  Each level of the hierarchy is read with
+        # a single (batched) query rather than a query per row.
+        with self.trace.span("irs.read_service_profiles"):
+            sp_uuids = yield self.get_associated_service_profiles()
+            sp_keys = [convert_uuid(sp_uuid) for sp_uuid in sp_uuids]
+            sp_rows = yield ServiceProfile.get_columns_multikeys(sp_keys)
+
+            sp_public_ids = {key: ServiceProfile.public_ids_from_columns(columns)
+                             for key, columns in sp_rows.iteritems()}
+            public_id_rows = yield PublicID.get_columns_multikeys(
+                                                utils.flatten(sp_public_ids.values()),
+                                                [PublicID.PUBLICIDENTITY])
+
+        for sp_key in sp_keys:
+            # Add a ServiceProfile node for each profile in this IRS that
+            # exists.
+            if sp_key not in sp_rows:
+                continue
 
-        for sp_uuid in sp_uuids:
-            # Add a ServiceProfile node for each profile in this IRS with iFCs.
-            #
             # Note that the IFC XML contains a wrapping <ServiceProfile> tag.
-            try:
-                ifc_xml = yield ServiceProfile(sp_uuid).get_ifc()
-            except NotFoundException:
+            ifc_xml = sp_rows[sp_key].get(ServiceProfile.IFC_COLUMN)
+            if ifc_xml is None:
                 ifc_xml = "<ServiceProfile><InitialFilterCriteria></InitialFilterCriteria></ServiceProfile>"
 
             sp_elem = ET.fromstring(ifc_xml)
 
-            try:
-                # Add a PublicIdentity node for each ID in this service
-                # profile. The contents of this node are stored in the
-                # database.
-                public_ids = yield ServiceProfile(sp_uuid).get_public_ids()
+            # Add a PublicIdentity node for each ID in this service profile.
+            # The contents of this node are stored in the database.  Skip the
+            # service profile if any of its public identities are missing.
+            public_ids = sp_public_ids[sp_key]
+            pub_id_xmls = [public_id_rows.get(pub_id, {}).get(PublicID.PUBLICIDENTITY)
+                           for pub_id in public_ids]
+            if None in pub_id_xmls:
+                continue
 
-                for pub_id in public_ids:
-                    if pub_id.startswith("sip:"):
-                        found_sip_uri = True;
-                    pub_id_xml = yield PublicID(pub_id).get_publicidentity()
-                    pub_id_xml_elem = ET.fromstring(pub_id_xml)
-                    sp_elem.append(pub_id_xml_elem)
+            for pub_id, pub_id_xml in zip(public_ids, pub_id_xmls):
+                if pub_id.startswith("sip:"):
+                    found_sip_uri = True
+                sp_elem.append(ET.fromstring(pub_id_xml))
 
-                # Append the Service Profile to the IMS subscription.
-                root.append(sp_elem)
-
-            except NotFoundException:
-                pass
+            # Append the Service Profile to the IMS subscription.
+            root.append(sp_elem)
 
         # Throw an exception if we're building an IMS subscription that doesn't
         # contain a SIP URI.
@@ -233,18 +243,27 @@ class IRS(ProvisioningModel):
         _log.debug("Rebuild cache for IRS %s" % self.row_key_str)
 
         try:
-            xml = yield self.build_imssubscription_xml()
-            timestamp = self._cache.generate_timestamp()
-
-            for pub_id in (yield self.get_associated_publics()):
-                yield self._cache.put_ims_subscription(pub_id, xml, timestamp)
-
+            with self.trace.span("irs.build_imssubscription_xml"):
+                xml = yield self.build_imssubscription_xml()
         except IRSNoSIPURI:
             _log.warning("Not pushing to cache since IRS doesn't contain a SIP URI")
-            pass
-
-        for priv_id in (yield self.get_associated_privates()):
-            yield PrivateID(priv_id).rebuild()
+            xml = None
+
+        # Gather everything we need to rebuild the cache before writing any of
+        # it, then update the IMPU and IMPI tables in a single batch so that
+        # the number of writes doesn't grow with the size of the IRS.
+        (public_ids, private_ids) = yield utils.gather_results(
+                                            [self.get_associated_publics(),
+                                             self.get_associated_privates()])
+        private_entries = yield utils.gather_results(
+                            [PrivateID(priv_id, self.memo).get_cache_entry()
+                             for priv_id in private_ids])
+
+        with self.trace.span("cache.rebuild_entries"):
+            yield self._cache.rebuild_entries(public_ids,
+                                              xml,
+                                              dict(zip(private_ids, private_entries)),
+                                              self._cache.generate_timestamp())
 
 class PrivateID(ProvisioningModel):
     """Model representing a provisioned private ID"""
@@ -272,7 +291,7 @@ class PrivateID(ProvisioningModel):
     @defer.inlineCallbacks
     def get_public_ids(self):
         irs_uuids = yield self.get_irses()
-        public_ids = utils.flatten([(yield IRS(uuid).get_associated_publics())
+        public_ids = utils.flatten([(yield IRS(uuid, self.memo).get_associated_publics())
                                                          for uuid in irs_uuids])
         defer.returnValue(public_ids)
 
@@ -285,9 +304,10 @@ class PrivateID(ProvisioningModel):
             columns[self.REALM] = realm
 
         yield self.modify_columns(columns)
-        yield self._cache.put_av(self.row_key,
-                                 DigestAuthVector(digest, realm, None),
-                                 self._cache.generate_timestamp())
+        with self.trace.span("cache.put_av"):
+            yield self._cache.put_av(self.row_key,
+                                     DigestAuthVector(digest, realm, None),
+                                     self._cache.generate_timestamp())
 
     @defer.inlineCallbacks
     def delete(self):
@@ -295,53 +315,49 @@ class PrivateID(ProvisioningModel):
 
         irs_uuids = yield self.get_irses()
         for irs_uuid in irs_uuids:
-            yield IRS(irs_uuid).dissociate_private_id(self.row_key)
+            yield IRS(irs_uuid, self.memo).dissociate_private_id(self.row_key)
 
         yield self.delete_row()
-        yield self._cache.delete_private_id(self.row_key,
-                                            self._cache.generate_timestamp())
+        with self.trace.span("cache.delete_private_id"):
+            yield self._cache.delete_private_id(self.row_key,
+                                                self._cache.generate_timestamp())
 
     @defer.inlineCallbacks
     def associate_irs(self, irs_uuid):
         yield self.assert_row_exists()
         yield self.modify_columns({self.ASSOC_IRS_PREFIX + uuid_to_str(irs_uuid):
                                                             NULL_COLUMN_VALUE})
-        yield IRS(irs_uuid).associate_private_id(self.row_key)
+        yield IRS(irs_uuid, self.memo).associate_private_id(self.row_key)
         yield self.rebuild()
 
     @defer.inlineCallbacks
     def dissociate_irs(self, irs_uuid):
         yield self.delete_column(self.ASSOC_IRS_PREFIX + uuid_to_str(irs_uuid))
-        yield IRS(irs_uuid).dissociate_private_id(self.row_key)
+        yield IRS(irs_uuid, self.memo).dissociate_private_id(self.row_key)
         yield self.rebuild()
 
+    @defer.inlineCallbacks
+    def get_cache_entry(self):
+        """Gets the auth vector and the associated public IDs that make up the
+        IMPI cache entry for this private ID"""
+        (digest, plaintext_password, realm) = yield self.get_digest()
+        public_ids = yield self.get_public_ids()
+        defer.returnValue((DigestAuthVector(digest, realm, None), public_ids))
+
     @defer.inlineCallbacks
     def rebuild(self):
         """ Rebuild the IMPI table in the cache """
         _log.debug("Rebuild cache for private ID %s" % self.row_key_str)
 
-        # Get all the information we need to rebuild the cache.  Do this before
-        # deleting any cache entries to minimize the time the cache is empty.
-        (digest, plaintext_password, realm) = yield self.get_digest()
-
-        public_ids = []
-        for irs in (yield self.get_irses()):
-            for pub_id in (yield IRS(irs).get_associated_publics()):
-                public_ids.append(pub_id)
-
-        timestamp = self._cache.generate_timestamp()
-
-        # Delete the existing cache entry then write back the digest and the
-        # associated public IDs.  Take 1ms off the timestamp to ensure the
-        # update happens after the delete.
-        yield self._cache.delete_private_id(self.row_key, timestamp - 1000)
-        yield self._cache.put_av(self.row_key,
-                                 DigestAuthVector(digest, realm, None),
-                                 self._cache.generate_timestamp())
-        for pub_id in public_ids:
-            yield self._cache.put_associated_public_id(self.row_key,
-                                                       pub_id,
-                                                       timestamp)
+        # Get all the information we need to rebuild the cache before writing
+        # anything.  The existing cache entry is replaced (deleted and written
+        # back) in a single batch.
+        entry = yield self.get_cache_entry()
+        with self.trace.span("cache.rebuild_entries"):
+            yield self._cache.rebuild_entries([],
+                                              None,
+                                              {self.row_key: entry},
+                                              self._cache.generate_timestamp())
 
 
 class PublicID(ProvisioningModel):
@@ -371,7 +387,7 @@ class PublicID(ProvisioningModel):
     @defer.inlineCallbacks
     def get_irs(self):
         sp_uuid = yield self.get_sp()
-        irs_uuid = yield ServiceProfile(sp_uuid).get_irs()
+        irs_uuid = yield ServiceProfile(sp_uuid, self.memo).get_irs()
         defer.returnValue(irs_uuid)
 
     @defer.inlineCallbacks
@@ -382,34 +398,83 @@ class PublicID(ProvisioningModel):
     @defer.inlineCallbacks
     def get_private_ids(self):
         irs_uuid = yield self.get_irs()
-        private_ids = yield IRS(irs_uuid).get_associated_privates()
+        private_ids = yield IRS(irs_uuid, self.memo).get_associated_privates()
         defer.returnValue(private_ids)
 
     @classmethod
     @defer.inlineCallbacks
-    def get_chunk(self, start, finish):
-        # Query an appropiate section of the Cassandra ring. Because we're
-        # limiting the query by token, we can accept an unrestricted number of
-        # results (10M is our max recommended size).
-        try:
-            values = yield self.client.get_range_slices(column_family=self.cass_table,
-                                                        start=start,
-                                                        finish=finish,
-                                                        use_tokens=True,
-                                                        count=10000000,
-                                                        consistency=ConsistencyLevel.LOCAL_QUORUM)
-        except UnavailableException:
-            values = yield self.client.get_range_slices(column_family=self.cass_table,
-                                                        start=start,
-                                                        finish=finish,
-                                                        use_tokens=True,
-                                                        count=10000000,
-                                                        consistency=ConsistencyLevel.ONE)
-
+    def get_chunk_page(cls, start, finish, count):
+        """Gets a page of the public IDs in a section of the Cassandra ring:
+        at most `count` rows with tokens after `start`, up to and including
+        `finish`.  Returns the public IDs and the token to start the next
+        page from (or None if this was the last page of the section).
+
+        Pages are resumed from the token of the last row in the page.  This
+        would skip rows whose keys hash to the same token as that row, but
+        that is vanishingly unlikely with 64-bit tokens."""
+        # Only whether each row has any columns matters, so only fetch one.
+        kwargs = dict(column_family=cls.cass_table,
+                      start=str(start),
+                      finish=str(finish),
+                      use_tokens=True,
+                      count=count,
+                      column_count=1)
+        values = yield cls.client.ha_get_range_slices(**kwargs)
+
+        # Deleted rows can come back with no columns.  They still count
+        # towards the page, though.
         keys = [x.key for x in values if len(x.columns) > 0]
         public_ids = [PublicID(x) for x in keys]
+        next_start = None
+        if len(values) == count:
+            next_start = murmur3.token(values[-1].key)
+
+            # A range whose start and finish are the same is the whole ring,
+            # so make sure we don't ask for that.
+            if next_start >= int(finish):
+                next_start = None
+
         _log.info("Queried tokens {} to {} - received {} results".format(start, finish, len(public_ids)))
-        defer.returnValue(public_ids)
+        defer.returnValue((public_ids, next_start))
+
+    @classmethod
+    @defer.inlineCallbacks
+    def get_sps_and_irses(cls, public_ids, sp_irs_memo=None):
+        """Gets the service profile and IRS of each of a set of public IDs.
+        Returns a dictionary mapping each public ID that exists to a tuple of
+        (SP UUID, IRS UUID).
+
+        The public IDs' rows are read in a single (batched) query, and then
+        the service profiles' rows in another.  sp_irs_memo, if given, is a
+        dictionary of SP row keys to IRS UUIDs that have already been read -
+        it is updated with the new service profiles read."""
+        if sp_irs_memo is None:
+            sp_irs_memo = {}
+
+        public_id_rows = yield cls.get_columns_multikeys(public_ids,
+                                                         [cls.SERVICE_PROFILE])
+        sp_uuids = {public_id: row[cls.SERVICE_PROFILE]
+                    for public_id, row in public_id_rows.iteritems()
+                    if cls.SERVICE_PROFILE in row}
+
+        # Many public IDs share a service profile, so only read each one
+        # once.
+        sp_keys = set(convert_uuid(sp_uuid) for sp_uuid in sp_uuids.values())
+        unread_sp_keys = [key for key in sp_keys if key not in sp_irs_memo]
+        sp_rows = yield ServiceProfile.get_columns_multikeys(
+                                            unread_sp_keys,
+                                            [ServiceProfile.IRS_COLUMN])
+        for key, row in sp_rows.iteritems():
+            if ServiceProfile.IRS_COLUMN in row:
+                sp_irs_memo[key] = row[ServiceProfile.IRS_COLUMN]
+
+        sps_and_irses = {}
+        for public_id, sp_uuid in sp_uuids.iteritems():
+            irs_uuid = sp_irs_memo.get(convert_uuid(sp_uuid))
+            if irs_uuid is not None:
+                sps_and_irses[public_id] = (sp_uuid, irs_uuid)
+
+        defer.returnValue(sps_and_irses)
 
     @defer.inlineCallbacks
     def put_publicidentity(self, xml, sp_uuid):
@@ -422,12 +487,13 @@ class PublicID(ProvisioningModel):
         irs_uuid = yield self.get_irs()
         sp_uuid = yield self.get_sp()
 
-        yield ServiceProfile(sp_uuid).dissociate_public_id(self.row_key)
+        yield ServiceProfile(sp_uuid, self.memo).dissociate_public_id(self.row_key)
         yield self.delete_row()
-        yield self._cache.delete_public_id(self.row_key,
-                                           self._cache.generate_timestamp())
+        with self.trace.span("cache.delete_public_id"):
+            yield self._cache.delete_public_id(self.row_key,
+                                               self._cache.generate_timestamp())
 
-        yield IRS(irs_uuid).rebuild()
+        yield IRS(irs_uuid, self.memo).rebuild()
 
 
 class ServiceProfile(ProvisioningModel):
@@ -439,8 +505,8 @@ class ServiceProfile(ProvisioningModel):
 
     cass_table = config.SP_TABLE
 
-    def __init__(self, row_key):
-        super(ServiceProfile, self).__init__(convert_uuid(row_key))
+    def __init__(self, row_key, memo=None):
+        super(ServiceProfile, self).__init__(convert_uuid(row_key), memo)
 
         # The row key is stored a byte array so need to explicitly store a human
         # readable version.
@@ -448,13 +514,13 @@ class ServiceProfile(ProvisioningModel):
 
     @classmethod
     @defer.inlineCallbacks
-    def create(self, irs_uuid):
+    def create(self, irs_uuid, memo=None):
         sp_uuid = uuid.uuid4()
         _log.debug("Create service profile %s" % sp_uuid)
 
-        yield ServiceProfile(sp_uuid).modify_columns(
+        yield ServiceProfile(sp_uuid, memo).modify_columns(
                                             {self.IRS_COLUMN: str(irs_uuid)})
-        yield IRS(irs_uuid).associate_service_profile(sp_uuid)
+        yield IRS(irs_uuid, memo).associate_service_profile(sp_uuid)
         defer.returnValue(sp_uuid)
 
     @defer.inlineCallbacks
@@ -463,6 +529,12 @@ class ServiceProfile(ProvisioningModel):
                                                 self.PUBLIC_ID_COLUMN_PREFIX)
         defer.returnValue(pub_hash.keys())
 
+    @classmethod
+    def public_ids_from_columns(cls, columns):
+        """Gets the public IDs from a service profile's columns (as returned
+        by get_columns)"""
+        return cls.strip_column_prefix(columns, cls.PUBLIC_ID_COLUMN_PREFIX).keys()
+
     @defer.inlineCallbacks
     def get_ifc(self):
         retval = yield self.get_column_value(self.IFC_COLUMN)
@@ -496,10 +568,10 @@ class ServiceProfile(ProvisioningModel):
         _log.debug("Delete service profile %s" % self.row_key_str)
         public_ids = yield self.get_public_ids()
         for pub_id in public_ids:
-            yield PublicID(pub_id).delete()
+            yield PublicID(pub_id, self.memo).delete()
 
         irs_uuid = yield self.get_irs()
-        IRS(irs_uuid).dissociate_service_profile(self.row_key)
+        IRS(irs_uuid, self.memo).dissociate_service_profile(self.row_key)
 
         self.delete_row()
 
@@ -508,4 +580,4 @@ class ServiceProfile(ProvisioningModel):
         _log.debug("Rebuild cache for parent of service profile %s" %
                    self.row_key_str)
         irs_uuid = yield self.get_irs()
-        yield IRS(irs_uuid).rebuild()
+        yield IRS(irs_uuid, self.memo).rebuild()
@@ -153,6 +153,36 @@ class TestCache(unittest.TestCase):
         batch_mutate.callback(None)
         self.assertEquals(res.value(), None)
 
+    def test_rebuild_entries(self):
+        """Test IMS subscriptions and private IDs can be rebuilt in the cache
+        in a single batch"""
+        self.cass_client.batch_mutate.return_value = batch_mutate = defer.Deferred()
+        auth = DigestAuthVector("ha1_test", "realm", "qop")
+        res = Result(self.cache.rebuild_entries(["pub1", "pub2"],
+                                                "xml",
+                                                {"priv": (auth, ["pub1", "pub2"])},
+                                                self.timestamp,
+                                                ttl=self.ttl))
+        self.assertEquals(self.cass_client.batch_mutate.call_count, 1)
+        mutmap = self.cass_client.batch_mutate.call_args[0][0]
+        self.assertEquals(set(mutmap.keys()), set(["pub1", "pub2", "priv"]))
+
+        impu_columns = {c.name: (c.value, c.timestamp) for c in mutmap["pub1"]["impu"]}
+        self.assertEquals(impu_columns["ims_subscription_xml"], ("xml", self.timestamp))
+        self.assertEquals(impu_columns["primary_ccf"], ("ccf", self.timestamp))
+
+        # The private ID's row is deleted just before the new columns are
+        # written.
+        impi_mutations = mutmap["priv"]["impi"]
+        self.assertEquals(impi_mutations[0], Deletion(self.timestamp - 1000))
+        impi_columns = {c.name: (c.value, c.timestamp) for c in impi_mutations[1:]}
+        self.assertEquals(impi_columns["digest_ha1"], ("ha1_test", self.timestamp))
+        self.assertEquals(impi_columns["public_id_pub1"], ("", self.timestamp))
+        self.assertEquals(impi_columns["public_id_pub2"], ("", self.timestamp))
+
+        batch_mutate.callback(None)
+        self.assertEquals(res.value(), None)
+
     def test_get_ims_subscription(self):
         """Test an IMS subscription can be fetched from the cache"""
 
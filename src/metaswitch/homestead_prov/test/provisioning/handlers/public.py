@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+# @file public.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import json
+import unittest
+import mock
+import msgpack
+
+from twisted.internet import defer
+from metaswitch.homestead_prov.provisioning.handlers import public
+
+class TestAllPublicIDsHandler(unittest.TestCase):
+    """
+    Detailed, isolated unit tests of the AllPublicIDsHandler class.
+    """
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.app = mock.MagicMock()
+        self.request = mock.MagicMock()
+
+        # Each page has two public IDs, and there are two pages in each chunk.
+        self.get_chunk_page_patch = mock.patch(
+            "metaswitch.homestead_prov.provisioning.models.PublicID.get_chunk_page",
+            side_effect=self.get_chunk_page)
+        self.get_chunk_page = self.get_chunk_page_patch.start()
+
+    def tearDown(self):
+        self.get_chunk_page_patch.stop()
+
+    def get_chunk_page(self, start, finish, count):
+        # The second page of each chunk starts from token `finish - 10`.
+        if start == finish - 10:
+            names = ["%d-c" % finish, "%d-d" % finish]
+            next_start = None
+        else:
+            names = ["%d-a" % finish, "%d-b" % finish]
+            next_start = finish - 10
+
+        public_ids = []
+        for name in names:
+            public_id = mock.MagicMock()
+            public_id.row_key = name
+            public_id.row_key_str = name
+            public_ids.append(public_id)
+
+        return defer.succeed((public_ids, next_start))
+
+    def all_public_ids(self):
+        return ["%d-%s" % (end, suffix)
+                for (_, end) in public.AllPublicIDsHandler.token_ranges(2)
+                for suffix in "abcd"]
+
+    def get_public_ids(self, accept="", **args):
+        """Makes a request to list public IDs, and returns the response
+        body"""
+        self.request.headers = {"Accept": accept}
+        handler = public.AllPublicIDsHandler(self.app, self.request)
+        args.setdefault("chunk-proportion", "2")
+        args.setdefault("excludeuuids", "true")
+        handler.get_argument = lambda name, default=None: args.get(name, default)
+
+        output = []
+        handler.flush = mock.MagicMock()
+        handler.finish = mock.MagicMock()
+        with mock.patch("cyclone.web.RequestHandler.write",
+                        side_effect=lambda handler, chunk: output.append(chunk)):
+            handler.get()
+        self.assertTrue(handler.finish.called)
+        return "".join(output)
+
+    def list_public_ids(self, **args):
+        return json.loads(self.get_public_ids(**args))
+
+    def test_list_all(self):
+        """Test all the pages of all the chunks are listed in ring order"""
+        body = self.list_public_ids()
+        self.assertEquals([p["public_id"] for p in body["public_ids"]],
+                          self.all_public_ids())
+        self.assertNotIn("continuation", body)
+
+    def test_continuation(self):
+        """Test a listing can be done a page at a time using continuation
+        tokens"""
+        public_ids = []
+        body = self.list_public_ids(limit="3")
+        while "continuation" in body:
+            public_ids += [p["public_id"] for p in body["public_ids"]]
+            body = self.list_public_ids(limit="3",
+                                        continuation=body["continuation"])
+        public_ids += [p["public_id"] for p in body["public_ids"]]
+
+        self.assertEquals(public_ids, self.all_public_ids())
+
+    def test_ndjson(self):
+        """Test a listing can be returned as newline-delimited JSON"""
+        body = self.get_public_ids(accept="application/x-ndjson", limit="3")
+        records = [json.loads(line) for line in body.splitlines() if line]
+        self.assertEquals(records[:-1],
+                          [{"public_id": p} for p in self.all_public_ids()[:4]])
+        self.assertIn("continuation", records[-1])
+
+    def test_msgpack(self):
+        """Test a listing can be returned as a stream of msgpack maps"""
+        body = self.get_public_ids(accept="application/x-msgpack")
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(body)
+        self.assertEquals([r for r in unpacker if r is not None],
+                          [{"public_id": p} for p in self.all_public_ids()])
+
+    def test_uuids(self):
+        """Test that the SP and IRS of each public ID are listed, looked up a
+        page at a time with a memo of service profiles shared by all the
+        chunks, and that public IDs deleted during the listing are skipped"""
+        memos = []
+
+        def get_sps_and_irses(public_ids, sp_irs_memo):
+            # Each chunk's public IDs are in their own service profile, and
+            # the "b" public IDs have been deleted.
+            memos.append((id(sp_irs_memo), len(sp_irs_memo)))
+            sp = "sp-" + public_ids[0].split("-")[0]
+            sp_irs_memo[sp] = "irs"
+            return defer.succeed({p: (sp, "irs") for p in public_ids
+                                  if not p.endswith("-b")})
+
+        with mock.patch("metaswitch.homestead_prov.provisioning.models.PublicID.get_sps_and_irses",
+                        side_effect=get_sps_and_irses):
+            body = self.list_public_ids(excludeuuids="false", concurrency="1")
+
+        self.assertEquals(body["public_ids"],
+                          [{"public_id": p, "sp": "sp-" + p.split("-")[0], "irs": "irs"}
+                           for p in self.all_public_ids() if not p.endswith("-b")])
+
+        # Every page used the same memo, which built up over the chunks: the
+        # first page of each chunk sees the service profiles of the chunks
+        # before it, and the second page also sees its own.
+        num_chunks = len(public.AllPublicIDsHandler.token_ranges(2))
+        self.assertEquals(len(set(memo_id for (memo_id, _) in memos)), 1)
+        self.assertEquals([size for (_, size) in memos],
+                          [chunk + page for chunk in range(num_chunks) for page in (0, 1)])
+
+    @mock.patch("metaswitch.crest.api.base.BaseHandler.send_error")
+    def test_invalid_continuation(self, send_error):
+        """Test that continuation tokens that can't be parsed, or that are for
+        chunks that don't exist, are rejected"""
+        encode = public.AllPublicIDsHandler.encode_continuation
+        for continuation in ["!!!",
+                             encode(0, None, 0),
+                             encode(-1, None, 0),
+                             encode(4, 4, 0),
+                             encode(4, -1, 0)]:
+            send_error.reset_mock()
+            handler = public.AllPublicIDsHandler(self.app, self.request)
+            handler.get_argument = lambda name, default=None: {"continuation": continuation}.get(name, default)
+            handler.get()
+            send_error.assert_called_once_with(400, "Invalid continuation token")
+        self.assertFalse(self.get_chunk_page.called)
+
+if __name__ == "__main__":
+    unittest.main()
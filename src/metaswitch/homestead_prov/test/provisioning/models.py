@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+# @file models.py
+#
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import uuid
+import unittest
+import xml.etree.ElementTree as ET # nosec
+
+import mock
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from telephus.cassandra.ttypes import NotFoundException
+
+from metaswitch.crest.api import cassandrapool
+from metaswitch.crest.api.exceptions import IRSNoSIPURI
+from metaswitch.crest.api.rowcache import RowCache, RowMemo
+from metaswitch.homestead_prov import config
+from metaswitch.homestead_prov.provisioning import models
+from metaswitch.homestead_prov.provisioning.models import IRS, PublicID, ServiceProfile
+
+IRS_UUID = uuid.UUID("00000000-0000-0000-0000-000000000001")
+SP1_UUID = uuid.UUID("00000000-0000-0000-0000-0000000000a1")
+SP2_UUID = uuid.UUID("00000000-0000-0000-0000-0000000000a2")
+
+IFC = "<ServiceProfile><InitialFilterCriteria>%s</InitialFilterCriteria></ServiceProfile>"
+
+
+def MockColumn(name, val):
+    m = mock.MagicMock()
+    m.column.name = name
+    m.column.value = val
+    return m
+
+
+class FakeCassandraClient(object):
+    """Serves get_slice and multiget_slice requests from a dictionary of
+    tables, each a dictionary of rows"""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.multiget_keys = []
+
+    def columns(self, table, key, names):
+        row = self.tables[table].get(key, {})
+        return [MockColumn(name, value) for name, value in row.iteritems()
+                if names is None or name in names]
+
+    def get_slice(self, key, column_family, names=None, consistency=None):
+        return defer.succeed(self.columns(column_family, key, names))
+
+    def multiget_slice(self, keys, column_family, names=None, consistency=None):
+        self.multiget_keys.append(list(keys))
+        return defer.succeed({key: self.columns(column_family, key, names)
+                              for key in keys})
+
+
+class ProvisioningModelTestCase(unittest.TestCase):
+    """Runs models against a CassandraPool whose connection is a
+    FakeCassandraClient, so that the pool's batching is used"""
+
+    def setUp(self):
+        self.tables = {config.IRS_TABLE: {},
+                       config.SP_TABLE: {},
+                       config.PUBLIC_TABLE: {}}
+        self.cass = FakeCassandraClient(self.tables)
+
+        for target, attribute, value in [
+                (cassandrapool, "reactor", mock.MagicMock()),
+                (cassandrapool, "ManagedCassandraClientFactory", mock.MagicMock()),
+                (cassandrapool.settings, "MULTIGET_BATCH_SIZE", 2)]:
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        pool = cassandrapool.CassandraPool(config.PROVISIONING_KEYSPACE,
+                                           size=1,
+                                           client_class=lambda factory: self.cass)
+        patcher = mock.patch.object(models.ProvisioningModel, "client", pool, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_irs(self, irs_uuid, sp_uuids):
+        self.tables[config.IRS_TABLE][irs_uuid.bytes] = dict(
+            (IRS.SERVICE_PROFILE_PREFIX + str(sp_uuid), "") for sp_uuid in sp_uuids)
+
+    def add_sp(self, sp_uuid, irs_uuid, public_ids, ifc=None):
+        row = {ServiceProfile.IRS_COLUMN: str(irs_uuid)}
+        if ifc is not None:
+            row[ServiceProfile.IFC_COLUMN] = ifc
+        for public_id in public_ids:
+            row[ServiceProfile.PUBLIC_ID_COLUMN_PREFIX + public_id] = ""
+        self.tables[config.SP_TABLE][sp_uuid.bytes] = row
+
+    def add_public_id(self, public_id, sp_uuid):
+        self.tables[config.PUBLIC_TABLE][public_id] = {
+            PublicID.PUBLICIDENTITY: "<PublicIdentity><Identity>%s</Identity></PublicIdentity>" % public_id,
+            PublicID.SERVICE_PROFILE: str(sp_uuid)}
+
+    def result(self, d):
+        results = []
+        d.addBoth(results.append)
+        self.assertEquals(len(results), 1)
+        if isinstance(results[0], Failure):
+            results[0].raiseException()
+        return results[0]
+
+
+class TestIMSSubscriptionXML(ProvisioningModelTestCase):
+
+    def build_xml(self):
+        xml = self.result(IRS(IRS_UUID).build_imssubscription_xml())
+        root = ET.fromstring(xml)
+        return [(sp.find("InitialFilterCriteria").text,
+                 sorted(identity.text for identity in sp.findall("PublicIdentity/Identity")))
+                for sp in root.findall("ServiceProfile")]
+
+    def test_build(self):
+        """Test that the XML contains every service profile and public ID in
+        the IRS, read in batches"""
+        sp1_ids = ["sip:a@example.com", "sip:b@example.com", "tel:+1234"]
+        sp2_ids = ["sip:c@example.com", "sip:d@example.com"]
+        self.add_irs(IRS_UUID, [SP1_UUID, SP2_UUID])
+        self.add_sp(SP1_UUID, IRS_UUID, sp1_ids, IFC % "ifc1")
+        self.add_sp(SP2_UUID, IRS_UUID, sp2_ids, IFC % "ifc2")
+        for public_id in sp1_ids:
+            self.add_public_id(public_id, SP1_UUID)
+        for public_id in sp2_ids:
+            self.add_public_id(public_id, SP2_UUID)
+
+        self.assertEquals(sorted(self.build_xml()),
+                          [("ifc1", sorted(sp1_ids)), ("ifc2", sorted(sp2_ids))])
+
+        # One batch of service profiles, then three batches of public IDs.
+        self.assertEquals([len(keys) for keys in self.cass.multiget_keys], [2, 2, 2, 1])
+        self.assertEquals(sorted(self.cass.multiget_keys[1] +
+                                 self.cass.multiget_keys[2] +
+                                 self.cass.multiget_keys[3]),
+                          sorted(sp1_ids + sp2_ids))
+
+    def test_missing_rows(self):
+        """Test that service profiles that don't exist, or that contain public
+        IDs that don't exist, are left out"""
+        sp3_uuid = uuid.uuid4()
+        self.add_irs(IRS_UUID, [SP1_UUID, SP2_UUID, sp3_uuid])
+        self.add_sp(SP1_UUID, IRS_UUID, ["sip:a@example.com"])
+        self.add_sp(SP2_UUID, IRS_UUID, ["sip:b@example.com", "sip:missing@example.com"])
+        self.add_public_id("sip:a@example.com", SP1_UUID)
+        self.add_public_id("sip:b@example.com", SP2_UUID)
+
+        self.assertEquals(self.build_xml(), [(None, ["sip:a@example.com"])])
+
+    def test_no_sip_uri(self):
+        """Test that an IRS without a SIP URI is rejected"""
+        self.add_irs(IRS_UUID, [SP1_UUID])
+        self.add_sp(SP1_UUID, IRS_UUID, ["tel:+1234"])
+        self.add_public_id("tel:+1234", SP1_UUID)
+
+        self.assertRaises(IRSNoSIPURI, self.result,
+                          IRS(IRS_UUID).build_imssubscription_xml())
+
+    def test_missing_irs(self):
+        """Test that building the XML for an IRS that doesn't exist fails"""
+        self.assertRaises(NotFoundException, self.result,
+                          IRS(IRS_UUID).build_imssubscription_xml())
+
+
+class TestSPsAndIRSes(ProvisioningModelTestCase):
+
+    def setUp(self):
+        super(TestSPsAndIRSes, self).setUp()
+        self.add_sp(SP1_UUID, IRS_UUID, ["sip:a@example.com", "sip:b@example.com"])
+        self.add_sp(SP2_UUID, IRS_UUID, ["sip:c@example.com"])
+        self.add_public_id("sip:a@example.com", SP1_UUID)
+        self.add_public_id("sip:b@example.com", SP1_UUID)
+        self.add_public_id("sip:c@example.com", SP2_UUID)
+
+    def test_lookup(self):
+        """Test that the SP and IRS of each public ID are returned, with each
+        service profile read once, and public IDs that don't exist left out"""
+        memo = {}
+        result = self.result(PublicID.get_sps_and_irses(
+            ["sip:a@example.com", "sip:b@example.com", "sip:c@example.com",
+             "sip:deleted@example.com"],
+            memo))
+
+        self.assertEquals(result,
+                          {"sip:a@example.com": (str(SP1_UUID), str(IRS_UUID)),
+                           "sip:b@example.com": (str(SP1_UUID), str(IRS_UUID)),
+                           "sip:c@example.com": (str(SP2_UUID), str(IRS_UUID))})
+        self.assertEquals(memo, {SP1_UUID.bytes: str(IRS_UUID),
+                                 SP2_UUID.bytes: str(IRS_UUID)})
+
+        # Two batches of public IDs, and one of the two service profiles.
+        self.assertEquals([len(keys) for keys in self.cass.multiget_keys], [2, 2, 2])
+        self.assertEquals(sorted(self.cass.multiget_keys[2]),
+                          sorted([SP1_UUID.bytes, SP2_UUID.bytes]))
+
+    def test_memo(self):
+        """Test that service profiles in the memo aren't read again"""
+        memo = {SP1_UUID.bytes: str(IRS_UUID)}
+        result = self.result(PublicID.get_sps_and_irses(
+            ["sip:a@example.com", "sip:c@example.com"], memo))
+
+        self.assertEquals(sorted(result.keys()), ["sip:a@example.com", "sip:c@example.com"])
+        self.assertEquals(self.cass.multiget_keys[1], [SP2_UUID.bytes])
+        self.assertIn(SP2_UUID.bytes, memo)
+
+    def test_missing_sp(self):
+        """Test that public IDs whose service profile has been deleted are
+        left out"""
+        del self.tables[config.SP_TABLE][SP2_UUID.bytes]
+        result = self.result(PublicID.get_sps_and_irses(
+            ["sip:a@example.com", "sip:c@example.com"]))
+        self.assertEquals(result.keys(), ["sip:a@example.com"])
+
+
+class TestRowCache(ProvisioningModelTestCase):
+
+    def setUp(self):
+        super(TestRowCache, self).setUp()
+        self.cache = mock.MagicMock()
+        for attribute, value in [("row_cache", RowCache(100, 60)),
+                                 ("_cache", self.cache)]:
+            patcher = mock.patch.object(models.ProvisioningModel, attribute, value, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.add_irs(IRS_UUID, [SP1_UUID])
+        self.add_sp(SP1_UUID, IRS_UUID, ["sip:a@example.com"])
+        self.add_public_id("sip:a@example.com", SP1_UUID)
+
+    def get_publics(self):
+        return sorted(self.result(IRS(IRS_UUID, RowMemo(use_row_cache=True)).get_associated_publics()))
+
+    def test_rebuild_after_other_write(self):
+        """Test that a rebuild sees a write made by another process since the
+        rows were cached, even though GETs don't yet"""
+        self.assertEquals(self.get_publics(), ["sip:a@example.com"])
+
+        # Another process adds a service profile to the IRS.
+        self.add_irs(IRS_UUID, [SP1_UUID, SP2_UUID])
+        self.add_sp(SP2_UUID, IRS_UUID, ["sip:b@example.com"])
+        self.add_public_id("sip:b@example.com", SP2_UUID)
+        self.assertEquals(self.get_publics(), ["sip:a@example.com"])
+
+        self.result(IRS(IRS_UUID, RowMemo()).rebuild())
+        public_ids = self.cache.rebuild_entries.call_args[0][0]
+        self.assertEquals(sorted(public_ids), ["sip:a@example.com", "sip:b@example.com"])
+        self.assertIn("sip:b@example.com", self.cache.rebuild_entries.call_args[0][1])
+
+if __name__ == "__main__":
+    unittest.main()